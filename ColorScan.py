@@ -23,22 +23,22 @@ from tkinter import ttk #for an updated visual style
 from PIL import Image, ImageTk #for making openCV images able to be displayed by tkinter
 import os #for filepath operations
 import sys #for commandline arguments
+from collections import OrderedDict #for the requests waiting to be computed
+from concurrent.futures import ThreadPoolExecutor #for computing in the background
+import threading #for waiting for the outputs to be saved in the background
 
 import matplotlib #For plotting histograms
 matplotlib.use("TkAgg")
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
 from matplotlib.figure import Figure
-import matplotlib.pyplot as plt
 
+#The analysis steps themselves, shared with batch processing
+from ColorScanEngine import ColorAnalysis, INVALID_PRESET_NUM, imageHistograms, pasteShape, \
+     shapeStamp, cachedShapeStamp, stampStatistics, \
+     conformPresets, refinementPreset, findContours, similarContours, contourFeatures, contourHitIndex, scaleShapeData, CONTOUR_MODES, HISTOGRAM_OUTPUTS, RESULTS_OUTPUTS
 
 
 
-#These are required to replace the missing constants in the OpenCV 3
-CV_CONTOURS_MATCH_I1 = 1 #sum of absolute differences of reciprocals of each image invariant
-CV_CONTOURS_MATCH_I2 = 2 #sum of absolute differences of each image invariant
-CV_CONTOURS_MATCH_I3 = 3 #greatest absolute difference of image invariants, normalized to A
-
-
 #Keycodes for keyboard events
 ENTER = 13
 ESC = 27
@@ -46,12 +46,8 @@ TAB = 9
 
 sizeFudge = 0 #Number of pixels to decrease the size of the displayed image by to avoid overlapping borders
 
+COMPUTE_POLL_MS = 10 #Milliseconds between checks for a finished background computation
 
-INVALID_PRESET_NUM = -999999 #A number that will (hopefully) never show up in a valid preset
-
-
-RGB2grayscale_weights = np.array([0.299, 0.587, 0.114]) #RGB weights to convert to grayscale
-#See https://docs.opencv.org/3.4/de/d25/imgproc_color_conversions.html for reference
 
 root = tk.Tk() #initializing the root window
 try:
@@ -82,79 +78,82 @@ def windowAspectAdjust(frameSize, im, scaling=2/3):
 
 
 
-#takes in a 2D array of integers (image channel) and a boolean mask of the same size
-#returns a histogram of the values for that channel in the masked area
-def imageChannelHistogram(channel, mask=None, bins=256):
-    if mask is not None:
-        channel_masked = np.ma.MaskedArray(channel, ~mask).compressed()
-    else:
-        channel_masked = channel
-    heights, edges = np.histogram(channel_masked, bins, (0,256))
-    return heights, edges
-
-
-#Produces the vertices of a regular polygon, where x = cos(2 i (pi) k/n) and y = sin(2 i (pi) k/n) for
-#  k from 0 to n-1 for open polygon (toClose=False) or from 0 to n for closed polygon (toClose=True)
-#  argument phi rotates the polygon, argument center shifts the origin, r controls the radius of the circumscribing circle
-def regularPolygonPoints(n, phi=0, center=np.array([0,0]), r=1, toClose=False):
-    angles = np.array([2*np.pi*k/n+phi for k in range(n+int(toClose))])
-    points = np.array([r*np.cos(angles)+center[0], r*np.sin(angles)+center[1]]).T
-    return points
-
-
-#Generalized OpenCV shape drawing function for various possible geometries
-#Args: image array (numpy) im, string shape ['polygon','rectangle','circle']
-#  numpy 2D vector for center coordinates of the shape, list of data for the shape:
-#     data organkzation: [general shape arguments, [size arguments]]
-#     Ex: polygon:   [# of sides, angle of polygon, [radius]]
-#         circle:    [[radius]]
-#         rectangle: [[width, height]]
-def drawShape(im, shape, center, data, color, thickness):
-    
-    if shape=='polygon':
+#Object: ComputeScheduler
+#Purpose: runs slow computations (e.g. the analysis steps) in a background thread so that the window stays responsive
+#   Only one computation runs at a time, and only the latest request of each kind waits for it, so when a slider moves
+#   faster than the image can be analyzed the values in between are skipped, and the last value is always computed
+#   Results are handed back in the main thread with tkinter's after, since tkinter can only be used from there
+class ComputeScheduler:
 
-        n_sides = data[0]
-        angle = data[1]
-        radius = data[2][0]
+    def __init__(self, widget):
+        self.widget = widget
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.running = None #(future, publish) of the computation in progress
+        self.pending = OrderedDict() #kind -> (compute, publish) of the latest request of each kind, oldest kind first
+        self.pollId = None #the scheduled check for the computation in progress
 
-        points = regularPolygonPoints(n_sides, angle, center, radius)
 
-        
-        if thickness>=0:
-            cv2.polylines(im, np.array([points]).astype(np.int32), True, color, thickness)
-        else:
-            cv2.fillConvexPoly(im, np.array([points]).astype(np.int32), color)
-                                        
-    elif shape=='rectangle':
+    #Requests compute() to run in the background, then publish(result) to run in the main thread
+    #   A request replaces the waiting request of the same kind, if there is one
+    def submit(self, kind, compute, publish):
+        self.pending[kind] = (compute, publish)
+        if self.running is None:
+            self.startNext()
 
-        width = data[0][0]
-        height = data[0][1]
 
-        #cv2 Rectangles are defined by two points (stored as tuples)
-        tl = tuple((center-np.array([width/2,height/2])).astype(int)) 
-        br = tuple((center+np.array([width/2,height/2])).astype(int))
+    #Starts the oldest waiting request
+    def startNext(self):
+        kind, (compute, publish) = self.pending.popitem(last=False)
+        self.running = (self.executor.submit(compute), publish)
+        if self.pollId is None:
+            self.pollId = self.widget.after(COMPUTE_POLL_MS, self.poll)
 
-        
-        cv2.rectangle(im, tl, br, color, thickness)
 
-    elif shape=='circle':
+    #Publishes the result of the computation in progress once it is done
+    #   (the next request is started first, so the thread isn't idle while the result is displayed)
+    def poll(self):
+        self.pollId = None
+        if self.running is None:
+            return
 
-        radius = data[0][0]
-        #cv2 Circles are defined by a center (tuple) and a radius
-        cv2.circle(im, tuple(center.astype(int)), radius, color, thickness)
-        
-        
-    else:
-        raise NotImplementedError(f"Shape {shape} not implemented!")
-            
+        future, publish = self.running
+        if not future.done():
+            self.pollId = self.widget.after(COMPUTE_POLL_MS, self.poll)
+            return
 
+        self.running = None
+        if len(self.pending)>0:
+            self.startNext()
+        publish(future.result())
+
+
+    #Waits for every request to be computed and published, for actions that need the latest results
+    def finish(self):
+        while self.running is not None:
+            if self.pollId is not None:
+                self.widget.after_cancel(self.pollId)
+                self.pollId = None
+            #Waits for the computation without raising its error, which poll passes on
+            self.running[0].exception()
+            self.poll()
+
+
+    #Drops the waiting requests and stops publishing results, e.g. when the window is closed
+    def close(self):
+        self.pending.clear()
+        self.running = None
+        if self.pollId is not None:
+            self.widget.after_cancel(self.pollId)
+            self.pollId = None
+        self.executor.shutdown(wait=False)
 
 
 
 
 #Object: AnalysisWindow
 #Purpose: Analysis window object to contain tkinter objects and opencv analysis methods
-class AnalysisWindow:
+#   (the analysis itself is inherited from ColorAnalysis in ColorScanEngine.py)
+class AnalysisWindow(ColorAnalysis):
 
     def __init__(self, window, base):
         
@@ -180,9 +179,18 @@ class AnalysisWindow:
         self.V_saveHSV = tk.BooleanVar(value=True)
         self.V_saveLAB = tk.BooleanVar(value=True)
         self.V_saveHistograms = tk.BooleanVar(value=False)
+        self.V_histogramOutput = tk.StringVar(value="csv+plots")
+        self.V_resultsOutput = tk.StringVar(value="npz+csv")
+        self.V_referenceArea = tk.DoubleVar(value=INVALID_PRESET_NUM)
+        self.V_contourMode = tk.StringVar(value="tree")
+        self.V_refiner_shape = tk.StringVar(value="")
         self.V_refiner_displace_x = tk.IntVar(value=INVALID_PRESET_NUM)
         self.V_refiner_displace_y = tk.IntVar(value=INVALID_PRESET_NUM)
         self.V_refiner_radius = tk.IntVar(value=INVALID_PRESET_NUM)
+        self.V_refiner_width = tk.IntVar(value=INVALID_PRESET_NUM)
+        self.V_refiner_height = tk.IntVar(value=INVALID_PRESET_NUM)
+        self.V_refiner_sides = tk.IntVar(value=INVALID_PRESET_NUM)
+        self.V_refiner_angle = tk.DoubleVar(value=INVALID_PRESET_NUM)
 
         #Fills the array self.presetArray with preset data from the presets file
         self.getPresets()
@@ -220,19 +228,13 @@ class AnalysisWindow:
 
         #Copies image over from base so we don't accidentally change anything
         #Allows for successive analyses of the same image without closing the program
-        self.im = self.base.image.copy()
-
-        #Coversions of the image into various colorspaces for easier analysis
-        self.imHSV = cv2.cvtColor(self.im, cv2.COLOR_BGR2HSV)
-        self.imLAB = cv2.cvtColor(self.im, cv2.COLOR_BGR2LAB)
+        #   (also converts the image to the other colorspaces and sets up the contour lists)
+        ColorAnalysis.__init__(self, self.base.image.copy(), self.base.filePath)
         
 
         #The image that will be displayed at each step of analysis
         self.dispIm = self.im.copy()
 
-        #Will be the sum of all the contour masks
-        self.totalMask = np.zeros(self.im.shape[:2], dtype=np.uint8)
-
 
         #Setting up gui for preset selection
         self.presetLabel = ttk.Label(self.window, text="Preset:")
@@ -394,21 +396,16 @@ class AnalysisWindow:
         ###Next Row###
 
 
-        #Setup for the lists to store contours and contour properties
-        self.contours = [] #contours
-        self.sizes = [] #size of each contour
-        self.closeInds = [] #indices of the contours which are similar to the selected one
-        self.closeIndsPlus = [] #the second step of selection
-        self.addConts = [] #manually added contours
-        self.removeConts = [] #manually removed contours
-        self.centers = [] #centroid of each contour
+        #Menu for how contours are found (see CONTOUR_MODES), used the next time Find Contours is pressed
+        self.contourModeLabel = ttk.Label(self.window, text="Contour mode:")
+        self.contourModeLabel.grid(row=row, column=0, sticky='we')
+        self.contourModeMenu = ttk.OptionMenu(self.window, self.V_contourMode, self.V_contourMode.get(), *CONTOUR_MODES)
+        self.contourModeMenu.grid(row=row, column=1, columnspan=2, sticky='we')
 
-        #Setup for the lists to store information for individual contours post-refinement
-        self.refinedMasks = [] #masks for each refined zone
-        self.refinedCenters = [] #center of each refined zone
 
-        #Setup for printing numbers on the screen after analysis
-        self.numberTextArgs = [] #arguments for each cv2.putText call
+        row += 1
+        ###Next Row###
+
 
         #Button to find the contours
         self.contourButton = ttk.Button(self.window, text = "Find Contours", command=self.cvContour)
@@ -562,6 +559,11 @@ class AnalysisWindow:
         self.RGBCheck.grid(row=row, column=2, sticky='e')
         self.RGBCheck.state(['disabled'])
 
+        #Menu for which files the colors are saved to (see RESULTS_OUTPUTS)
+        self.resultsOutputMenu = ttk.OptionMenu(self.window, self.V_resultsOutput, self.V_resultsOutput.get(), *RESULTS_OUTPUTS)
+        self.resultsOutputMenu.grid(row=row, column=1, sticky='e')
+        self.resultsOutputMenu.state(['disabled'])
+
 
         row += 1
         ###Next Row###
@@ -592,19 +594,51 @@ class AnalysisWindow:
         self.histCheck.grid(row=row, column=2, sticky='e')
         self.histCheck.state(['disabled'])
 
+        #Menu for how the histograms are saved (see HISTOGRAM_OUTPUTS)
+        self.histOutputMenu = ttk.OptionMenu(self.window, self.V_histogramOutput, self.V_histogramOutput.get(), *HISTOGRAM_OUTPUTS)
+        self.histOutputMenu.grid(row=row, column=1, sticky='e')
+        self.histOutputMenu.state(['disabled'])
 
 
-        #Boolean to output the cropped image around each zone
-        #   (currently no option to change this)
-        self.saveCrops=True
-
-        #Number of pixels to expand the border around the cropped zone
-        self.saveBorder = 5
 
         #Variables to store the current position of the mouse on the screen
         self.mousex = None
         self.mousey = None
 
+        #Hit-test index of the contours and the contour the mouse is in (see cvContour and trackMouse)
+        self.contourHits = None
+        self.inContour = -1
+
+        #Everything is drawn at the size the image is displayed at (see updateLayers and convertCoords),
+        #   starting at full size until the display size is known
+        self.dispSize = (self.im.shape[1], self.im.shape[0])
+        self.dispScale = 1
+
+        #Cached layers of the displayed image (see updateLayers), the image the highlight is drawn on,
+        #   and the pixels drawn over the highlight (see drawContours)
+        self.layerKey = None
+        self.layerSources = ()
+        self.dispSmall = None
+        self.dispContours = []
+        self.contourLayer = None
+        self.overlayIm = None
+        self.markedIm = None
+        self.markMask = None
+        self.totalMaskedIm = None
+
+        #The analysis steps and the search for similar contours run in the background (see ComputeScheduler)
+        self.scheduler = ComputeScheduler(self.window)
+
+        #The thread waiting for the outputs of the last analysis to be saved (see finishOutputs)
+        self.outputsThread = None
+
+        #The pending redraw of the mouse highlight (see trackMouse)
+        self.hoverCallback = None
+
+        #The main window asks this window to draw the image when it is resized or a snapshot is taken
+        self.base.overlay = self
+        self.window.protocol("WM_DELETE_WINDOW", self.close)
+
         #Variable to store the currently selected contour (by clicking)
         self.selectedCont = -1
         
@@ -631,10 +665,20 @@ class AnalysisWindow:
     def close(self):
         self.base.display.unbind("<Motion>")
         self.base.display.unbind("<Button-1>")
+        self.base.overlay = None
+
+        self.scheduler.close()
+        if self.hoverCallback is not None:
+            self.window.after_cancel(self.hoverCallback)
 
         self.window.destroy()
 
 
+    #Preset variables are read from the tkinter variables instead of a preset dictionary
+    def getSetting(self, name):
+        return getattr(self, name).get()
+
+
     #Stores the array of presets to the presetArray variable,
     #   or makes a new file to store presets in
     def getPresets(self):
@@ -720,6 +764,9 @@ class AnalysisWindow:
 
         #If the preset array already exists, append a row
         else:
+            #Presets saved by an older version may be missing some variables
+            self.presetArray = conformPresets(self.presetArray, presetArray_row.dtype)
+
             #If the preset to be saved doesn't already have a row, make it
             if presetName not in self.presetArray['PresetName']:
                 self.presetArray = np.append(self.presetArray, presetArray_row)
@@ -763,199 +810,253 @@ class AnalysisWindow:
 
 
     #Updates the analysis of the image, depending on the selected mode
+    #   The settings are read here, then the steps run in the background and the result is displayed by showAnalyses
+    #   (results are kept in the stage cache, so only the steps after a changed setting are recomputed)
     def updateAnalyses(self, e=None):
         mode = self.showWhat.get()
 
-        #if the original image is selected, no analysis steps will be applied
-        self.analyzed = self.im.copy()
+        #tkinter variables can only be read in the main thread
+        settings = (mode,)+self.maskSettings()+(self.dileroSettings(), self.blurSettings())
 
-        #Each analysis step modifies self.analyzed in order
+        self.scheduler.submit('analyses', lambda: self.computeStages(*settings), self.showAnalyses)
 
-        #if the mask is selected
-        if mode>0:
-            self.cvMask()
-        #if a dilation/erosion has been applied
-        if mode>1:
-            self.cvDilateErode()
-        #if the blurred image is selected
-        if mode>2:
-            self.cvBlur()
 
-        #Displays the analyzed image
+    #Displays the result of the analysis steps (see updateAnalyses)
+    def showAnalyses(self, result):
+        self.analyzed, self.stageKey = result
         self.updateImage()
 
-                    
 
     #Displays the analyses performed
-    def updateImage(self, e=None):
-
-        #If at least one analysis has been performed, must be converted to color from grayscale
-        if self.showWhat.get()>0:        
-            self.dispIm[:,:,:] = cv2.cvtColor(self.analyzed, cv2.COLOR_GRAY2BGR)
+    #   Everything is drawn at the size the image is displayed at, so redrawing costs the same whatever the image size
+    #   The base image and the outlines of all the contours are only drawn again when they change (see updateLayers),
+    #   and the contour under the mouse is drawn separately by showHover
+    #   The image is drawn at the size the main window displays it at in a frame of the given size (default: its frame's)
+    def updateImage(self, e=None, size=None):
+
+        #If at least one analysis has been performed the contours can be found
+        if self.showWhat.get()>0:
             self.contourButton.state(['!disabled'])
-        #If no analyses have been performed the image is already color
         else:
-            self.dispIm = self.im.copy()
             self.contourButton.state(['disabled'])
 
-        #Will show only the zones that are included in the mask
-        if self.showRefinedZones.get():
-            self.dispIm = self.totalMaskedIm.copy()
+        self.renderImage(self.base.displaySize(self.im, size))
+        self.showHover()
+
+
+    #Draws the displayed image (without the mouse highlight) at the given size (width, height), see updateImage
+    def renderImage(self, size):
+        self.updateLayers(size)
 
         #If the Draw Contours option is selected, will draw contours on the displayed image
         if self.drawConts.get():
             self.drawContours()
-            if len(self.numberTextArgs)>0:
-                for i in range(len(self.numberTextArgs)):
-                    cv2.putText(self.dispImDraw, *self.numberTextArgs[i][:-1], self.numberTextArgs[i][-1] if not self.showRefinedZones.get() else (255,255,255), thickness=10)
-            self.base.displayCVImage(self.dispImDraw)
+            self.overlayIm = self.dispImDraw
         else:
-            self.base.displayCVImage(self.dispIm)
+            self.overlayIm = self.dispSmall
+        return self.overlayIm
 
 
-    #Draws contours onto the displayed image
-    def drawContours(self):
-        #Making a copy of the image so we don't lose the analysis steps when we draw
-        self.dispImDraw = self.dispIm.copy()
+    #Returns the displayed image drawn at the full size of the image, for snapshots
+    def fullSizeImage(self):
+        im = self.renderImage((self.im.shape[1], self.im.shape[0]))
+        self.updateImage()
+        return im
 
-        #If the user hasn't refined the zones, draw the contours
-        if len(self.refinedMasks)==0:
-            cv2.drawContours(self.dispImDraw, self.contours, -1, (255, 0, 255),thickness=3)
-            self.inContour = -1
 
-            #If the mouse is in the frame, check if it's in a contour
-            if self.inFrame.get():
-                for i in range(len(self.contours)):
-                    contour = self.contours[i]
-                    #The contours will be in order of size ascending, so the first contour the mouse is in
-                    #   will be the smallest
-                    if cv2.pointPolygonTest(contour, (self.mousex,self.mousey),False)>=0:
-                        self.inContour = i
-                        cv2.drawContours(self.dispImDraw, [self.contours[i]], -1, (0, 255,0), thickness=4)
-                        break
-
-            #If the user has clicked in a contour to select it, draw it in a different color
-            if self.selectedCont!=-1:
-                cv2.drawContours(self.dispImDraw, [self.contours[self.selectedCont]],
-                                 -1, (0, 255, 255), thickness=5)
-
-                #If we have found similar contours, draw them in a different color too
-                if len(self.closeInds)!=0:
-                    cv2.drawContours(self.dispImDraw, self.contours[self.closeInds],
-                                     -1, (255, 255, 0), thickness=4)
-                    #If the user has added contours, draw them in a slightly different color
-                    if len(self.addConts)!=0:
-                        cv2.drawContours(self.dispImDraw, self.contours[self.addConts],
-                                         -1, (255, 128, 0), thickness=4)
-                    if len(self.removeConts)!=0:
-                        cv2.drawContours(self.dispImDraw, self.contours[self.removeConts],
-                                         -1, (0, 0, 255), thickness=4)
-        #If the user has refined the zones, draw the refined zones
+    #Renders the base image at the display size and, if contours are drawn, the outlines of every contour
+    #   (or refined zone) on top of it
+    #   Both are kept until the display size, the analyzed image, the contours, the refined zones or the display
+    #   options change, so clicking and hovering don't redraw thousands of contours
+    def updateLayers(self, size):
+        key = (tuple(size), self.showWhat.get(), self.showRefinedZones.get(), self.drawConts.get())
+        sources = (self.analyzed, self.contours, self.refinedStamps, self.totalMaskedIm)
+        if key==self.layerKey and all(new is old for new, old in zip(sources, self.layerSources)):
+            return
+        self.layerKey, self.layerSources = key, sources
+
+        self.dispSize = tuple(size)
+        self.dispScale = (self.dispSize[0]/self.im.shape[1]+self.dispSize[1]/self.im.shape[0])/2
+
+        #Will show only the zones that are included in the mask
+        if self.showRefinedZones.get():
+            self.dispIm = self.totalMaskedIm
+        #If at least one analysis has been performed, must be converted to color from grayscale
+        elif self.showWhat.get()>0:
+            self.dispIm = cv2.cvtColor(self.analyzed, cv2.COLOR_GRAY2BGR)
+        #If no analyses have been performed the image is already color
+        else:
+            self.dispIm = self.im
+
+        #The full-resolution image is only resized here, not at every redraw
+        if self.dispSize==(self.dispIm.shape[1], self.dispIm.shape[0]):
+            self.dispSmall = self.dispIm
         else:
-            for i in range(len(self.refinedMasks)):
-                center = self.refinedCenters[i].astype(int)
-                drawShape(self.dispImDraw, self.zoneShape, center, self.refiner_data, (0,0,255), thickness=4)
+            self.dispSmall = cv2.resize(self.dispIm, self.dispSize)
+
+        #The contours in display coordinates, converted all at once
+        self.dispContours = []
+        if len(self.contours)>0:
+            outlines = self.contours.outlines()
+            self.dispContours = outlines.withPoints(self.displayCoords(outlines.points))
+
+        #The layers are never drawn on directly, only on copies of the contour layer
+        self.contourLayer = None
+        if self.drawConts.get():
+            self.contourLayer = self.dispSmall.copy()
+
+            #If the user hasn't refined the zones, draw the contours
+            if len(self.refinedStamps)==0:
+                cv2.drawContours(self.contourLayer, self.dispContours, -1, (255, 0, 255),thickness=self.displayThickness(3))
+            #If the user has refined the zones, draw the refined zones
+            else:
+                data = scaleShapeData(self.zoneShape, self.refiner_data, self.dispScale)
+                for i in range(len(self.refinedStamps)):
+                    center = self.displayCoords(self.refinedCenters[i].astype(int))
+                    pasteShape(self.contourLayer, self.zoneShape, center, data, (0,0,255), thickness=self.displayThickness(4))
+
+
+    #Draws the selected, similar, added and removed contours and the zone numbers onto a copy of the contour layer
+    #   These are all drawn over the mouse highlight, so the image before the numbers are drawn is kept as
+    #   self.markedIm, and the pixels of the contours drawn here are marked in self.markMask
+    def drawContours(self):
+        #Making a copy of the contour layer so we don't lose it when we draw
+        self.markedIm = self.contourLayer.copy()
+        self.markMask = np.zeros(self.markedIm.shape[:2], dtype=np.uint8)
+
+        #If the user has clicked in a contour to select it, draw it in a different color
+        if len(self.refinedStamps)==0 and self.selectedCont!=-1:
+            cv2.drawContours(self.markedIm, [self.dispContours[self.selectedCont]],
+                             -1, (0, 255, 255), thickness=self.displayThickness(5))
+            cv2.drawContours(self.markMask, [self.dispContours[self.selectedCont]], -1, 255, thickness=self.displayThickness(5))
+
+            #If we have found similar contours, draw them in a different color too
+            if len(self.closeInds)!=0:
+                cv2.drawContours(self.markedIm, self.dispContours[self.closeInds],
+                                 -1, (255, 255, 0), thickness=self.displayThickness(4))
+                #If the user has added contours, draw them in a slightly different color
+                if len(self.addConts)!=0:
+                    cv2.drawContours(self.markedIm, self.dispContours[self.addConts],
+                                     -1, (255, 128, 0), thickness=self.displayThickness(4))
+                if len(self.removeConts)!=0:
+                    cv2.drawContours(self.markedIm, self.dispContours[self.removeConts],
+                                     -1, (0, 0, 255), thickness=self.displayThickness(4))
+                cv2.drawContours(self.markMask, self.dispContours[np.union1d(self.closeInds, self.addConts).astype(int)],
+                                 -1, 255, thickness=self.displayThickness(4))
+
+        self.dispImDraw = self.markedIm.copy()
+        self.drawNumbers(self.dispImDraw)
+
+
+    #Draws the zone numbers onto the displayed image, or a region of it starting at offset
+    def drawNumbers(self, im, offset=(0,0)):
+        for i in range(len(self.numberTextArgs)):
+            text, org, font, fontsize, color = self.numberTextArgs[i]
+            org = self.displayCoords(org)+offset
+            cv2.putText(im, text, (int(org[0]), int(org[1])), font, fontsize*self.dispScale,
+                        color if not self.showRefinedZones.get() else (255,255,255), thickness=self.displayThickness(10))
+
+
+    #Displays the drawn image with the contour the mouse is in highlighted
+    #   Only the box around the contour is drawn again: the highlight goes onto the box of self.markedIm, under the
+    #   contours marked in self.markMask, then the numbers go on top and the box is pasted into the drawn image
+    #   The drawn image is put back once it has been displayed, so nothing else is ever redrawn
+    def showHover(self):
+        im = self.overlayIm
+        if not self.drawConts.get() or not self.inFrame.get() or self.inContour==-1 or len(self.refinedStamps)>0:
+            self.base.showImage(im)
+            return
+
+        contour = self.dispContours[self.inContour]
+        thickness = self.displayThickness(4)
+        x, y, w, h = cv2.boundingRect(contour)
+        #Padding the box by more than half the line thickness, so the whole highlight fits in it
+        x0, y0 = max(x-thickness, 0), max(y-thickness, 0)
+        x1, y1 = x+w+thickness, y+h+thickness
+
+        box = self.markedIm[y0:y1, x0:x1].copy()
+        cv2.drawContours(box, [contour], -1, (0, 255,0), thickness=thickness, offset=(-x0, -y0))
+        np.copyto(box, self.markedIm[y0:y1, x0:x1], where=self.markMask[y0:y1, x0:x1, None]>0)
+        self.drawNumbers(box, offset=(-x0, -y0))
+
+        underneath = im[y0:y1, x0:x1].copy()
+        im[y0:y1, x0:x1] = box
+        self.base.showImage(im)
+        im[y0:y1, x0:x1] = underneath
+
+
+    #Scales a line thickness in image pixels to the displayed image, keeping lines at least a pixel thick
+    def displayThickness(self, thickness):
+        return max(1, int(round(thickness*self.dispScale)))
+
+
+    #Converts pixel coordinates in the image to pixel coordinates in the displayed image (see convertCoords)
+    #   The pixel centers are scaled, as cv2.resize does
+    def displayCoords(self, points):
+        scale = np.array(self.dispSize)/np.array([self.im.shape[1], self.im.shape[0]])
+        return np.round((np.asarray(points)+0.5)*scale-0.5).astype(np.int32)
                 
 
             
 
 
-    #Applies a thresholding mask to the image based on the present state of the sliders
-    def cvMask(self, val=None):
+    #Reads the thresholds for the mask from the sliders
+    #Returns (value threshold, saturation threshold, mask mode)
+    def maskSettings(self):
 
         #Making sure the thresholds are integers between 0 and 255
         self.V_maskThresh1.set(np.clip(int(self.maskThresh1Slider.get()),0,255))
         self.V_maskThresh2.set(np.clip(int(self.maskThresh2Slider.get()),0,255))
-        
-        
-        smin = int(self.V_maskThresh2.get())
-        vmin = int(self.V_maskThresh1.get())
 
-        #Using the HSV colorspace to mask for saturation and value
-        hsvMin_s = np.array([0,smin,0])
-        hsvMin_v = np.array([0,0,vmin])
-        hsvMax = np.array([255,255,255])
-
-        #The default mode is to AND the masks
-        if self.V_maskMode.get()==0:
-            self.analyzed = cv2.inRange(self.imHSV, hsvMin_s+hsvMin_v, hsvMax)
-        
-        #There is an option to OR them instead (slightly slower)
-        elif self.V_maskMode.get()==1:
-            self.mask_s = cv2.inRange(self.imHSV, hsvMin_s, hsvMax)
-            self.mask_v = cv2.inRange(self.imHSV, hsvMin_v, hsvMax)
-            self.analyzed = np.array(np.logical_or(self.mask_s, self.mask_v)*255, dtype=np.uint8)
+        return self.V_maskThresh1.get(), self.V_maskThresh2.get(), self.V_maskMode.get()
 
 
 
-    #Applies a series of dilations and erosions to the mask depending on the code
-    #   Argument: code is a string of ['e','d'] of arbitrary length to indicate the
+    #Reads the series of dilations and erosions to apply to the mask
+    #   The code is a string of ['e','d'] of arbitrary length to indicate the
     #   order in which the user has pressed the Dilate and Erode buttons
-    def cvDilateErode(self, code=None):
-        self.dilateCounter.set(0)
-        self.erodeCounter.set(0)
+    def dileroSettings(self):
         dilerocode_text = self.V_dilerocode.get()
-        for i in range(len(dilerocode_text)):
-            code = dilerocode_text[i]
-            if code=='d':
-                self.analyzed = cv2.dilate(self.analyzed, (5,5))
-                self.dilateCounter.set(self.dilateCounter.get()+1)
-            if code=='e':
-                self.analyzed = cv2.erode(self.analyzed, (5,5))
-                self.erodeCounter.set(self.erodeCounter.get()+1)
-
-
-    #Applies a blurring filter to the mask based on the present state of the slider
-    def cvBlur(self, val=None):
+        self.dilateCounter.set(dilerocode_text.count('d'))
+        self.erodeCounter.set(dilerocode_text.count('e'))
+        return dilerocode_text
+
+
+    #Reads the amount to blur the mask by from the slider
+    def blurSettings(self):
         blur = np.clip(int(self.blurSlider.get()),0,10)
         self.V_blurAmount.set(blur)
-        self.analyzed = cv2.blur(self.analyzed, (blur, blur))
+        return blur
         
 
 
     #Detects contours in the mask
     def cvContour(self):
 
-        self.refinedMasks = []
+        #The contours are found in the latest analysis
+        self.scheduler.finish()
+
+        self.refinedStamps = []
 
         #If the image is in grayscale (only two coordinates, or third dimension is 1), find contours
         if len(self.analyzed.shape)==2 or self.analyzed.shape[-1]==1:
 
-            #Finds contours in the image
-            res = cv2.findContours(self.analyzed, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
+            #Finds contours in the image, sorted by size ascending
+            self.contours, self.sizes = findContours(self.analyzed, self.V_contourMode.get())
 
-            #Convert list of contours to an array
-            #The if statement is necessary because of stupid compatibility reasons
-            #(The return values of findContours changed between versions 3 and 4
-            if cv2.__version__.startswith('3'):
-                self.contours = np.array(res[1])
-            else:
-                self.contours = np.array(res[0])
+            #Measuring every contour once, so moving the tolerance sliders only compares arrays
+            self.features = contourFeatures(self.contours)
 
+            #Rasterizing the contours once so the contour under the mouse can be looked up directly
+            self.contourHits = contourHitIndex(self.contours, self.analyzed.shape[:2])
+            self.inContour = -1
                 
             #Initializing the index of the user-selected contour
             self.selectedCont = -1
 
-            #Initializing an array of sizes
-            self.sizes = np.zeros(len(self.contours))
-
             #Initializing a list of text parameters for later printing
             self.numberTextArgs = []
 
-            #Finding and storing the size of all the contours
-            for i in range(len(self.contours)):
-                c = self.contours[i]
-                self.sizes[i] = cv2.contourArea(c)
-                
-            #Sorting the contours by size ascending
-            self.bysize = np.argsort(self.sizes)
-            #We only want to consider the reasonably sized contours, so I arbitrarily picked the ones
-            #   with an area above 5 pixels --- this may cause problems.
-            self.bysize = self.bysize[self.sizes[self.bysize]>5] 
-            self.contours = self.contours[self.bysize]
-            self.sizes = self.sizes[self.bysize]
-
-
 
 
             #Disable the Find Similar Contours button
@@ -979,9 +1080,11 @@ class AnalysisWindow:
             #Disable the output options
             self.outputLabel.state(["disabled"])
             self.RGBCheck.state(["disabled"])
+            self.resultsOutputMenu.state(["disabled"])
             self.HSVCheck.state(["disabled"])
             self.LABCheck.state(["disabled"])
             self.histCheck.state(["disabled"])
+            self.histOutputMenu.state(["disabled"])
 
 
 
@@ -1010,17 +1113,41 @@ class AnalysisWindow:
     def trackMouse(self, event):
         newx, newy = self.convertCoords(event.x, event.y)
         self.mousex, self.mousey = newx, newy
-        self.updateImage()
+
+        #Only the highlight changes, and only when the mouse moves into a different contour
+        inContour = self.contourAt(newx, newy)
+        if inContour!=self.inContour:
+            self.inContour = inContour
+
+            #Drawing once the waiting mouse events have been handled, so a burst of motion is drawn once
+            if self.hoverCallback is None:
+                self.hoverCallback = self.window.after_idle(self.drawHover)
+
+
+    #Draws the highlight requested by trackMouse
+    def drawHover(self):
+        self.hoverCallback = None
+        self.showHover()
+
+
+    #Returns the index of the smallest contour containing the pixel (x, y), or -1 if there is none
+    def contourAt(self, x, y):
+        if self.contourHits is None or not (0<=x<self.contourHits.shape[1] and 0<=y<self.contourHits.shape[0]):
+            return -1
+        return int(self.contourHits[y, x])-1
 
     #Waits for a mouse click and sets the index of the selected contour
     def selectContour(self, event):
         
         newx, newy = self.convertCoords(event.x, event.y)
+        self.inContour = self.contourAt(newx, newy)
 
         if self.inContour!=-1:
-            #self.inContour is defined in updateImage when drawing the contours
             self.selectedCont = self.inContour
 
+            #Remembering the size of the reference so that presets can pick it again without a click
+            self.V_referenceArea.set(self.sizes[self.selectedCont])
+
             #Selecting a new reference contour resets the arrays of similar contours
             self.closeInds = []
             self.addConts = []
@@ -1050,9 +1177,11 @@ class AnalysisWindow:
             #Disable the output options
             self.outputLabel.state(["disabled"])
             self.RGBCheck.state(["disabled"])
+            self.resultsOutputMenu.state(["disabled"])
             self.HSVCheck.state(["disabled"])
             self.LABCheck.state(["disabled"])
             self.histCheck.state(["disabled"])
+            self.histOutputMenu.state(["disabled"])
 
 
 
@@ -1064,10 +1193,17 @@ class AnalysisWindow:
 
     #Waits for a shift-click and adds the contour that the mouse is in to the list of added contours
     def appendContour(self, event):
+        #Adding to the latest similar contours
+        self.scheduler.finish()
+
         newx, newy = self.convertCoords(event.x, event.y)
+        self.inContour = self.contourAt(newx, newy)
         #If the user shift-clicks before similar contours are found it redirects to normal click
         if len(self.closeInds)==0:
             self.selectContour(event)
+        #Shift-clicking outside every contour does nothing
+        elif self.inContour==-1:
+            return
         #If there is a list of similar contours this will add to them
         else:
             #If the contour hasn't been added yet add it
@@ -1100,14 +1236,15 @@ class AnalysisWindow:
 
         
     #Takes mouse coordinates in the frame and converts them to pixel coordinates in the image
+    #   (the inverse of displayCoords: gives the pixel of the image at the center of the displayed pixel)
     def convertCoords(self, x, y):
-        frameWidth, frameHeight = self.base.display.winfo_width(), self.base.display.winfo_height()
+        dispWidth, dispHeight = self.dispSize
         imWidth, imHeight = self.im.shape[1], self.im.shape[0]
 
-        Wratio = (imWidth-1)/(frameWidth-1)
-        Hratio = (imHeight-1)/(frameHeight-1)
+        Wratio = imWidth/dispWidth
+        Hratio = imHeight/dispHeight
 
-        return int(x*Wratio), int(y*Hratio)
+        return min(max(int((x+0.5)*Wratio), 0), imWidth-1), min(max(int((y+0.5)*Hratio), 0), imHeight-1)
 
 
     #Finds the contours that have a size and shape within a certain tolerance of the selected contour
@@ -1130,9 +1267,11 @@ class AnalysisWindow:
         #Enable the output options
         self.outputLabel.state(["!disabled"])
         self.RGBCheck.state(["!disabled"])
+        self.resultsOutputMenu.state(["!disabled"])
         self.HSVCheck.state(["!disabled"])
         self.LABCheck.state(["!disabled"])
         self.histCheck.state(["!disabled"])
+        self.histOutputMenu.state(["!disabled"])
 
 
         #Rounds the size tolerance (preset var) and makes sure it's between 0 and 100
@@ -1142,17 +1281,18 @@ class AnalysisWindow:
         self.V_shapeTol.set(np.round(np.clip(self.V_shapeTol.get(),0,2),3))
 
 
-        #First eliminates contours by size
-        self.closeInds = np.where(np.isclose(self.sizes, self.sizes[self.selectedCont], rtol=self.V_sizeTol.get()/100))[0]
+        #Eliminates contours by size, then by shape, in the background (see showSimilarContours)
+        contours, sizes, features, selectedCont = self.contours, self.sizes, self.features, self.selectedCont
+        sizeTol, shapeTol = self.V_sizeTol.get(), self.V_shapeTol.get()
+        self.scheduler.submit('similar', lambda: similarContours(contours, sizes, selectedCont, sizeTol, shapeTol, features),
+                              lambda closeInds: self.showSimilarContours(closeInds, contours, selectedCont))
 
 
-        #Finds the shape-match score for each contour compared to the reference
-        #   See https://docs.opencv.org/3.1.0/d3/dc0/group__imgproc__shape.html#gaadc90cb16e2362c9bd6e7363e6e4c317
-        #   for more information
-        shapeMatches = [cv2.matchShapes(self.contours[ind], self.contours[self.selectedCont], CV_CONTOURS_MATCH_I3, 0) for ind in self.closeInds]
-        shapeMatches = np.array(shapeMatches)
-        doesMatch = shapeMatches<self.V_shapeTol.get() #boolean array of where the shapes do match within tolerance
-        self.closeInds = self.closeInds[doesMatch]
+    #Displays the similar contours found by getSimilarContours, unless the contours or the selection have changed since
+    def showSimilarContours(self, closeInds, contours, selectedCont):
+        if contours is not self.contours or selectedCont!=self.selectedCont:
+            return
+        self.closeInds = closeInds
 
         #Resetting the removed contours because changing the thresholds could result in removing contours that aren't there
         self.removeConts = []
@@ -1170,57 +1310,12 @@ class AnalysisWindow:
         self.updateImage()
 
 
-    #Finds the center of each contour
-    def findCenters(self):
-
-        #Initializing lists of center coordinates and sizes
-        self.centers = np.zeros((len(self.closeIndsPlus),2))
-        self.closeSizes = np.zeros((len(self.closeIndsPlus)))
-
-        #A dictionary that will allow us to go from indices in the contour array to
-        #   indices in the centers array
-        self.indDict = {}
-
-        #Calculates center and size for the contours in the closeIndsPlus array
-        for i in range(len(self.closeIndsPlus)):
-            ind = int(self.closeIndsPlus[i])
-            cont = self.contours[ind]
-
-            self.indDict[ind] = i
-
-            #Computing moments of the contour
-            M = cv2.moments(cont)
-
-            #Central moments are given by M_10/M_00 and M_01/M_00,
-            #   where M_ij = sum(x^i y^j I(x,y)) over the whole image,
-            #   where I is either 1 or 0
-            #   Finds the centroid of the image
-            self.centers[i] = np.array([int(M['m10']/M['m00']),int(M['m01']/M['m00'])]) #x,y
-
-            #For reference: M_00 is sum(I(x,y)) 
-            self.closeSizes[i] = M['m00'] #0,0th moment is the sum of the pixels in the image
-
-
-
-    #Returns the average color and standard deviation of an image,
-    #   if a mask is given returns the average color of the masked area
-    def getAvColor(self, im, mask=None):
-        if mask is not None:
-            mask3D = np.concatenate(([mask],[mask],[mask])).transpose((1,2,0))/255 #triplicating the mask values for RGB etc.
-            immasked = np.ma.MaskedArray(im, mask=1-mask3D)
-            avcolor = np.ma.mean(immasked, axis=(0,1))
-            std = np.ma.std(immasked, axis=(0,1)) #standard deviation
-
-        else:
-            avcolor = np.average(np.average(im, axis=0), axis=0)
-            std = np.std(im, axis=(0,1))
-            
-        return avcolor, std
-
-
     #Creates a zone refinement dialog and sets refined zones based on user input
     #Triggered by Refine Zones button
     def refineZones(self):
+        #The zones are refined around the latest similar contours
+        self.scheduler.finish()
+
         #Finding the boundaries of the selected contour (the one to be used as a reference for zone refinement
         x, y, w, h = cv2.boundingRect(self.contours[self.selectedCont])
 
@@ -1233,43 +1328,34 @@ class AnalysisWindow:
 
 
         
+        #The centers of all the selected zones, in the order the analysis will number them (by row then column),
+        #   so the refiner can preview the color of every zone
+        zoneCenters = self.centers[np.lexsort((self.centers[:,0], self.centers[:,1]))].astype(int)
+
         #Setting up the tk window for the refinement interface
         self.refinerWindow = tk.Toplevel(master=self.window)
 
         #Creating and running a ZoneRefiner object (see class definition)
-        self.refiner = ZoneRefiner(self.refinerWindow, zoneCrop, center)
+        self.refiner = ZoneRefiner(self.refinerWindow, zoneCrop, center, self.im, zoneCenters)
 
         #The program will wait until the user closes the refiner window
         self.window.wait_window(self.refinerWindow)
 
 
-        #Extracting the information from the refiner object
-        self.zoneShape, self.displace_x, self.displace_y, self.refiner_data = self.refiner.getParams()
-
-
-        #Initializing variables to store masks and new zone centers
-        self.refinedMasks = np.zeros((len(self.centers),*self.im.shape[:2]), dtype=np.uint8)
-        self.refinedCenters = np.zeros_like(self.centers)
-        mask = np.zeros(self.im.shape[:2], dtype=np.uint8)
+        #Extracting the information from the refiner object and making the refined zone masks
+        refinerParams = self.refiner.getParams()
+        self.setRefinedZones(*refinerParams)
 
-        #Applying the displacement to contour centers and making a set of masks for each refined zone
-        for i in range(len(self.centers)):
-            mask_i = np.zeros(self.im.shape[:2], dtype=np.uint8)
-            self.refinedCenters[i] = self.centers[i]+np.array([self.displace_x, -self.displace_y])
+        #The image masked to the refined zones, for the Show Masks view
+        self.totalMaskedIm = cv2.bitwise_and(self.im, self.im, mask=self.totalMask)
 
-            #Making a total mask for display purposes
-            drawShape(mask, self.zoneShape, self.refinedCenters[i].astype(int), self.refiner_data, color=255, thickness=-1)
-
-            #Making individual masks for each contour for analysis
-            drawShape(mask_i, self.zoneShape, self.refinedCenters[i].astype(int), self.refiner_data, color=255, thickness=-1)
-            self.refinedMasks[i] = mask_i[:,:]
+        #Storing the refinement in the preset variables so it can be saved
+        for name, value in refinementPreset(*refinerParams).items():
+            getattr(self, name).set(value)
 
         #Enabling the Show Masks check button
         self.refineMaskShowCheck.state(['!disabled'])
 
-        self.totalMaskedIm = cv2.bitwise_and(self.im, self.im, mask=mask)
-        self.totalMask = mask
-
         #Will now draw the refined zones on the image
         self.updateImage()
 
@@ -1278,319 +1364,33 @@ class AnalysisWindow:
     #Final contour analysis
     #Triggered by Analysis button
     def analyzeContours(self):
-        print("ANALYZING")
-
-        #Initializing arrays to store the zone color information
-        self.avcolorsRGB = np.zeros((len(self.closeIndsPlus), 3))
-        self.avcolorsHSV = np.zeros((len(self.closeIndsPlus), 3))
-        self.avcolorsLAB = np.zeros((len(self.closeIndsPlus), 3))
-        self.stdsRGB = np.zeros((len(self.closeIndsPlus), 3))
-        self.stdsHSV = np.zeros((len(self.closeIndsPlus), 3))
-        self.stdsLAB = np.zeros((len(self.closeIndsPlus), 3))
-        self.maskAreas = np.zeros(len(self.closeIndsPlus))
-
-        #Array to store position, size, etc. for text to place on image
-        self.numberTextArgs = np.zeros(len(self.closeIndsPlus), dtype=object)
-
-
-        #Making a unique folder name for this analysis output
-        analysisPath = os.path.splitext(self.base.filePath)[0]+'_analysis'
-        foldernum = 0
-        self.analysisPathNum = analysisPath
-        while os.path.exists(self.analysisPathNum):
-            foldernum+=1
-            self.analysisPathNum = analysisPath+'_'+str(foldernum)
-        os.makedirs(self.analysisPathNum)
-        
-        
-        #Various aesthetic properties will be decided by the size of the largest contour
-        #   Note: this will behave poorly when the analyzed contours are of very different sizes
-        largestContInd = self.closeIndsPlus[np.argmax(self.closeSizes)]
-        largest_x, largest_y, largest_w, largest_h = cv2.boundingRect(self.contours[largestContInd])
-
-
-        #Sorting indices first by row then by column
-        sort_inds = np.lexsort((self.centers[:,0],self.centers[:,1]))
-
-        #Sorting the arrays
-        self.closeIndsPlus = self.closeIndsPlus[sort_inds]
-        self.centers = self.centers[sort_inds]
-
-        #If the user has refined the zones, sorting those arrays too
-        if len(self.refinedMasks)!=0:
-            self.refinedMasks = self.refinedMasks[sort_inds]
-            self.refinedCenters = self.refinedCenters[sort_inds]
-
-
-        #Looping through all the close contours to analyze them
-        for i in range(len(self.closeIndsPlus)):
-            
-            ind = self.closeIndsPlus[i]
-            cont = self.contours[ind]
-
-            cont_x, cont_y, cont_w, cont_h = cv2.boundingRect(cont)
-
-
-            #If there are no refined masks (the user has not refined zones)
-            #   then use contours
-            if len(self.refinedMasks)==0:
-                x, y, w, h = cont_x, cont_y, cont_w, cont_h
-                contMask = np.zeros((self.im.shape[0],self.im.shape[1]), dtype=np.uint8)
-                cv2.drawContours(contMask, [cont], -1, 255, thickness=-1)
-                center = self.centers[i]
-
-                self.totalMask = np.bitwise_or(contMask,self.totalMask)
-
-            #If the user has refined zones, use the refined zones
-            else:
-                contMask = self.refinedMasks[i]
-                center = self.refinedCenters[i]
-                x = int(center[0]-self.refiner_data[-1][0])
-                y = int(center[1]-self.refiner_data[-1][-1])
-                w = self.refiner_data[-1][0]*2+1
-                h = self.refiner_data[-1][-1]*2+1
-                
-
-
-            #Getting average color of the zone and standard deviation
-            avcolorRGB, stdRGB = self.getAvColor(self.im[y:y+h,x:x+w], contMask[y:y+h,x:x+w])
-            avcolorRGB = avcolorRGB[::-1]#reversing because opencv uses BGR
-            stdRGB = stdRGB[::-1]#ditto
-
-            #Doing the same in the other color spaces
-            avcolorHSV, stdHSV = self.getAvColor(self.imHSV[y:y+h,x:x+w], contMask[y:y+h,x:x+w])
-            avcolorLAB, stdLAB = self.getAvColor(self.imLAB[y:y+h,x:x+w], contMask[y:y+h,x:x+w])
-
-            #Sticking them in the list
-            self.avcolorsRGB[i, :] = avcolorRGB
-            self.avcolorsHSV[i, :] = avcolorHSV
-            self.avcolorsLAB[i, :] = avcolorLAB
-            self.stdsRGB[i, :] = stdRGB
-            self.stdsHSV[i, :] = stdHSV
-            self.stdsLAB[i, :] = stdLAB
-
-            #Getting the area of the masked region
-            self.maskAreas[i] = np.sum(contMask[y:y+h,x:x+w])/255
-
-            #Finding a referencee text size for scaling
-            t_size, baseline = cv2.getTextSize(str(i+1), cv2.FONT_HERSHEY_SIMPLEX, 1, 10)
-
-            #Scaling by the size of the largest contour
-            #TODO: Find a better way to scale the text!!
-            fontsize = min(int(np.round(largest_w/t_size[0])),int(np.round(largest_h/t_size[1])))
-            
-            #Setting the position of the number to the top right of the contour
-            textcent = (int(center[0]+w//2), int(center[1]-h//2))
-            color = [0,255,0]
-                
-            self.numberTextArgs[i]=(str(i+1), textcent, cv2.FONT_HERSHEY_SIMPLEX, fontsize, color)
-            
-
-
-            print(f'Spot {i+1} analyzed')
-
-
-            #If the user has elected to save the histograms (slow!)
-            if self.V_saveHistograms.get():
-                histspath = self.analysisPathNum+'/histograms'
-                if not os.path.exists(histspath):
-                    os.makedirs(histspath)
-                self.saveHistogram(self.im[y:y+h,x:x+w], contMask[y:y+h,x:x+w], path=histspath+'/'+self.base.filename+'_histogram_'+str(i+1))
-
-            #Saves an image cropped to the current zone
-            if self.saveCrops:
-                cropspath = self.analysisPathNum+'/crops'
-                if not os.path.exists(cropspath):
-                    os.makedirs(cropspath)
-                    os.makedirs(cropspath+'/drawn')
+        #Analyzing the latest similar contours, once the outputs of the last analysis are saved
+        self.scheduler.finish()
+        if self.outputsThread is not None:
+            self.outputsThread.join()
 
-                #Takes a slice of the image from the top-left corner of the zone
-                #   with the dimensions of the largest of the close contours (for consistent crop sizes)    
-                crop_im = self.im[cont_y-self.saveBorder:cont_y+largest_h+self.saveBorder,\
-                                  cont_x-self.saveBorder:cont_x+largest_w+self.saveBorder]
-
-                #A copy of the original image to draw just the contour on
-                crop_im_draw = self.im.copy()
-
-                #Drawing either the contour or the refined zone shape
-                if len(self.refinedMasks)==0:
-                    cv2.drawContours(crop_im_draw, [cont], -1, (255,255,0), 1)
-                else:
-                    drawShape(crop_im_draw, self.zoneShape, self.refinedCenters[i], self.refiner_data, (0,0,255),1)
-
-                #Cropping that result down (we do it in this order so we don't have to transform any coordinates)
-                crop_im_draw = crop_im_draw[cont_y-self.saveBorder:cont_y+largest_h+self.saveBorder,\
-                              cont_x-self.saveBorder:cont_x+largest_w+self.saveBorder]
-
-                #Saving the resulting images               
-                cv2.imwrite(cropspath+'/'+self.base.filename+'_crop_'+str(i+1)+'.jpg', crop_im)
-                cv2.imwrite(cropspath+'/drawn/'+self.base.filename+'_crop_draw_'+str(i+1)+'.jpg', crop_im_draw)
+        ColorAnalysis.analyzeContours(self)
 
         #Draws the numbers on the screen
         self.updateImage()
 
-        #Saves the average colors to a csv file
-        self.saveColors()
-
-        #Saves the numbered image and the mask for reference
-        self.saveIm()
-
-            
-    #Saving the average colors to a csv file
-    def saveColors(self):
-
-        #Making a column of numbers in ascending order to match numbers drawn on image
-        labelcol = np.arange(len(self.closeIndsPlus))+1
-
-        #A blank column which will be used to space colorspaces
-        spacer = np.array([['']*len(labelcol)]).T
-
-        #Initializing the array to be filled with the colors
-        #   (We will append columns each time)
-        full = np.array([labelcol]).T
-
-        #Can't be capitalized -- Excel interprets that weirdly
-        header = 'id'
-
-        #If the user has elected to save RGB colors 
-        if self.V_saveRGB.get():
-            rgb = self.avcolorsRGB
-            std_rgb = self.stdsRGB
-            header+=',R,G,B,std R,std G,std B,'
-            rgb_s = rgb.astype(str)
-            std_rgb_s = std_rgb.astype(str)
-            full = np.concatenate((full, rgb_s, std_rgb_s, spacer), axis=1)
-
-        #The program will always output at least the grayscale
-        #Grayscale values calculated as a weighted average of RGB
-        grayscale = np.dot(rgb, RGB2grayscale_weights)
-        std_grayscale = np.sqrt(np.dot(std_rgb**2, RGB2grayscale_weights**2)) #sqrt of sum of squares for proper propagation of error
-        grayscale_s = np.array([grayscale.astype(str)]).T
-        std_grayscale_s = np.array([std_grayscale.astype(str)]).T
-        header+=',Gray,std Gray,'
-        full = np.concatenate((full, grayscale_s, std_grayscale_s, spacer), axis=1)
-
-
-        #If the user has elected to save HSV colors
-        if self.V_saveHSV.get():
-            hsv = self.avcolorsHSV
-            hsv[:,0] = hsv[:,0]/180*360
-            hsv[:,1:] = np.round(hsv[:,1:]/255, 8)
-            std_hsv = self.stdsHSV
-            std_hsv[:,0] = std_hsv[:,0]/180*360
-            std_hsv[:,1:] = np.round(std_hsv[:,1:]/255, 8)
-            header+=',H,S,V,std H,std S,std V,'
-            hsv_s = hsv.astype(str)
-            std_hsv_s = std_hsv.astype(str)
-            full = np.concatenate((full, hsv_s, std_hsv_s, spacer), axis=1)
-
-        #If the user has elected to save Lab colors
-        if self.V_saveLAB.get():
-            lab = self.avcolorsLAB
-            lab[:,0] = np.round(lab[:,0]/255*100, 8)
-            lab[:,1:] = lab[:,1:]-128
-            std_lab = self.stdsLAB
-            std_lab[:,0] = np.round(std_lab[:,0]/255*100, 8)
-            header+=',L,a,b,std L,std a,std b,'
-            lab_s = lab.astype(str)
-            std_lab_s = std_lab.astype(str)
-            full = np.concatenate((full, lab_s, std_lab_s, spacer), axis=1)
-
-
-        #The program will always output the contour areas (or refined zone areas)
-        area_s = np.array([self.maskAreas.astype(str)]).T
-        full = np.concatenate((full, area_s), axis=1)
-        header+=',Area [pixels]'
-
-        #Saving the full output in a csv format
-        np.savetxt(self.analysisPathNum+'/'+self.base.filename+"_colors.csv", full, delimiter=',', header = header, fmt='%s', comments='')
-
-
-    #Saving the image with numbers drawn on
-    def saveIm(self):
-        #copying the image so we don't edit the original
-        imcopy = self.im.copy()
-
-        #Drawing the numbers on
-        for i in range(len(self.numberTextArgs)):
-            cv2.putText(imcopy, *self.numberTextArgs[i], thickness=10)
-
-        #If the user has refined the zones, draw the zones
-        if len(self.refinedMasks)!=0:
-            for i in range(len(self.refinedMasks)):
-                center = self.refinedCenters[i].astype(int)
-                drawShape(imcopy, self.zoneShape, center, self.refiner_data, color=(0,0,255), thickness=4)
-        #Otherwise, draw the contours
-        else:
-            cv2.drawContours(imcopy, self.contours[self.closeIndsPlus], -1, (255,255,0), 4)
-
-        #Save the labeled image and the mask
-        cv2.imwrite(self.analysisPathNum+'/'+self.base.filename+"_labeled"+self.base.ext, imcopy)
-        cv2.imwrite(self.analysisPathNum+'/'+self.base.filename+"_mask"+self.base.ext, self.totalMask)
-                
-
-    #Saving a histogram for an image
-    #Triggered by the Analyze button if the user has elected to save the histograms
-    def saveHistogram(self, im, mask, path):
-
-        #Computing the histograms for each channel
-        Bheights, edges = imageChannelHistogram(im[:,:,0], mask)
-        Gheights, edges = imageChannelHistogram(im[:,:,1], mask)
-        Rheights, edges = imageChannelHistogram(im[:,:,2], mask)
-
-        #Converting the result to strings for saving as a csv
-        edges_str = edges.astype(int).astype(str)[:-1]
-        Bheights_str = Bheights.astype(int).astype(str)
-        Gheights_str = Gheights.astype(int).astype(str)
-        Rheights_str = Rheights.astype(int).astype(str)
-
-        #Sticking them together
-        combo = np.concatenate(([edges_str], [Rheights_str], [Gheights_str], [Bheights_str]), axis=0).T
-
-        #Saving the csv file
-        np.savetxt(path+'.csv', combo, fmt='%s', header='bin, Red Channel, Green Channel, Blue Channel', delimiter=',', comments='')
-
-        ###Also saving plots of the histograms for immediate inspection###
-
-        #Average of successive edges will be the centers of the bins
-        centers = (edges[:-1] + edges[1:]) / 2
-
 
-        #Setup for histogram plotting
-        histoFig = plt.figure()
-        histoAxis = histoFig.add_subplot(111)
-
-        histoAxis.set_facecolor('xkcd:grey')
-        histoAxis.set_xlim([0,256])
-        histoAxis.set_xticks(np.linspace(0,256,9))
-        histoAxis.set_xlabel("Intensity")
-        histoAxis.set_ylabel("Counts")
-        histoAxis.set_title(f"Zone {path.split('_')[-1]} Histogram")
-
-
-        #Plots the histograms
-        histoPlotBlue = histoAxis.bar(centers, Bheights, align='center', color='blue', width=edges[1] - edges[0], alpha=0.6)
-        histoPlotGreen = histoAxis.bar(centers, Gheights, align='center', color='green', width=edges[1] - edges[0], alpha=0.6)
-        histoPlotRed = histoAxis.bar(centers, Rheights, align='center', color='red', width=edges[1] - edges[0], alpha=0.6)
-
-        #Uncomment for Photoshop-style color-mixing intersections in the saved histograms
-##        histoPlotCyan = histoAxis.bar(centers, np.min([Bheights, Gheights],axis=0), align='center', color='cyan', width=edges[1] - edges[0], alpha=1)
-##        histoPlotMagenta = histoAxis.bar(centers, np.min([Bheights, Rheights],axis=0), align='center', color='magenta', width=edges[1] - edges[0], alpha=1)
-##        histoPlotYellow = histoAxis.bar(centers, np.min([Rheights, Gheights],axis=0), align='center', color='yellow', width=edges[1] - edges[0], alpha=1)
-##
-##        histoPlotWhite = histoAxis.bar(centers, np.min([Bheights, Gheights, Rheights],axis=0), align='center', color='white', width=edges[1] - edges[0], alpha=1)
-
-        #Saving the figures
-        histoFig.savefig(path+'.png')
-##        plt.close()
+    #Waits for the outputs of the analysis to be saved in a thread of its own, so the window stays responsive meanwhile
+    #   This isn't left to the scheduler, which drops requests that are replaced or still waiting when the window closes,
+    #   and the thread isn't a daemon, so the files are still flushed to disk if the program exits meanwhile
+    #   (the next analysis waits for them)
+    def finishOutputs(self, writer, plotter):
+        self.outputsThread = threading.Thread(target=ColorAnalysis.finishOutputs, args=(self, writer, plotter))
+        self.outputsThread.start()
 
 
 
 #Object: ZoneRefiner
 #Purpose: Interface for refining the zone shape, size, and position
+#   If the full image and the centers of all the zones are given, the colors of every zone are previewed too
 class ZoneRefiner:
 
-    def __init__(self, window, im, center):
+    def __init__(self, window, im, center, zoneIm=None, zoneCenters=None):
 
         self.window = window
         window.title("Refine Zone")
@@ -1608,6 +1408,13 @@ class ZoneRefiner:
         #Making sure the center is an integer value for drawing
         self.center = center.astype(int)
 
+        #The image and zone centers for the zone color preview
+        self.zoneIm = zoneIm
+        self.zoneCenters = zoneCenters
+
+        #The after_idle callback that will update the zone color preview, if one is waiting
+        self.zoneStatsCallback = None
+
 
 
         ####Histogram####
@@ -1640,19 +1447,20 @@ class ZoneRefiner:
 
         #Getting the heights and edges of the histogram
         #   (Filled with blank data initially)
-        self.blankHeights, edges = imageChannelHistogram(-1*np.ones((1,1,1)))
-        self.centers = (edges[:-1] + edges[1:]) / 2
+        blankHeights, edges = imageHistograms(np.zeros((0,1,1), dtype=np.uint8))
+        self.blankHeights = blankHeights[0]
 
         #Initializing plots with blank histograms
-        self.histoPlotBlue = self.histoAxis.bar(self.centers, self.blankHeights, align='center', color='blue', width=edges[1] - edges[0], alpha=0.6)
-        self.histoPlotGreen = self.histoAxis.bar(self.centers, self.blankHeights, align='center', color='green', width=edges[1] - edges[0], alpha=0.6)
-        self.histoPlotRed = self.histoAxis.bar(self.centers, self.blankHeights, align='center', color='red', width=edges[1] - edges[0], alpha=0.6)
+        #   Each histogram is a single step patch, so an update replaces one artist's heights instead of 256 bars
+        self.histoPlotBlue = self.histoAxis.stairs(self.blankHeights, edges, fill=True, color='blue', alpha=0.6)
+        self.histoPlotGreen = self.histoAxis.stairs(self.blankHeights, edges, fill=True, color='green', alpha=0.6)
+        self.histoPlotRed = self.histoAxis.stairs(self.blankHeights, edges, fill=True, color='red', alpha=0.6)
 
-        self.histoPlotCyan = self.histoAxis.bar(self.centers, self.blankHeights, align='center', color='cyan', width=edges[1] - edges[0], alpha=1)
-        self.histoPlotMagenta = self.histoAxis.bar(self.centers, self.blankHeights, align='center', color='magenta', width=edges[1] - edges[0], alpha=1)
-        self.histoPlotYellow = self.histoAxis.bar(self.centers, self.blankHeights, align='center', color='yellow', width=edges[1] - edges[0], alpha=1)
+        self.histoPlotCyan = self.histoAxis.stairs(self.blankHeights, edges, fill=True, color='cyan', alpha=1)
+        self.histoPlotMagenta = self.histoAxis.stairs(self.blankHeights, edges, fill=True, color='magenta', alpha=1)
+        self.histoPlotYellow = self.histoAxis.stairs(self.blankHeights, edges, fill=True, color='yellow', alpha=1)
 
-        self.histoPlotWhite = self.histoAxis.bar(self.centers, self.blankHeights, align='center', color='white', width=edges[1] - edges[0], alpha=1)
+        self.histoPlotWhite = self.histoAxis.stairs(self.blankHeights, edges, fill=True, color='white', alpha=1)
 
 
 
@@ -1899,6 +1707,43 @@ class ZoneRefiner:
         ###Next Row###
 
 
+        #Table previewing the average color and standard deviation of every zone with the current shape
+        self.zoneTable = None
+        if self.zoneCenters is not None:
+            self.zoneTableLabel = ttk.Label(self.menu, text="Zone colors (mean ± std):")
+            self.zoneTableLabel.grid(row=row, column=0, columnspan=3, sticky='w')
+
+            row+=1
+            ###Next Row###
+
+            self.zoneTable = ttk.Treeview(self.menu, columns=('R', 'G', 'B'), height=8)
+            self.zoneTable.heading('#0', text='Zone')
+            self.zoneTable.column('#0', width=50, stretch=False)
+            for channel in ('R', 'G', 'B'):
+                self.zoneTable.heading(channel, text=channel)
+                self.zoneTable.column(channel, width=90, anchor='center')
+            self.zoneTable.grid(row=row, column=0, columnspan=3, sticky='nesw')
+
+            self.zoneTableScroll = ttk.Scrollbar(self.menu, orient=tk.VERTICAL, command=self.zoneTable.yview)
+            self.zoneTableScroll.grid(row=row, column=3, sticky='ns')
+            self.zoneTable.configure(yscrollcommand=self.zoneTableScroll.set)
+
+            #One row per zone, numbered like the analysis output, filled in by updateZoneStats
+            for i in range(len(self.zoneCenters)):
+                self.zoneTable.insert('', 'end', iid=str(i), text=str(i+1))
+
+            row+=1
+            ###Next Row###
+
+            #How much the average colors vary between the zones
+            self.zoneSpread = tk.StringVar(self.window, value="")
+            self.zoneSpreadLabel = ttk.Label(self.menu, textvariable=self.zoneSpread)
+            self.zoneSpreadLabel.grid(row=row, column=0, columnspan=3, sticky='w')
+
+            row+=1
+            ###Next Row###
+
+
         spacer = ttk.Label(master=self.menu, text="")
         spacer.grid(row=row)
 
@@ -2056,58 +1901,37 @@ class ZoneRefiner:
         plotGreen = self.plotHistoGreen.get()
         plotRed = self.plotHistoRed.get()
 
-        #Only computing histograms for the channels that are requested
-        if plotBlue:
-            Bheights, edges = imageChannelHistogram(self.im[:,:,0], self.mask)
-        else:
-            Bheights = self.blankHeights
-        if plotGreen:
-            Gheights, edges = imageChannelHistogram(self.im[:,:,1], self.mask)
-        else:
-            Gheights = self.blankHeights
-        if plotRed:
-            Rheights, edges = imageChannelHistogram(self.im[:,:,2], self.mask)
-        else:
-            Rheights = self.blankHeights
-
-        plotIntersections = self.plotHistoIntersection.get()
-
-        #The only way to update a matplotlib bar chart without making a whole new one
-        #   is to loop through each bar and modify it
-        for i in range(len(self.centers)):
-
-            #Setting the heights for the RGB plots
-            self.histoPlotBlue[i].set_height(Bheights[i])
-            self.histoPlotGreen[i].set_height(Gheights[i])
-            self.histoPlotRed[i].set_height(Rheights[i])
-
-            #If the user has elected to show the intersections, show them
-            if plotIntersections:
-                self.histoPlotCyan[i].set_height(np.min([Bheights[i],Gheights[i]]))
-                self.histoPlotMagenta[i].set_height(np.min([Bheights[i],Rheights[i]]))
-                self.histoPlotYellow[i].set_height(np.min([Rheights[i],Gheights[i]]))
-
-                self.histoPlotWhite[i].set_height(np.min([Bheights[i],Gheights[i],Rheights[i]]))
-
-            #Otherwise, give them blank histograms
-            else:
-                self.histoPlotCyan[i].set_height(self.blankHeights[i])
-                self.histoPlotMagenta[i].set_height(self.blankHeights[i])
-                self.histoPlotYellow[i].set_height(self.blankHeights[i])
+        #Computing the histograms of all the channels in one pass (in BGR order), showing only the requested ones
+        heights, edges = imageHistograms(self.im, self.mask)
+        Bheights = heights[0] if plotBlue else self.blankHeights
+        Gheights = heights[1] if plotGreen else self.blankHeights
+        Rheights = heights[2] if plotRed else self.blankHeights
 
-                self.histoPlotWhite[i].set_height(self.blankHeights[i])
+        #If the user has elected to show the intersections, show them
+        if self.plotHistoIntersection.get():
+            Cheights = np.minimum(Bheights, Gheights)
+            Mheights = np.minimum(Bheights, Rheights)
+            Yheights = np.minimum(Rheights, Gheights)
+            Wheights = np.minimum(Cheights, Rheights)
 
+        #Otherwise, give them blank histograms
+        else:
+            Cheights = Mheights = Yheights = Wheights = self.blankHeights
 
+        self.histoPlotBlue.set_data(Bheights)
+        self.histoPlotGreen.set_data(Gheights)
+        self.histoPlotRed.set_data(Rheights)
+        self.histoPlotCyan.set_data(Cheights)
+        self.histoPlotMagenta.set_data(Mheights)
+        self.histoPlotYellow.set_data(Yheights)
+        self.histoPlotWhite.set_data(Wheights)
 
-        #Rescale to match new max height
-        self.histoAxis.set_ylim([0,np.max([Bheights, Gheights, Rheights])])
 
-        #Redraw the figure
-        self.histoFig.canvas.draw()
-        self.histoFig.canvas.flush_events()
+        #Rescale to match new max height (an empty zone keeps a height of 1 so the limits stay valid)
+        self.histoAxis.set_ylim([0,max(np.max([Bheights, Gheights, Rheights]), 1)])
 
-        #This pause is required to keep it from breaking
-        plt.pause(0.000000000001)
+        #Redraw the figure once tk is idle, so a burst of slider ticks is only drawn once
+        self.histoCanvas.draw_idle()
         
 
     #Displays the zone on the image
@@ -2137,9 +1961,6 @@ class ZoneRefiner:
         #Shifting the center of the shape by the displacement
         centershift = self.center+np.array([self.displace_x.get(), -self.displace_y.get()])
 
-        #Initializing a mask to be drawn on
-        self.mask = np.zeros(self.imDraw.shape[:2], dtype=np.uint8)
-
         #Encapsulating the information into a shape data array
         if shape=='polygon':
             self.data = [self.nsides.get(), poly_angle_rad, [self.radius.get()]]
@@ -2148,15 +1969,17 @@ class ZoneRefiner:
         elif shape=='rectangle':
             self.data = [[self.rectangle_width.get(), self.rectangle_height.get()]]    
                                   
-        #Draws the shape onto the mask
-        drawShape(self.mask, self.zoneShape.get(), centershift, self.data, color=255, thickness=-1)
+        #Placing the shape's stamp (rasterized once per shape, see cachedShapeStamp) into a mask
+        x, y, stamp = shapeStamp(shape, centershift, self.data, self.im.shape)
+        self.mask = np.zeros(self.imDraw.shape[:2], dtype=np.uint8)
+        self.mask[y:y+stamp.shape[0], x:x+stamp.shape[1]] = stamp
 
-        #Computing the area by summing over the mask
-        self.area.set(np.sum(self.mask)//255)
+        #The area is the number of pixels in the zone
+        self.area.set(np.count_nonzero(stamp))
 
         #If we aren't looking at the masked zone, draw on the image
         if not self.maskZone.get():
-            drawShape(self.imDraw, self.zoneShape.get(), centershift, self.data, color=(128,0,128), thickness=1)
+            pasteShape(self.imDraw, shape, centershift, self.data, color=(128,0,128), thickness=1)
 
         #Otherwise, mask the image with the shape
         else:
@@ -2169,6 +1992,30 @@ class ZoneRefiner:
         #Update the displayed image
         self.displayCVImage(self.imDraw)
 
+        #Updating the zone colors once the waiting slider events have been handled, so a drag is previewed
+        #   at the latest shape rather than at every tick
+        if self.zoneTable is not None and self.zoneStatsCallback is None:
+            self.zoneStatsCallback = self.window.after_idle(self.updateZoneStats)
+
+
+    #Fills the zone color table with the colors of every zone with the current shape
+    #   Every zone is the same stamp, so its pixels are gathered straight from the image (see stampStatistics)
+    def updateZoneStats(self):
+        self.zoneStatsCallback = None
+
+        centers = self.zoneCenters+np.array([self.displace_x.get(), -self.displace_y.get()])
+        counts, means, stds = stampStatistics(cachedShapeStamp(self.zoneShape.get(), self.data, -1), centers, [self.zoneIm])
+
+        #Reversing RGB because opencv uses BGR
+        means, stds = means[:, ::-1], stds[:, ::-1]
+
+        for i in range(len(centers)):
+            self.zoneTable.item(str(i), values=[f"{mean:.1f} ± {std:.1f}" for mean, std in zip(means[i], stds[i])])
+
+        #Standard deviation of the zones' average colors
+        spread = np.std(means, axis=0)
+        self.zoneSpread.set("Spread between zones: R {:.1f}, G {:.1f}, B {:.1f}".format(*spread))
+
     #Returns the refiner parameters
     def getParams(self):
         return self.zoneShape.get(), self.displace_x.get(), self.displace_y.get(), self.data
@@ -2234,12 +2081,14 @@ class ColorGUI:
 
         #Checkbutton to maintain the original aspect ratio of the image when resizing
         self.fixAspect = tk.BooleanVar(value=True)
-        self.aspectCheck = ttk.Checkbutton(self.menu, text="Fix Aspect Ratio", variable=self.fixAspect, onvalue=True, command=self.displayCVImage)
+        self.aspectCheck = ttk.Checkbutton(self.menu, text="Fix Aspect Ratio", variable=self.fixAspect, onvalue=True, command=self.redisplay)
         self.aspectCheck.grid(row=row, column=0, sticky='we')
 
 
         #When analysis pane is None it indicates that the user has not started analysis yet
         self.analysisPane = None
+        #The open Analysis window, which draws the displayed image itself (see redisplay)
+        self.overlay = None
 
         #Setting up the display for the image
         self.display = ttk.Label(self.frame, text="No Image Selected")
@@ -2259,7 +2108,7 @@ class ColorGUI:
         self.snapshots = tk.IntVar(master=self.window, value=0)
         self.window.bind("s", lambda event: \
             [cv2.imwrite(os.path.splitext(self.filePath)[0]+"_snapshot_"+\
-                         str(self.snapshots.get())+self.ext,self.dispIm),\
+                         str(self.snapshots.get())+self.ext,self.snapshotImage()),\
              self.snapshots.set(self.snapshots.get()+1), print("saved snapshot")])
 
         #Prevents the resizing of the image from resizing the window (preventing feedback loops)
@@ -2276,7 +2125,7 @@ class ColorGUI:
             else:
                 size = (event.width, event.height)
 
-            self.displayCVImage(self.dispIm, size)
+            self.redisplay(size)
         else:
             pass
 
@@ -2325,19 +2174,44 @@ class ColorGUI:
             self.dispIm = im
         else:
             im = self.dispIm
+
+        self.showImage(cv2.resize(im, self.displaySize(self.dispIm, size)))
+
+
+    #Returns the size (width, height) an image is displayed at in a frame of the given size (default: the frame's size)
+    def displaySize(self, im, size=None):
         if size is None:
             size = (self.frame.winfo_width(), self.frame.winfo_height())
 
         if self.fixAspect.get():                                           
-            size = windowAspectAdjust(size, self.dispIm, scaling=1)
+            size = windowAspectAdjust(size, im, scaling=1)
 
-        size = (size[0]-sizeFudge, size[1]-sizeFudge)
-        self.PILimage = Image.fromarray(cv2.cvtColor(cv2.resize(im, size), cv2.COLOR_BGR2RGB)) #opencv stores images in bgr, PIL in rgb
+        return (size[0]-sizeFudge, size[1]-sizeFudge)
+
+
+    #Displays an image that has already been resized to the display size
+    def showImage(self, im):
+        self.PILimage = Image.fromarray(cv2.cvtColor(im, cv2.COLOR_BGR2RGB)) #opencv stores images in bgr, PIL in rgb
         self.Tkimage = ImageTk.PhotoImage(self.PILimage)
         self.display.config(image = self.Tkimage)
         self.display.image = self.Tkimage
 
 
+    #Displays the image again at the frame's size, drawn by the Analysis window if one is open
+    def redisplay(self, size=None):
+        if self.overlay is not None:
+            self.overlay.updateImage(size=size)
+        else:
+            self.displayCVImage(self.dispIm, size)
+
+
+    #Returns the image to save as a snapshot: the displayed image (with anything the Analysis window draws) at full size
+    def snapshotImage(self):
+        if self.overlay is not None:
+            return self.overlay.fullSizeImage()
+        return self.dispIm
+
+
     #Starts analysis
     def analyze(self):
         if self.image is None:
@@ -0,0 +1,420 @@
+'''
+ColorScanBatch
+Mace Lab, Tufts University
+
+Command-line batch analysis for ColorScan. Analyzes a list of images and/or
+folders of images with the settings of a preset saved from the Analysis window,
+writing the same <name>_analysis folders as the GUI. Images are spread across a
+pool of worker processes, one image per worker at a time.
+
+With --watch, keeps running and analyzes each new image dropped into the given
+folders as soon as it has finished being written. The images already analyzed
+are listed in a ColorScan_analyzed.txt file in each folder, so restarting the
+watch doesn't analyze them again.
+
+With --database, the results of every image are also recorded in an SQLite
+database (see ColorScanDatabase.py), so they can be found again across runs.
+
+With --cache, the results of each stage of every analysis are kept in a cache
+folder, keyed by the image's contents and the settings the stage depends on.
+Running the batch again (e.g. after a crash or a change to the preset) reuses
+the analysis folders of the images that are done, and only recomputes the
+stages whose settings changed for the others.
+
+With --tile, each image is analyzed a tile at a time (see TiledAnalysis in
+ColorScanEngine.py), for scans too large to hold the masks and label images of
+the whole image. Blobs are then always found as connected components.
+
+Usage:
+    python ColorScanBatch.py PRESET PATH [PATH ...] [--presets presets.npy] [--workers N] [--baseline N] [--database results.db] [--cache [FOLDER]] [--tile [SIZE]]
+    python ColorScanBatch.py PRESET FOLDER [FOLDER ...] --watch [--interval SECONDS] [--database results.db] [--cache [FOLDER]] [--tile [SIZE]]
+
+'''
+
+
+import argparse #for commandline arguments
+import time #for timing the batch
+import os #for counting cores
+import signal #for leaving Ctrl-C to the main process
+import cv2 #for image processing
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait #for analyzing images in parallel
+from concurrent.futures.process import BrokenProcessPool
+
+from ColorScanEngine import PRESET_PATH, RESULT_CACHE_PATH, RESULT_CACHE_BYTES, TILE_SIZE, ResultCache, getPreset, findImages, analyzeFile
+from ColorScanDatabase import ResultsDatabase
+
+
+#Name of the file in each watched folder listing the images that have already been analyzed
+WATCH_LEDGER = 'ColorScan_analyzed.txt'
+
+#Number of polls in a row that a new file's size and modification time must stay the same
+#   before it is considered fully written
+WATCH_SETTLE_POLLS = 2
+
+#Number of images at the start of a batch analyzed from scratch one at a time, as the baseline the workers' speedup is
+#   measured against (images that fail or are reused from the cache don't count towards it)
+BASELINE_IMAGES = 2
+
+
+
+
+#Analyzes a single image with the given preset, reusing the results in the cache if one is given (as (path, size)),
+#   a tile at a time if a tile size is given
+#Returns the path of the analysis folder, and whether any of it was reused from the cache
+def analyzeImage(filePath, preset, cache=None, tileSize=None):
+    return analyzeFile(filePath, preset, ResultCache(*cache) if cache is not None else None, tileSize)
+
+
+#Sets up each worker process
+def initWorker():
+    limitThreads()
+
+    #Ctrl-C stops the main process, which then lets the workers finish the images they have started
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+#Limits OpenCV to one thread, since each worker already keeps one core busy and OpenCV's own threads would only
+#   compete with the other workers (a serial batch is limited too, so it can be compared with a batch of workers)
+#Returns the number of threads OpenCV was using before
+def limitThreads():
+    threads = cv2.getNumThreads()
+    cv2.setNumThreads(1)
+    return threads
+
+
+#Analyzes a single image, catching any error so that one bad image doesn't stop the batch
+#Returns (image path, analysis folder or None, error message or None, seconds taken, whether it was reused from the cache)
+def analyzeTask(filePath, preset, cache=None, tileSize=None):
+    print("Analyzing image:", filePath)
+    start = time.perf_counter()
+    try:
+        analysisPath, reused = analyzeImage(filePath, preset, cache, tileSize)
+        error = None
+    except Exception as e:
+        analysisPath, reused = None, False
+        error = f"{type(e).__name__}: {e}"
+        print(f"Could not analyze {filePath}: {error}")
+    return filePath, analysisPath, error, time.perf_counter()-start, reused
+
+
+
+
+#Object: WorkerPool
+#Purpose: Analyzes images with a pool of worker processes, surviving a worker that dies outright (e.g. a crash in an
+#   image decoder, or being killed for running out of memory) rather than raising an error
+#   A worker dying breaks its whole pool, failing every image the pool hadn't finished, so the pool is rebuilt and each
+#   of those images is analyzed again in a pool of its own, up to the number of workers at a time
+#   Only the image whose own worker dies too is marked as failed
+class WorkerPool:
+
+    def __init__(self, workers, preset, cache=None, tileSize=None):
+        self.workers = max(1, workers)
+        self.args = (preset, cache, tileSize)
+        self.pool = self.newPool(self.workers)
+        self.running = {} #future -> (key, image path, pool, whether the pool is the image's own) of the images being analyzed
+        self.retries = [] #(key, image path) of the images waiting to be analyzed again in pools of their own
+
+
+    def newPool(self, workers):
+        return ProcessPoolExecutor(max_workers=workers, initializer=initWorker)
+
+
+    #Number of images submitted that haven't been collected yet
+    def __len__(self):
+        return len(self.running)+len(self.retries)
+
+
+    #Starts analyzing an image, which collect() returns under the given key once it is done
+    def submit(self, key, filePath):
+        try:
+            future = self.pool.submit(analyzeTask, filePath, *self.args)
+        except BrokenProcessPool:
+            #The pool broke since its images were last collected (they are analyzed again once collected)
+            self.rebuild()
+            future = self.pool.submit(analyzeTask, filePath, *self.args)
+        self.running[future] = (key, filePath, self.pool, False)
+
+
+    #Replaces the broken pool with a new one
+    def rebuild(self):
+        self.pool.shutdown(wait=False)
+        self.pool = self.newPool(self.workers)
+
+
+    #Starts analyzing the images waiting to be analyzed again, while fewer than the number of workers are
+    def startRetries(self):
+        ownPools = sum(own for key, filePath, pool, own in self.running.values())
+        while len(self.retries)>0 and ownPools<self.workers:
+            key, filePath = self.retries.pop(0)
+            pool = self.newPool(1)
+            self.running[pool.submit(analyzeTask, filePath, *self.args)] = (key, filePath, pool, True)
+            ownPools += 1
+
+
+    #Waits up to timeout seconds (or until one is done, if timeout is None) for the images being analyzed
+    #Returns a list of (key, analyzeTask result) of the images that are done
+    def collect(self, timeout=None):
+        self.startRetries()
+        finished = []
+        done, notDone = wait(list(self.running), timeout=timeout, return_when=FIRST_COMPLETED)
+        for future in done:
+            key, filePath, pool, own = self.running.pop(future)
+            if own:
+                pool.shutdown()
+            elif isinstance(future.exception(), BrokenProcessPool):
+                if pool is self.pool:
+                    self.rebuild()
+                self.retries.append((key, filePath))
+                continue
+
+            try:
+                finished.append((key, future.result()))
+            except BrokenProcessPool:
+                finished.append((key, (filePath, None, "BrokenProcessPool: the worker process stopped unexpectedly", 0.0, False)))
+        self.startRetries()
+        return finished
+
+
+    #Waits for the images being analyzed, then shuts the pool down
+    #   If cancel is True, the images that haven't started yet are dropped rather than analyzed
+    #Returns a list of (key, analyzeTask result) of the images done meanwhile
+    def close(self, cancel=False):
+        finished = []
+        while len(self)>0:
+            if cancel:
+                self.retries.clear()
+                for future in list(self.running):
+                    if future.cancel():
+                        del self.running[future]
+            finished += self.collect()
+        self.pool.shutdown()
+        return finished
+
+
+
+
+#Analyzes the images with a pool of worker processes (or in this process if workers is 1)
+#   If a database is given, each analyzed image is queued to be recorded in it as soon as it is done
+#Returns a list of analyzeTask results in the same order as the images, whatever order they finish in
+def runBatch(images, preset, workers=1, database=None, cache=None, tileSize=None):
+    if workers<=1 or len(images)<=1:
+        threads = limitThreads()
+        results = []
+        try:
+            for filePath in images:
+                results.append(analyzeTask(filePath, preset, cache, tileSize))
+                recordResult(database, results[-1])
+        finally:
+            cv2.setNumThreads(threads)
+        return results
+
+    results = [None]*len(images)
+    pool = WorkerPool(min(workers, len(images)), preset, cache, tileSize)
+    try:
+        for i, filePath in enumerate(images):
+            pool.submit(i, filePath)
+        while len(pool)>0:
+            for i, result in pool.collect():
+                results[i] = result
+                recordResult(database, result)
+    except KeyboardInterrupt:
+        #Recording the images the workers were in the middle of, without starting any more
+        for i, result in pool.close(cancel=True):
+            recordResult(database, result)
+        raise
+    pool.close()
+    return results
+
+
+#Queues an analyzeTask result to be recorded in the database, if there is one and the image was analyzed
+def recordResult(database, result):
+    filePath, analysisPath, error, seconds, reused = result
+    if database is not None and analysisPath is not None:
+        database.record(filePath, analysisPath)
+
+
+#Whether an analyzeTask result timed a whole analysis, i.e. the image was analyzed and none of it came from the cache
+def isTimed(result):
+    filePath, analysisPath, error, seconds, reused = result
+    return analysisPath is not None and not reused
+
+
+#Prints a summary of the batch, and how well it scaled across the workers if it started with a serial baseline
+#   The baseline is the first images of the batch, analyzed one at a time in this process, and the rest are analyzed
+#   by the workers, which took poolElapsed seconds
+#   Both are timed in seconds per image analyzed from scratch, leaving out the images that failed or were reused from
+#   the cache (the workers' time is reduced by the time they spent on those), and the speedup is the ratio of the two
+#   A perfectly scaling batch has a speedup equal to the number of workers
+def reportBatch(results, elapsed, workers, serialImages=0, poolElapsed=None):
+    failed = [(filePath, error) for filePath, analysisPath, error, seconds, reused in results if analysisPath is None]
+    print(f"Analyzed {len(results)-len(failed)} of {len(results)} images in {elapsed:.1f} s"+\
+          f" ({len(results)/elapsed if elapsed>0 else 0:.2f} images/s)")
+
+    serialTimed = [result[3] for result in results[:serialImages] if isTimed(result)]
+    poolTimed = [result for result in results[serialImages:] if isTimed(result)]
+    if len(serialTimed)>0 and len(poolTimed)>0 and poolElapsed is not None:
+        workers = max(1, min(workers, len(results)-serialImages))
+        serialSeconds = sum(serialTimed)/len(serialTimed)
+        untimedSeconds = sum(result[3] for result in results[serialImages:] if not isTimed(result))
+        poolSeconds = max(0, poolElapsed-untimedSeconds/workers)/len(poolTimed)
+        speedup = serialSeconds/poolSeconds if poolSeconds>0 else 0
+        print(f"Serial: {len(serialTimed)} images at {serialSeconds:.2f} s/image | {workers} workers: {len(poolTimed)} images at"+\
+              f" {poolSeconds:.2f} s/image | speedup: {speedup:.2f}x | efficiency: {100*speedup/workers:.0f}%")
+
+    for filePath, error in failed:
+        print("Failed:", filePath, "|", error)
+
+
+#Reads the ledger of a watched folder
+#Returns a dictionary of file name -> (size, modification time) of the images already analyzed
+def readLedger(folder):
+    ledger = {}
+    ledgerPath = os.path.join(folder, WATCH_LEDGER)
+    if os.path.exists(ledgerPath):
+        with open(ledgerPath) as f:
+            for line in f:
+                fields = line.rstrip('\n').split('\t')
+                #Skipping lines cut short by a crash while writing
+                if len(fields)==4:
+                    ledger[fields[0]] = (int(fields[1]), int(fields[2]))
+    return ledger
+
+
+#Adds an analyzed image to the ledger of its folder, along with whether the analysis worked
+#   Failed images are recorded too, so a corrupt file isn't retried forever
+def appendLedger(filePath, fileStat, status):
+    with open(os.path.join(os.path.dirname(filePath), WATCH_LEDGER), 'a') as f:
+        f.write(f"{os.path.basename(filePath)}\t{fileStat[0]}\t{fileStat[1]}\t{status}\n")
+
+
+#Returns the size and modification time of a file, or None if it has disappeared
+def fileStat(filePath):
+    try:
+        st = os.stat(filePath)
+    except FileNotFoundError:
+        return None
+    return st.st_size, st.st_mtime_ns
+
+
+#Records a finished image of a watched folder in the folder's ledger, and in the database if there is one
+def finishWatched(result, stat, ledgers, database):
+    filePath, analysisPath, error, seconds, reused = result
+    appendLedger(filePath, stat, 'analyzed' if analysisPath is not None else 'failed')
+    recordResult(database, result)
+    ledgers[os.path.dirname(filePath)][os.path.basename(filePath)] = stat
+    if analysisPath is not None:
+        print(f"Analyzed {filePath} -> {analysisPath}")
+    else:
+        print(f"Failed: {filePath} | {error}")
+
+
+#Watches folders for new images and analyzes each one once it has stopped changing, until interrupted
+#   An image that is rewritten (new size or modification time) is analyzed again
+def watchFolders(folders, preset, workers=1, interval=1.0, database=None, cache=None, tileSize=None):
+    ledgers = {folder: readLedger(folder) for folder in folders}
+
+    #Files seen but not yet settled: path -> (last size and modification time, number of polls unchanged)
+    pending = {}
+    #Files being analyzed: path -> size and modification time when submitted
+    running = {}
+
+    print("Watching for new images in:", *folders)
+    pool = WorkerPool(workers, preset, cache, tileSize)
+    try:
+        while True:
+            for folder in folders:
+                for filePath in findImages([folder]):
+                    stat = fileStat(filePath)
+                    if stat is None or filePath in running or ledgers[folder].get(os.path.basename(filePath))==stat:
+                        continue
+
+                    #A file is only analyzed once it is non-empty and hasn't changed for a few polls
+                    lastStat, polls = pending.get(filePath, (None, 0))
+                    polls = polls+1 if stat==lastStat and stat[0]>0 else 0
+                    if polls>=WATCH_SETTLE_POLLS:
+                        del pending[filePath]
+                        pool.submit(filePath, filePath)
+                        running[filePath] = stat
+                    else:
+                        pending[filePath] = (stat, polls)
+
+            #Recording the images that have finished, waiting up to one poll interval for them
+            for filePath, result in pool.collect(timeout=interval):
+                finishWatched(result, running.pop(filePath), ledgers, database)
+
+            if len(pool)==0:
+                time.sleep(interval)
+
+    except KeyboardInterrupt:
+        #Images already started are finished and recorded, so a restart doesn't analyze them again
+        #   (the others aren't in the ledger, so a restart picks them up)
+        print("Stopped watching, finishing the images in progress")
+        for filePath, result in pool.close(cancel=True):
+            finishWatched(result, running.pop(filePath), ledgers, database)
+
+
+#Reads the commandline arguments
+def parseArgs(argv=None):
+    parser = argparse.ArgumentParser(description="Analyze images with a saved ColorScan preset, without the GUI")
+    parser.add_argument('preset', help="name of the preset to use, as saved from the Analysis window")
+    parser.add_argument('paths', nargs='+', help="images and/or folders of images to analyze")
+    parser.add_argument('--presets', default=PRESET_PATH, help="path to the presets file (default: %(default)s)")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help="number of worker processes (default: %(default)s)")
+    parser.add_argument('--baseline', type=int, default=BASELINE_IMAGES,
+                        help="number of images analyzed from scratch one at a time before starting the workers, to measure their speedup against (default: %(default)s)")
+    parser.add_argument('--watch', action='store_true', help="keep running and analyze new images as they appear in the folders")
+    parser.add_argument('--interval', type=float, default=1.0, help="seconds between checks for new images when watching (default: %(default)s)")
+    parser.add_argument('--database', help="SQLite database to also record the results in (created if it doesn't exist)")
+    parser.add_argument('--cache', nargs='?', const=RESULT_CACHE_PATH,
+                        help="folder to cache the results of each stage in, to skip unchanged work when run again (default folder: %(const)s)")
+    parser.add_argument('--cache-size', type=float, default=RESULT_CACHE_BYTES/1024**3,
+                        help="size in GB that the cache is kept under, deleting the least recently used results (default: %(default)s)")
+    parser.add_argument('--tile', type=int, nargs='?', const=TILE_SIZE,
+                        help="analyze each image a tile of this many pixels square at a time, to bound memory on very large scans (default size: %(const)s)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parseArgs(argv)
+    preset = getPreset(args.preset, args.presets)
+    database = ResultsDatabase(args.database) if args.database is not None else None
+    #The workers each open the cache from its folder and size
+    cache = (args.cache, int(args.cache_size*1024**3)) if args.cache is not None else None
+
+    if args.watch:
+        folders = [os.path.normpath(path) for path in args.paths]
+        for folder in folders:
+            if not os.path.isdir(folder):
+                raise SystemExit(f"{folder} is not a folder, only folders can be watched")
+        watchFolders(folders, preset, args.workers, args.interval, database, cache, args.tile)
+        if database is not None:
+            database.close()
+        return 0
+
+    images = findImages(args.paths)
+
+    #Starting with images analyzed one at a time until enough are analyzed from scratch (not failed or reused from the
+    #   cache) to measure the workers' speedup against, as long as images are left for the workers
+    start = time.perf_counter()
+    results = []
+    if args.workers>1:
+        while len(results)<len(images)-1 and sum(isTimed(result) for result in results)<args.baseline:
+            results += runBatch([images[len(results)]], preset, 1, database, cache, args.tile)
+    serialImages = len(results)
+
+    poolStart = time.perf_counter()
+    results += runBatch(images[serialImages:], preset, args.workers, database, cache, args.tile)
+    poolElapsed = time.perf_counter()-poolStart
+    elapsed = time.perf_counter()-start
+
+    #Waiting for the last results to be recorded
+    if database is not None:
+        database.close()
+
+    reportBatch(results, elapsed, args.workers, serialImages, poolElapsed)
+
+    return 1 if any(analysisPath is None for filePath, analysisPath, error, seconds, reused in results) else 0
+
+
+if __name__=='__main__':
+    raise SystemExit(main())
@@ -0,0 +1,240 @@
+'''
+ColorScanDatabase
+Mace Lab, Tufts University
+
+SQLite database of analysis results, collected across runs. Each analyzed image
+is recorded once per content (path, SHA-256 hash and size), each analysis as a
+run (the preset used, when it was analyzed and recorded, and its analysis
+folder), and each zone of a run with its area and the average and standard
+deviation of every channel, as saved in the run's _results.npz file. An
+analysis folder is only recorded once, however many times it is passed in
+(e.g. by a batch reusing its cached analyses).
+
+ColorScanBatch.py records its results here with --database. Results are
+recorded by a background thread, which inserts everything that finished since
+its last write in one transaction, so neither the analysis nor the batch waits
+on the database.
+
+Example query, all the zones of the images of device X from the last week:
+    db = ResultsDatabase('results.db')
+    zones = db.findZones(path='*deviceX*', since=datetime.now()-timedelta(days=7))
+
+'''
+
+
+import sqlite3 #for the database
+import json #for storing the presets
+import os #for filepath operations
+import time #for timestamps
+import queue #for handing results to the writer thread
+import threading #for writing in the background
+from contextlib import closing
+
+import numpy as np #for array operations
+
+from ColorScanEngine import RESULTS_CHANNELS, RESULTS_DTYPE, loadResults, fileHash
+
+
+#Seconds to wait for another process writing to the same database before giving up
+DATABASE_TIMEOUT = 60
+
+#Column of the zones table for each field of the results (see RESULTS_DTYPE)
+#   SQLite column names ignore case, so the channels are named after their colorspace (B of RGB and b of Lab would clash)
+ZONE_COLUMNS = {'id': 'zone', 'x': 'x', 'y': 'y', 'Area [pixels]': 'area'}
+for colorspace, channels in RESULTS_CHANNELS.items():
+    for name in channels:
+        ZONE_COLUMNS[name] = f"{colorspace}_{name}" if colorspace!='Gray' else 'gray'
+        ZONE_COLUMNS['std '+name] = f"std_{colorspace}_{name}" if colorspace!='Gray' else 'std_gray'
+
+SCHEMA = f'''
+CREATE TABLE IF NOT EXISTS images (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL,
+    sha256 TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    UNIQUE (path, sha256)
+);
+CREATE INDEX IF NOT EXISTS images_sha256 ON images (sha256);
+
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    image INTEGER NOT NULL REFERENCES images (id),
+    analysis_path TEXT NOT NULL,
+    preset TEXT NOT NULL,
+    analyzed REAL NOT NULL,
+    recorded REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS runs_image ON runs (image, analyzed);
+CREATE INDEX IF NOT EXISTS runs_analyzed ON runs (analyzed);
+
+CREATE TABLE IF NOT EXISTS zones (
+    run INTEGER NOT NULL REFERENCES runs (id) ON DELETE CASCADE,
+    {', '.join(f'{column} {"INTEGER" if column=="zone" else "REAL"}' for column in ZONE_COLUMNS.values())},
+    PRIMARY KEY (run, zone)
+) WITHOUT ROWID;
+'''
+
+#Index keeping each analysis folder to one run, made separately (see ResultsDatabase), since databases made before it
+#   can hold the same run more than once
+RUNS_UNIQUE_INDEX = 'CREATE UNIQUE INDEX runs_analysis_path ON runs (analysis_path)'
+
+
+
+
+#Converts a datetime to seconds since the epoch, as the timestamps are stored (numbers are passed through)
+def timestamp(t):
+    return t.timestamp() if hasattr(t, 'timestamp') else t
+
+
+
+
+#Object: ResultsDatabase
+#Purpose: Records analysis results in an SQLite database, and finds them again
+#   record() only queues the result, a background thread (started by the first record) reads the analysis files and
+#   inserts them, everything queued since its last write in one transaction
+#   The database is in write-ahead-log mode, so it can be queried while results are being recorded
+#   close() waits for every queued result to be recorded
+class ResultsDatabase:
+
+    def __init__(self, path):
+        self.path = path
+        self.queue = queue.Queue()
+        self.thread = None
+
+        with closing(self.connect()) as connection:
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.executescript(SCHEMA)
+
+            #Keeping the first run of each analysis folder recorded more than once (the zones of the others go with
+            #   them) so the index can be made
+            if connection.execute("SELECT 1 FROM sqlite_master WHERE type='index' AND name='runs_analysis_path'").fetchone() is None:
+                with connection:
+                    connection.execute('DELETE FROM runs WHERE id NOT IN (SELECT MIN(id) FROM runs GROUP BY analysis_path)')
+                    connection.execute(RUNS_UNIQUE_INDEX)
+
+
+    #Opens a new connection to the database (a connection can only be used by the thread that opened it)
+    def connect(self):
+        connection = sqlite3.connect(self.path, timeout=DATABASE_TIMEOUT)
+        connection.execute('PRAGMA foreign_keys=ON')
+        return connection
+
+
+    #Queues the results of an analysis to be recorded, given the image and its analysis folder
+    def record(self, imagePath, analysisPath):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.writeLoop, daemon=True)
+            self.thread.start()
+        self.queue.put((imagePath, analysisPath))
+
+
+    #Waits for every queued result to be recorded
+    def close(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+
+    #Records the queued results until close() is called (in the background thread)
+    def writeLoop(self):
+        with closing(self.connect()) as connection:
+            while True:
+                #Taking everything that is queued, waiting for at least one
+                items = [self.queue.get()]
+                while not self.queue.empty():
+                    items.append(self.queue.get())
+                done = None in items
+
+                #Reading the files first, so a run that can't be read doesn't stop the others being recorded
+                runs = []
+                for item in items:
+                    if item is None:
+                        continue
+                    try:
+                        runs.append(self.readRun(*item))
+                    except Exception as e:
+                        print(f"Could not record {item[0]} in {self.path}: {type(e).__name__}: {e}")
+
+                if len(runs)>0:
+                    try:
+                        with connection:
+                            for run in runs:
+                                self.insertRun(connection, *run)
+                    except sqlite3.Error as e:
+                        print(f"Could not record {len(runs)} runs in {self.path}: {type(e).__name__}: {e}")
+
+                if done:
+                    return
+
+
+    #Reads what is recorded of an analysis: the image's path, hash and size, and the results saved in the analysis folder
+    #   The analysis time is when the results file was saved
+    #Returns (image path, hash, size, analysis path, preset, analysis time, zones)
+    def readRun(self, imagePath, analysisPath):
+        imagePath = os.path.abspath(imagePath)
+        analysisPath = os.path.abspath(analysisPath)
+        resultsPath = os.path.join(analysisPath, os.path.splitext(os.path.basename(imagePath))[0]+'_results.npz')
+
+        zones, preset = loadResults(resultsPath)
+        return imagePath, fileHash(imagePath), os.path.getsize(imagePath), analysisPath, preset, os.path.getmtime(resultsPath), zones
+
+
+    #Inserts a run, its zones, and its image if the image (with this content) isn't in the database yet
+    #   A run whose analysis folder is already recorded (e.g. reused from the cache) isn't inserted again
+    def insertRun(self, connection, imagePath, sha256, size, analysisPath, preset, analyzed, zones):
+        connection.execute('INSERT OR IGNORE INTO images (path, sha256, size) VALUES (?, ?, ?)', (imagePath, sha256, size))
+        image, = connection.execute('SELECT id FROM images WHERE path=? AND sha256=?', (imagePath, sha256)).fetchone()
+
+        cursor = connection.execute('INSERT OR IGNORE INTO runs (image, analysis_path, preset, analyzed, recorded) VALUES (?, ?, ?, ?, ?)',
+                                    (image, analysisPath, json.dumps(preset), analyzed, time.time()))
+        if cursor.rowcount==0:
+            return
+        run = cursor.lastrowid
+
+        columns = [ZONE_COLUMNS[name] for name in RESULTS_DTYPE.names]
+        connection.executemany(f"INSERT INTO zones (run, {', '.join(columns)}) VALUES ({', '.join('?'*(len(columns)+1))})",
+                               [(run,)+zone for zone in zones.tolist()])
+
+
+    #Builds the conditions on the runs and images for the find functions
+    #   path is matched as a glob pattern against the absolute path of the image (e.g. '*deviceX*')
+    #   since and until limit when the runs were analyzed, as datetimes or seconds since the epoch
+    #Returns the WHERE clause and its parameters
+    def runConditions(self, path=None, sha256=None, since=None, until=None):
+        conditions, parameters = [], []
+        for condition, value in (('images.path GLOB ?', path), ('images.sha256=?', sha256),
+                                 ('runs.analyzed>=?', timestamp(since)), ('runs.analyzed<?', timestamp(until))):
+            if value is not None:
+                conditions.append(condition)
+                parameters.append(value)
+        return ('WHERE '+' AND '.join(conditions)) if len(conditions)>0 else '', parameters
+
+
+    #Finds the runs of the images matching the conditions (see runConditions), oldest first
+    #Returns a list of dictionaries with the run id, image path, hash and size, analysis path, preset,
+    #   and when the run was analyzed and recorded (seconds since the epoch)
+    def findRuns(self, path=None, sha256=None, since=None, until=None):
+        where, parameters = self.runConditions(path, sha256, since, until)
+        with closing(self.connect()) as connection:
+            rows = connection.execute('SELECT runs.id, images.path, images.sha256, images.size, runs.analysis_path, runs.preset, '
+                                      f'runs.analyzed, runs.recorded FROM runs JOIN images ON runs.image=images.id {where} '
+                                      'ORDER BY runs.analyzed', parameters).fetchall()
+
+        names = ('run', 'path', 'sha256', 'size', 'analysisPath', 'preset', 'analyzed', 'recorded')
+        runs = [dict(zip(names, row)) for row in rows]
+        for run in runs:
+            run['preset'] = json.loads(run['preset'])
+        return runs
+
+
+    #Finds the zones of the runs matching the conditions (see runConditions), in order of run then zone
+    #Returns the zones as an array of the run id followed by the results fields (see RESULTS_DTYPE)
+    def findZones(self, path=None, sha256=None, since=None, until=None):
+        where, parameters = self.runConditions(path, sha256, since, until)
+        columns = ', '.join('zones.'+ZONE_COLUMNS[name] for name in RESULTS_DTYPE.names)
+        with closing(self.connect()) as connection:
+            rows = connection.execute(f'SELECT zones.run, {columns} FROM zones JOIN runs ON zones.run=runs.id '
+                                      f'JOIN images ON runs.image=images.id {where} ORDER BY runs.analyzed, zones.run, zones.zone',
+                                      parameters).fetchall()
+        return np.array(rows, dtype=[('run', np.int64)]+RESULTS_DTYPE.descr)
@@ -0,0 +1,2375 @@
+'''
+ColorScanEngine
+Mace Lab, Tufts University
+
+GUI-free analysis engine for ColorScan. It runs the same steps as the Analysis
+window (mask, dilate/erode, blur, contours, similar contours, zone refinement,
+zone colors) but reads its settings from a saved preset instead of tkinter
+variables, so images can be analyzed without clicking through the GUI.
+
+The Analysis window in ColorScan.py is built on top of the ColorAnalysis class
+defined here, and ColorScanBatch.py uses it to process whole folders of images.
+TiledAnalysis runs the same analysis a tile at a time, for scans too large to
+hold the masks of the whole image.
+
+'''
+
+
+import numpy as np #for array operations
+import cv2 #for image processing
+import os #for filepath operations
+import math #for log-scaling Hu moments exactly like OpenCV
+from collections import OrderedDict #for the least-recently-used stage cache
+import threading #for sharing the stage cache with a background thread
+import functools #for caching rasterized shapes
+import copy #for indexing component stores
+from concurrent.futures import ThreadPoolExecutor #for plotting histograms and saving outputs in the background
+import io #for rendering plots in memory
+import hashlib #for hashing images and settings for the result cache
+import json #for hashing settings
+import zipfile #for catching damaged cache files
+
+from matplotlib.figure import Figure #For plotting histograms without a GUI
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+
+
+
+#These are required to replace the missing constants in the OpenCV 3
+CV_CONTOURS_MATCH_I1 = 1 #sum of absolute differences of reciprocals of each image invariant
+CV_CONTOURS_MATCH_I2 = 2 #sum of absolute differences of each image invariant
+CV_CONTOURS_MATCH_I3 = 3 #greatest absolute difference of image invariants, normalized to A
+
+
+INVALID_PRESET_NUM = -999999 #A number that will (hopefully) never show up in a valid preset
+
+
+RGB2grayscale_weights = np.array([0.299, 0.587, 0.114]) #RGB weights to convert to grayscale
+#See https://docs.opencv.org/3.4/de/d25/imgproc_color_conversions.html for reference
+
+
+#Path to the presets file, stored as a binary file by numpy
+PRESET_PATH = 'presets.npy'
+
+#Default values of the preset variables, matching the defaults of the Analysis window
+#   (new settings must be added here as well as in AnalysisWindow.__init__)
+DEFAULT_PRESET = {
+    'V_maskThresh1': 0,
+    'V_maskThresh2': 0,
+    'V_maskMode': 0,
+    'V_dilerocode': "",
+    'V_blurAmount': 1,
+    'V_sizeTol': 20.0,
+    'V_shapeTol': 1.0,
+    'V_saveRGB': True,
+    'V_saveHSV': True,
+    'V_saveLAB': True,
+    'V_saveHistograms': False,
+    'V_histogramOutput': "csv+plots",
+    'V_resultsOutput': "npz+csv",
+    'V_referenceArea': float(INVALID_PRESET_NUM),
+    'V_contourMode': "tree",
+    'V_refiner_shape': "",
+    'V_refiner_displace_x': INVALID_PRESET_NUM,
+    'V_refiner_displace_y': INVALID_PRESET_NUM,
+    'V_refiner_radius': INVALID_PRESET_NUM,
+    'V_refiner_width': INVALID_PRESET_NUM,
+    'V_refiner_height': INVALID_PRESET_NUM,
+    'V_refiner_sides': INVALID_PRESET_NUM,
+    'V_refiner_angle': float(INVALID_PRESET_NUM),
+    }
+
+
+#Ways of finding the contours in the mask (the V_contourMode setting)
+#   tree: every outline in the mask, including the outlines of holes
+#   external: only the outer outlines, for devices without holes
+#   components: connected-component labeling, which measures every blob at once and only traces the outlines
+#      that are drawn or shape-matched (areas count pixels, so they are a little larger than outline areas)
+#   Presets saved before this setting existed have no mode, which finds contours the original way (tree)
+CONTOUR_MODES = ('tree', 'external', 'components')
+
+
+#Ways of saving the zone histograms when V_saveHistograms is on (the V_histogramOutput setting)
+#   csv: one csv file of counts per zone
+#   npy: one array of every zone's counts, shaped (zones, 256, 3) with the channels in RGB order
+#   +plots: also a png plot per zone, drawn in a background thread while the rest of the analysis is saved
+#   Presets saved before this setting existed have no output, which saves csv files and plots (as before)
+HISTOGRAM_OUTPUTS = ('csv+plots', 'csv', 'npy+plots', 'npy')
+
+
+#Ways of saving the zone colors (the V_resultsOutput setting)
+#   npz: the results of every zone as one typed array, with the preset that made them (see saveColors and loadResults)
+#   +csv: also the colors csv file, made from the same results
+#   Presets saved before this setting existed have no output, which saves both
+RESULTS_OUTPUTS = ('npz+csv', 'npz')
+
+#Channels of each colorspace in the results, in the units of the csv file
+#   (RGB 0-255, H in degrees, S and V 0-1, L 0-100, a and b from -128 to 127)
+RESULTS_CHANNELS = {'RGB': ('R', 'G', 'B'), 'Gray': ('Gray',), 'HSV': ('H', 'S', 'V'), 'LAB': ('L', 'a', 'b')}
+
+#Results of each zone: its number (as drawn on the labeled image), center, area in pixels,
+#   and the average and standard deviation of every channel (NaN for the colorspaces that weren't saved)
+RESULTS_DTYPE = np.dtype([('id', np.int32), ('x', np.float64), ('y', np.float64), ('Area [pixels]', np.float64)]+
+                         [(name, np.float64) for channels in RESULTS_CHANNELS.values() for name in channels]+
+                         [('std '+name, np.float64) for channels in RESULTS_CHANNELS.values() for name in channels])
+
+
+#Per-contour measurements used to find similar contours (see contourFeatures)
+CONTOUR_FEATURES_DTYPE = np.dtype([('hu', np.float64, 7), ('logHu', np.float64, 7), ('area', np.float64), ('perimeter', np.float64), ('bbox', np.int32, 4)])
+
+#Structuring element for each press of Dilate or Erode
+#   Earlier versions passed the tuple (5,5) as the kernel, which OpenCV reads as a 2x1 column of ones,
+#   so this is kept as the default to reproduce the masks saved in existing presets
+DILERO_KERNEL = np.ones((2,1), dtype=np.uint8)
+
+#OpenCV operations for each step of a compiled dilate/erode code
+MORPH_OPS = {'dilate': cv2.MORPH_DILATE, 'erode': cv2.MORPH_ERODE, 'open': cv2.MORPH_OPEN, 'close': cv2.MORPH_CLOSE}
+
+
+#Total size of the intermediate masks kept by each image's stage cache
+STAGE_CACHE_BYTES = 512*1024**2
+
+
+#Folder the batch keeps its result cache in by default, and the total size the cache is kept under
+RESULT_CACHE_PATH = 'ColorScan_cache'
+RESULT_CACHE_BYTES = 2*1024**3
+
+#Version of the cached results, to be increased whenever a change to the analysis changes its results
+RESULT_CACHE_VERSION = 1
+
+#Preset settings that each stage of an analysis depends on, in the order of the stages (see stageKeys)
+#   zones: the contours of the zones, found in the mask and selected as similar to the reference contour
+#   colors: the colors and areas of the zones, which also depend on the zone refinement and the colorspaces measured
+#   outputs: the analysis folder, which also depends on what is saved
+#   A stage's key also covers the stages before it, so e.g. saving histograms too doesn't remeasure the zones
+STAGE_SETTINGS = OrderedDict([
+    ('zones', ('V_maskThresh1', 'V_maskThresh2', 'V_maskMode', 'V_dilerocode', 'V_blurAmount', 'V_contourMode',
+               'V_referenceArea', 'V_sizeTol', 'V_shapeTol')),
+    ('colors', ('V_refiner_shape', 'V_refiner_displace_x', 'V_refiner_displace_y', 'V_refiner_radius',
+                'V_refiner_width', 'V_refiner_height', 'V_refiner_sides', 'V_refiner_angle', 'V_saveHSV', 'V_saveLAB')),
+    ('outputs', ('V_saveRGB', 'V_saveHistograms', 'V_histogramOutput', 'V_resultsOutput')),
+    ])
+
+#Colorspaces the zone colors are measured in, in the order of the results, as (cv2.cvtColor code from BGR, preset
+#   setting that saves the colorspace), BGR always being measured since the grayscale is computed from it
+ZONE_COLORSPACES = ((None, None), (cv2.COLOR_BGR2HSV, 'V_saveHSV'), (cv2.COLOR_BGR2LAB, 'V_saveLAB'))
+
+#Number of rows converted at a time when only some channels of a conversion are kept (see saturationValue)
+CONVERSION_STRIP_ROWS = 256
+
+#Width and height in pixels of the tiles that a tiled analysis works on (see TiledAnalysis)
+TILE_SIZE = 2048
+
+#Size of the pieces files are read in to be hashed
+HASH_CHUNK = 1024**2
+
+
+#Number of threads that encode and save the output files of an analysis, and how many files can wait for them
+#   (each waiting file holds its image, so this bounds the memory the waiting files take)
+OUTPUT_THREADS = 4
+OUTPUT_QUEUE = 32
+
+
+#File extensions that will be picked up when analyzing a folder of images
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.tif', '.tiff', '.bmp')
+
+
+
+
+#takes in a 2D array of integers (image channel) and a boolean mask of the same size
+#returns a histogram of the values for that channel in the masked area
+def imageChannelHistogram(channel, mask=None, bins=256):
+    if mask is not None:
+        channel_masked = np.ma.MaskedArray(channel, ~mask).compressed()
+    else:
+        channel_masked = channel
+    heights, edges = np.histogram(channel_masked, bins, (0,256))
+    return heights, edges
+
+
+#Computes the histograms of every channel of an 8-bit image in one pass, counting only the pixels where the mask
+#   is nonzero if a mask is given (the same counts as imageChannelHistogram gives for each channel)
+#   The channels' values are offset into separate ranges of one bincount
+#Returns heights (channels, 256) and the bin edges
+def imageHistograms(im, mask=None):
+    channels = im.shape[-1]
+    pixels = im.reshape(-1, channels) if mask is None else im[mask>0]
+    values = pixels.astype(np.intp)+np.arange(channels)*256
+    heights = np.bincount(values.ravel(), minlength=256*channels).reshape(channels, 256)
+    return heights, np.linspace(0, 256, 257)
+
+
+#Produces the vertices of a regular polygon, where x = cos(2 i (pi) k/n) and y = sin(2 i (pi) k/n) for
+#  k from 0 to n-1 for open polygon (toClose=False) or from 0 to n for closed polygon (toClose=True)
+#  argument phi rotates the polygon, argument center shifts the origin, r controls the radius of the circumscribing circle
+def regularPolygonPoints(n, phi=0, center=np.array([0,0]), r=1, toClose=False):
+    angles = np.array([2*np.pi*k/n+phi for k in range(n+int(toClose))])
+    points = np.array([r*np.cos(angles)+center[0], r*np.sin(angles)+center[1]]).T
+    return points
+
+
+#Generalized OpenCV shape drawing function for various possible geometries
+#Args: image array (numpy) im, string shape ['polygon','rectangle','circle']
+#  numpy 2D vector for center coordinates of the shape, list of data for the shape:
+#     data organkzation: [general shape arguments, [size arguments]]
+#     Ex: polygon:   [# of sides, angle of polygon, [radius]]
+#         circle:    [[radius]]
+#         rectangle: [[width, height]]
+#  offset shifts the shape after its points are rounded to pixels, like the offset of cv2.drawContours,
+#     so a shape drawn into a crop has exactly the pixels it would have in the full image
+def drawShape(im, shape, center, data, color, thickness, offset=(0,0)):
+    offset = np.array(offset, dtype=int)
+
+    if shape=='polygon':
+
+        n_sides = data[0]
+        angle = data[1]
+        radius = data[2][0]
+
+        points = regularPolygonPoints(n_sides, angle, center, radius)
+
+
+        if thickness>=0:
+            cv2.polylines(im, np.array([points]).astype(np.int32)+offset.astype(np.int32), True, color, thickness)
+        else:
+            cv2.fillConvexPoly(im, np.array([points]).astype(np.int32)+offset.astype(np.int32), color)
+
+    elif shape=='rectangle':
+
+        width = data[0][0]
+        height = data[0][1]
+
+        #cv2 Rectangles are defined by two points (stored as tuples)
+        tl = tuple((center-np.array([width/2,height/2])).astype(int)+offset)
+        br = tuple((center+np.array([width/2,height/2])).astype(int)+offset)
+
+
+        cv2.rectangle(im, tl, br, color, thickness)
+
+    elif shape=='circle':
+
+        radius = data[0][0]
+        #cv2 Circles are defined by a center (tuple) and a radius
+        cv2.circle(im, tuple(center.astype(int)+offset), radius, color, thickness)
+
+
+    else:
+        raise NotImplementedError(f"Shape {shape} not implemented!")
+
+
+#Scales the size of a shape (the data of drawShape), e.g. to draw it on a resized image
+def scaleShapeData(shape, data, scale):
+    if shape=='polygon':
+        return [data[0], data[1], [data[2][0]*scale]]
+    elif shape=='rectangle':
+        return [[data[0][0]*scale, data[0][1]*scale]]
+    elif shape=='circle':
+        #cv2 Circles need an integer radius
+        return [[int(round(data[0][0]*scale))]]
+    else:
+        raise NotImplementedError(f"Shape {shape} not implemented!")
+
+
+#Returns the data of a shape (see drawShape) as nested tuples, so it can key the shape stamp cache
+def freezeShapeData(data):
+    return tuple(freezeShapeData(d) if isinstance(d, (list, tuple, np.ndarray)) else d for d in data)
+
+
+#Rasterizes a shape (see drawShape) once, around the origin, so the same pixels can be pasted at every zone
+#   thickness<0 gives the filled mask, otherwise the outline drawn with that thickness
+#   Every refined zone has the same shape and size, so each shape is only drawn once per thickness
+#   The shape is drawn away from the image borders, so a zone near an edge gets the same pixels as any other
+#Returns (dx, dy, stamp), the stamp covering [y+dy:y+dy+h, x+dx:x+dx+w] for a shape centered at (x, y)
+def cachedShapeStamp(shape, data, thickness):
+    return rasterizeShape(shape, freezeShapeData(data), int(thickness))
+
+
+#Draws a shape for cachedShapeStamp, the data given as nested tuples so the results can be cached
+@functools.lru_cache(maxsize=32)
+def rasterizeShape(shape, data, thickness):
+    #The shape reaches at most its size parameters from its center, plus the outline's thickness
+    margin = int(np.ceil(max(data[-1][0], data[-1][-1])))+max(thickness, 0)+2
+    canvas = np.zeros((2*margin+1, 2*margin+1), dtype=np.uint8)
+    drawShape(canvas, shape, np.array([margin, margin]), data, color=255, thickness=thickness)
+
+    #Cropping to the pixels of the shape
+    rows = np.flatnonzero(canvas.any(axis=1))
+    cols = np.flatnonzero(canvas.any(axis=0))
+    if len(rows)==0:
+        return 0, 0, np.zeros((0, 0), dtype=np.uint8)
+    stamp = canvas[rows[0]:rows[-1]+1, cols[0]:cols[-1]+1].copy()
+
+    #The stamp is shared by every zone
+    stamp.flags.writeable = False
+    return int(cols[0])-margin, int(rows[0])-margin, stamp
+
+
+#Clips a stamp placed with its top-left corner at (x, y) to an image of the given shape
+#Returns (x, y, stamp), with the stamp cut down to the part inside the image (possibly empty)
+def clipStamp(x, y, stamp, imShape):
+    h, w = stamp.shape
+    x0, y0 = min(max(x, 0), imShape[1]), min(max(y, 0), imShape[0])
+    x1, y1 = max(min(x+w, imShape[1]), x0), max(min(y+h, imShape[0]), y0)
+    return x0, y0, stamp[y0-y:y1-y, x0-x:x1-x]
+
+
+#Draws a shape (see drawShape) centered at integer coordinates by pasting its cached stamp, clipped to the image
+#   offset shifts the shape, as in drawShape
+def pasteShape(im, shape, center, data, color, thickness, offset=(0,0)):
+    dx, dy, stamp = cachedShapeStamp(shape, data, thickness)
+    x, y, stamp = clipStamp(int(center[0])+dx+int(offset[0]), int(center[1])+dy+int(offset[1]), stamp, im.shape)
+    im[y:y+stamp.shape[0], x:x+stamp.shape[1]][stamp>0] = color
+
+
+
+
+#####Presets#####
+
+
+#Reads the array of presets saved by the Analysis window
+def loadPresets(presetPath=PRESET_PATH):
+    return np.load(presetPath)
+
+
+#Returns the preset with the given name as a dictionary of preset variables
+#   Variables missing from presets saved by older versions keep their default values
+def getPreset(presetName, presetPath=PRESET_PATH):
+    presetArray = loadPresets(presetPath)
+    rows = presetArray[presetArray['PresetName']==presetName]
+    if len(rows)==0:
+        raise KeyError(f"Preset {presetName} not found in {presetPath}")
+
+    preset = dict(DEFAULT_PRESET)
+    for name in rows.dtype.names:
+        if name.startswith('V_'):
+            val = rows[0][name].item()
+            #Keeping the same python type as the default (numpy stores booleans and strings its own way)
+            if name in DEFAULT_PRESET:
+                val = type(DEFAULT_PRESET[name])(val)
+            preset[name] = val
+    return preset
+
+
+#Converts an array of presets to a new set of fields, so that presets saved by
+#   an older version can be stored alongside presets with new variables
+#   Numeric variables missing from the old presets are marked invalid
+def conformPresets(presetArray, dtype):
+    if presetArray.dtype==dtype:
+        return presetArray
+
+    conformed = np.zeros(len(presetArray), dtype=dtype)
+    for name in dtype.names:
+        if name in presetArray.dtype.names:
+            conformed[name] = presetArray[name]
+        elif conformed[name].dtype.kind in 'iuf':
+            conformed[name] = INVALID_PRESET_NUM
+    return conformed
+
+
+#Returns the zone refinement stored in a preset as (shape, displace_x, displace_y, data),
+#   with data organized as in drawShape, or None if the preset has no refinement
+def presetRefinement(preset):
+    shape = preset['V_refiner_shape']
+    dx = preset['V_refiner_displace_x']
+    dy = preset['V_refiner_displace_y']
+    if dx==INVALID_PRESET_NUM or dy==INVALID_PRESET_NUM:
+        return None
+
+    if shape=='circle' and preset['V_refiner_radius']!=INVALID_PRESET_NUM:
+        data = [[preset['V_refiner_radius']]]
+    elif shape=='rectangle' and INVALID_PRESET_NUM not in (preset['V_refiner_width'], preset['V_refiner_height']):
+        data = [[preset['V_refiner_width'], preset['V_refiner_height']]]
+    elif shape=='polygon' and INVALID_PRESET_NUM not in (preset['V_refiner_sides'], preset['V_refiner_radius'], preset['V_refiner_angle']):
+        data = [preset['V_refiner_sides'], preset['V_refiner_angle'], [preset['V_refiner_radius']]]
+    else:
+        return None
+
+    return shape, dx, dy, data
+
+
+#Returns the preset variables that store a zone refinement (inverse of presetRefinement)
+def refinementPreset(shape, displace_x, displace_y, data):
+    preset = {'V_refiner_shape': shape,
+              'V_refiner_displace_x': int(displace_x),
+              'V_refiner_displace_y': int(displace_y),
+              'V_refiner_radius': INVALID_PRESET_NUM,
+              'V_refiner_width': INVALID_PRESET_NUM,
+              'V_refiner_height': INVALID_PRESET_NUM,
+              'V_refiner_sides': INVALID_PRESET_NUM,
+              'V_refiner_angle': float(INVALID_PRESET_NUM)}
+    if shape=='circle':
+        preset['V_refiner_radius'] = int(data[0][0])
+    elif shape=='rectangle':
+        preset['V_refiner_width'] = int(data[0][0])
+        preset['V_refiner_height'] = int(data[0][1])
+    elif shape=='polygon':
+        preset['V_refiner_sides'] = int(data[0])
+        preset['V_refiner_angle'] = float(data[1])
+        preset['V_refiner_radius'] = int(data[2][0])
+    return preset
+
+
+
+
+#####Analysis steps#####
+
+
+#Reads an image from a file, raising an error if it can't be read as an image
+def readImage(filePath):
+    im = cv2.imread(filePath)
+    if im is None:
+        raise ValueError(f"Could not read {filePath} as an image")
+    return im
+
+
+#Converts an image with a cv2.cvtColor code, or returns it as it is if the code is None (or the image is empty)
+def convertColors(im, code):
+    if code is None or im.size==0:
+        return im
+    return cv2.cvtColor(im, code)
+
+
+#Converts an image only inside the given boxes (x0, y0, x1, y1), for images that are only read inside those boxes
+#   The rest of the result is left 0
+def convertBoxes(im, code, boxes):
+    converted = np.zeros_like(im)
+    for x0, y0, x1, y1 in boxes:
+        converted[y0:y1, x0:x1] = convertColors(im[y0:y1, x0:x1], code)
+    return converted
+
+
+#Converts a BGR image to HSV a strip of rows at a time, keeping only the saturation and value (all the mask uses),
+#   so that neither the hue nor a whole HSV copy of the image is ever kept
+#Returns the saturation and value as an array of shape (h, w, 2)
+def saturationValue(im):
+    sv = np.empty(im.shape[:2]+(2,), dtype=np.uint8)
+    for y in range(0, im.shape[0], CONVERSION_STRIP_ROWS):
+        sv[y:y+CONVERSION_STRIP_ROWS] = cv2.cvtColor(im[y:y+CONVERSION_STRIP_ROWS], cv2.COLOR_BGR2HSV)[:,:,1:]
+    return sv
+
+
+#Applies a thresholding mask to the saturation and value of an image (see saturationValue)
+#   thresh1 is the value (brightness) threshold, thresh2 the saturation threshold
+#   maskMode 0 ANDs the two thresholds, maskMode 1 ORs them
+def thresholdMask(imSV, thresh1, thresh2, maskMode=0):
+    vmin = int(np.clip(int(thresh1),0,255))
+    smin = int(np.clip(int(thresh2),0,255))
+
+    #Masking for saturation and value
+    svMin_s = np.array([smin,0])
+    svMin_v = np.array([0,vmin])
+    svMax = np.array([255,255])
+
+    #The default mode is to AND the masks
+    if maskMode==0:
+        return cv2.inRange(imSV, svMin_s+svMin_v, svMax)
+
+    #There is an option to OR them instead (slightly slower)
+    mask_s = cv2.inRange(imSV, svMin_s, svMax)
+    mask_v = cv2.inRange(imSV, svMin_v, svMax)
+    return np.array(np.logical_or(mask_s, mask_v)*255, dtype=np.uint8)
+
+
+#Compiles a dilate/erode code into a short list of (operation, iterations) steps
+#   Argument: code is a string of ['e','d'] of arbitrary length to indicate the
+#   order in which the user has pressed the Dilate and Erode buttons
+#   Runs of the same letter become one step with that many iterations, and a run of erosions followed by
+#   as many dilations becomes an opening (a closing the other way around), e.g. 'dddddeeeee' -> [('close', 5)]
+def compileDilateErode(code):
+
+    #Collapsing runs of the same operation
+    runs = []
+    for c in code:
+        if c not in 'de':
+            continue
+        op = 'dilate' if c=='d' else 'erode'
+        if len(runs)>0 and runs[-1][0]==op:
+            runs[-1][1] += 1
+        else:
+            runs.append([op, 1])
+
+    #Pairing equal runs into openings and closings
+    plan = []
+    i = 0
+    while i<len(runs):
+        op, n = runs[i]
+        if i+1<len(runs) and runs[i+1][1]==n:
+            plan.append(('open' if op=='erode' else 'close', n))
+            i += 2
+        else:
+            plan.append((op, n))
+            i += 1
+    return plan
+
+
+#Applies a compiled dilate/erode plan to a mask
+#   Each step is one OpenCV call; for a rectangular kernel OpenCV turns the iterations into a single pass
+#   with a larger kernel, so a run of presses costs about as much as one
+def applyMorphologyPlan(mask, plan, kernel=DILERO_KERNEL):
+    for op, n in plan:
+        mask = cv2.morphologyEx(mask, MORPH_OPS[op], kernel, iterations=n)
+    return mask
+
+
+#Applies a series of dilations and erosions to the mask depending on the code
+#   (gives the same mask as dilating or eroding once per letter, in far fewer passes)
+def dilateErode(mask, code, kernel=DILERO_KERNEL):
+    return applyMorphologyPlan(mask, compileDilateErode(code), kernel)
+
+
+#Applies a blurring filter to the mask
+def blurMask(mask, blurAmount):
+    blur = int(np.clip(int(blurAmount),0,10))
+    return cv2.blur(mask, (blur, blur))
+
+
+#Returns how many pixels away the dilations/erosions of the code and the blur can reach,
+#   i.e. the margin a part of the image needs around it for its mask to come out the same as in the whole image
+#   Each iteration of the kernel reaches at most its size less one, and an opening or closing is two passes
+def maskHalo(code, blurAmount, kernel=DILERO_KERNEL):
+    passes = sum(2*n if op in ('open', 'close') else n for op, n in compileDilateErode(code))
+    return passes*(max(kernel.shape)-1)+int(np.clip(int(blurAmount),0,10))//2
+
+
+#Computes the mask (thresholded, dilated/eroded and blurred) of one box (x0, y0, x1, y1) of an image
+#   The box is processed with a margin of halo pixels around it (see maskHalo) which is then cut off again,
+#   so the mask is exactly that part of the mask of the whole image
+def tileMask(im, box, halo, thresh1, thresh2, maskMode, code, blurAmount):
+    x0, y0, x1, y1 = box
+    h, w = im.shape[:2]
+    left, top = max(0, x0-halo), max(0, y0-halo)
+    window = im[top:min(h, y1+halo), left:min(w, x1+halo)]
+
+    mask = thresholdMask(cv2.cvtColor(window, cv2.COLOR_BGR2HSV)[:,:,1:], thresh1, thresh2, maskMode)
+    mask = blurMask(dilateErode(mask, code), blurAmount)
+    return mask[y0-top:y1-top, x0-left:x1-left]
+
+
+#Detects contours in a mask, in one of the CONTOUR_MODES
+#Returns the contours sorted by size ascending (as a ContourStore, or a ComponentStore in components mode),
+#   and their sizes
+def findContours(mask, mode='tree'):
+
+    #Labels the blobs in the image, measuring all of them in one pass
+    if mode=='components':
+        contours = ComponentStore.fromMask(mask)
+
+    #Finds contours in the image
+    else:
+        res = cv2.findContours(mask, cv2.RETR_EXTERNAL if mode=='external' else cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
+
+        #The return values of findContours changed between versions 3 and 4
+        if cv2.__version__.startswith('3'):
+            contours = ContourStore.fromList(res[1])
+        else:
+            contours = ContourStore.fromList(res[0])
+
+    return contoursBySize(contours)
+
+
+#Sorts contours (a ContourStore or one of the component stores) by size ascending, leaving out the tiny ones
+#Returns the sorted contours and their sizes
+def contoursBySize(contours):
+
+    #Finding and storing the size of all the contours
+    sizes = contours.areas()
+
+    #Sorting the contours by size ascending
+    bysize = np.argsort(sizes)
+    #We only want to consider the reasonably sized contours, so I arbitrarily picked the ones
+    #   with an area above 5 pixels --- this may cause problems.
+    bysize = bysize[sizes[bysize]>5]
+
+    return contours[bysize].compact(), sizes[bysize]
+
+
+#Finds the blobs of the mask of an image (see tileMask) by connected-component labeling, one tile at a time,
+#   so that only one tile of the mask and its labels is held at once
+#   Each blob found in a tile is measured (pixel count, bounding box and the sums of its pixel coordinates),
+#   and the labels along the tile's edges are kept; blobs that touch across a seam between tiles (8-connected,
+#   diagonally too, like within one label image) are then merged, adding up their measurements
+#Returns a TiledComponentStore of the blobs, in the order their first tile was labeled
+def findTiledComponents(im, thresh1, thresh2, maskMode, code, blurAmount, tileSize=TILE_SIZE):
+    h, w = im.shape[:2]
+    halo = maskHalo(code, blurAmount)
+    maskOf = lambda box: tileMask(im, box, halo, thresh1, thresh2, maskMode, code, blurAmount)
+
+    #The labels on either side of each seam: the rows above and below each seam between rows of tiles,
+    #   and the columns left and right of each seam between columns of tiles
+    seamRows = {y: (np.zeros(w, dtype=np.int32), np.zeros(w, dtype=np.int32)) for y in range(tileSize, h, tileSize)}
+    seamCols = {x: (np.zeros(h, dtype=np.int32), np.zeros(h, dtype=np.int32)) for x in range(tileSize, w, tileSize)}
+
+    #The stats (x, y, w, h, area) and coordinate sums of the blobs of every tile, numbered from 1 across the tiles
+    tileStats, tileSums = [np.zeros((0, 5), dtype=np.int64)], [np.zeros((0, 2))]
+    nLabels = 1
+    for y0 in range(0, h, tileSize):
+        for x0 in range(0, w, tileSize):
+            y1, x1 = min(h, y0+tileSize), min(w, x0+tileSize)
+            n, labels, stats, centers = cv2.connectedComponentsWithStats(maskOf((x0, y0, x1, y1)), connectivity=8, ltype=cv2.CV_32S)
+
+            #Numbering the blobs of this tile after those of the tiles before it
+            offset = nLabels-1
+            numbered = lambda edge: np.where(edge>0, edge+offset, 0)
+            if y0 in seamRows:
+                seamRows[y0][1][x0:x1] = numbered(labels[0])
+            if y1 in seamRows:
+                seamRows[y1][0][x0:x1] = numbered(labels[-1])
+            if x0 in seamCols:
+                seamCols[x0][1][y0:y1] = numbered(labels[:,0])
+            if x1 in seamCols:
+                seamCols[x1][0][y0:y1] = numbered(labels[:,-1])
+
+            stats = stats[1:].astype(np.int64)
+            stats[:,:2] += (x0, y0)
+            areas = stats[:,4:]
+
+            #The coordinate sums are integers, recovered exactly from the centroids (each a sum divided by the area)
+            tileStats.append(stats)
+            tileSums.append(np.rint(centers[1:]*areas)+np.array([x0, y0])*areas)
+            nLabels += n-1
+
+    stats, sums = np.concatenate(tileStats), np.concatenate(tileSums)
+
+    #Pairs of labels touching across a seam, straight across or diagonally
+    pairs = [np.zeros((0, 2), dtype=np.int32)]
+    for before, after in list(seamRows.values())+list(seamCols.values()):
+        for shift in (-1, 0, 1):
+            a = before[max(0, -shift):len(before)-max(0, shift)]
+            b = after[max(0, shift):len(after)-max(0, -shift)]
+            touching = (a>0) & (b>0)
+            pairs.append(np.column_stack((a[touching], b[touching])))
+    roots = mergeLabels(nLabels, np.unique(np.concatenate(pairs), axis=0))
+
+    #Adding up the measurements of the parts of each blob (label 0 staying the background)
+    blobIds, blobOf = np.unique(roots, return_inverse=True)
+    blobOf = blobOf[1:]
+    nBlobs = len(blobIds)
+    areas = np.bincount(blobOf, weights=stats[:,4], minlength=nBlobs)
+    left, top = np.full(nBlobs, w), np.full(nBlobs, h)
+    right, bottom = np.zeros(nBlobs, dtype=np.int64), np.zeros(nBlobs, dtype=np.int64)
+    np.minimum.at(left, blobOf, stats[:,0])
+    np.minimum.at(top, blobOf, stats[:,1])
+    np.maximum.at(right, blobOf, stats[:,0]+stats[:,2])
+    np.maximum.at(bottom, blobOf, stats[:,1]+stats[:,3])
+
+    blobStats = np.column_stack((left, top, right-left, bottom-top, areas)).astype(np.int64)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        blobCenters = np.column_stack((np.bincount(blobOf, weights=sums[:,0], minlength=nBlobs),
+                                       np.bincount(blobOf, weights=sums[:,1], minlength=nBlobs)))/areas[:,None]
+
+    return TiledComponentStore(maskOf, blobStats, blobCenters, np.arange(1, nBlobs))
+
+
+#Merges labels 0 to n-1 that are joined by pairs (an array of shape (pairs, 2)) into groups
+#   This is a union-find done with array operations over all the pairs at once, since a noisy scan can have millions:
+#   each round, the larger root of every pair still split between two groups is pointed at the smaller one,
+#   then every label is pointed straight at its root, until no pair is split
+#Returns the smallest label of each label's group
+def mergeLabels(n, pairs):
+    roots = np.arange(n)
+    a, b = pairs[:,0], pairs[:,1]
+    while True:
+        rootA, rootB = roots[a], roots[b]
+        split = rootA!=rootB
+        if not split.any():
+            return roots
+        a, b, rootA, rootB = a[split], b[split], rootA[split], rootB[split]
+
+        np.minimum.at(roots, np.maximum(rootA, rootB), np.minimum(rootA, rootB))
+        while True:
+            jumped = roots[roots]
+            if np.array_equal(jumped, roots):
+                break
+            roots = jumped
+
+
+#Builds a hit-test index of the contours: an integer label image, 0 where no contour is and i+1 inside contour i
+#   The contours are filled largest first, so where contours nest each pixel ends up labeled with the smallest
+#   contour containing it, the same one a search through the contours by size ascending would find first
+#   Blobs found by connected-component labeling don't overlap, so their label image is used as it is
+def contourHitIndex(contours, shape):
+    if isinstance(contours, ComponentStore):
+        return contours.labelImage()
+
+    hits = np.zeros(shape, dtype=np.int32)
+    for i in range(len(contours)-1, -1, -1):
+        cv2.drawContours(hits, [contours[i]], -1, i+1, thickness=-1)
+    return hits
+
+
+#Computes the Hu moment invariants (and their log-scaled values, see logHuMoments), area, perimeter and
+#   bounding box (x, y, w, h) of every contour
+#   These only need computing once per set of contours, then similar contours can be found for any
+#   tolerance with array operations
+#Returns a structured array with one row per contour
+def contourFeatures(contours):
+    features = np.zeros(len(contours), dtype=CONTOUR_FEATURES_DTYPE)
+    for i in range(len(contours)):
+        features['hu'][i] = cv2.HuMoments(cv2.moments(contours[i])).ravel()
+        features['logHu'][i] = logHuMoments(features['hu'][i])
+        features['area'][i] = cv2.contourArea(contours[i])
+        features['perimeter'][i] = cv2.arcLength(contours[i], True)
+        features['bbox'][i] = cv2.boundingRect(contours[i])
+    return features
+
+
+#Log-scales Hu moments the way cv2.matchShapes does, keeping their sign
+#   This uses math.log10 like OpenCV does, since numpy's log10 can differ in the last digits,
+#   which would be enough to change which contours are within the shape tolerance
+def logHuMoments(hu):
+    return np.array([(1 if h>0 else -1)*math.log10(abs(h)) if h!=0 else 0 for h in hu])
+
+
+#Scores how different each shape is from a reference shape from their Hu moments, for all the shapes at once
+#   This is the CONTOURS_MATCH_I3 score of cv2.matchShapes(shape, reference): the greatest relative difference
+#   of the log-scaled invariants, only counting the invariants above 1e-5 in both shapes
+#   See https://docs.opencv.org/3.1.0/d3/dc0/group__imgproc__shape.html#gaadc90cb16e2362c9bd6e7363e6e4c317
+#   for more information
+def shapeMatchScores(hu, logHu, refHu, refLogHu):
+    hu = np.asarray(hu).reshape(-1, 7)
+    logHu = np.asarray(logHu).reshape(-1, 7)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        differences = np.abs((logHu-refLogHu)/logHu)
+
+    #matchShapes skips the invariants that are too small, and its maximum never picks up a NaN
+    counted = (np.abs(hu)>1e-5) & (np.abs(refHu)>1e-5) & ~np.isnan(differences)
+    scores = np.max(np.where(counted, differences, 0), axis=1, initial=0)
+
+    #OpenCV 4 gives the largest possible score when only one of the shapes has any nonzero invariant
+    if not cv2.__version__.startswith('3'):
+        scores[np.any(hu!=0, axis=1)!=np.any(refHu!=0)] = np.finfo(np.float64).max
+    return scores
+
+
+#Finds the indices of the contours that have a size and shape within a certain tolerance of the selected contour
+#   sizeTol is in percent, shapeTol is the maximum CONTOURS_MATCH_I3 score
+#   features (see contourFeatures) can be given to reuse the Hu moments, otherwise they are computed for the
+#   contours of the right size
+def similarContours(contours, sizes, selectedCont, sizeTol, shapeTol, features=None):
+
+    #First eliminates contours by size
+    closeInds = np.where(np.isclose(sizes, sizes[selectedCont], rtol=sizeTol/100))[0]
+
+    #Finds the shape-match score for each contour compared to the reference
+    if features is None:
+        features = contourFeatures([contours[selectedCont]]+[contours[ind] for ind in closeInds])
+        ref, candidates = features[0], features[1:]
+    else:
+        ref, candidates = features[selectedCont], features[closeInds]
+    scores = shapeMatchScores(candidates['hu'], candidates['logHu'], ref['hu'], ref['logHu'])
+    doesMatch = scores<shapeTol #boolean array of where the shapes do match within tolerance
+    return closeInds[doesMatch]
+
+
+#Picks the reference contour without a user click
+#   If the preset stores the area of the contour the user selected, the contour closest in area is used,
+#   otherwise the contour with the most other contours within the size tolerance is used
+def findReferenceContour(sizes, referenceArea, sizeTol):
+    if referenceArea!=INVALID_PRESET_NUM:
+        return int(np.argmin(np.abs(sizes-referenceArea)))
+
+    #sizes are sorted ascending, so the contours within tolerance of each size can be counted by bisection
+    rtol = sizeTol/100
+    counts = np.searchsorted(sizes, sizes*(1+rtol), side='right')-np.searchsorted(sizes, sizes*(1-rtol), side='left')
+
+    #Ties go to the largest contour
+    return int(len(sizes)-1-np.argmax(counts[::-1]))
+
+
+#Returns the average color and standard deviation of an image,
+#   if a mask is given returns the average color of the masked area
+def getAvColor(im, mask=None):
+    if mask is not None:
+        mask3D = np.concatenate(([mask],[mask],[mask])).transpose((1,2,0))/255 #triplicating the mask values for RGB etc.
+        immasked = np.ma.MaskedArray(im, mask=1-mask3D)
+        avcolor = np.ma.mean(immasked, axis=(0,1))
+        std = np.ma.std(immasked, axis=(0,1)) #standard deviation
+
+    else:
+        avcolor = np.average(np.average(im, axis=0), axis=0)
+        std = np.std(im, axis=(0,1))
+
+    return avcolor, std
+
+
+#Draws a filled contour into a mask just big enough to hold it
+#Returns (x, y, stamp), where the stamp covers the image region [y:y+h, x:x+w]
+def contourStamp(cont):
+    x, y, w, h = cv2.boundingRect(cont)
+    stamp = np.zeros((h, w), dtype=np.uint8)
+    cv2.drawContours(stamp, [cont], -1, 255, thickness=-1, offset=(-x, -y))
+    return x, y, stamp
+
+
+#Returns the mask of a filled shape (see drawShape) centered at integer coordinates, clipped to an image of the given shape
+#   The mask is the shape's cached stamp (see cachedShapeStamp), so it is shared and read-only
+#Returns (x, y, stamp), where the stamp covers the image region [y:y+h, x:x+w]
+def shapeStamp(shape, center, data, imShape):
+    dx, dy, stamp = cachedShapeStamp(shape, data, -1)
+    return clipStamp(int(center[0])+dx, int(center[1])+dy, stamp, imShape)
+
+
+#Rasterizes zones given as (x, y, stamp) into one integer label image, 0 for background and i+1 for zone i
+#   A pixel can only have one label, so zones that overlap another zone are also returned, as a sorted list
+def zoneLabelImage(shape, stamps):
+    labels = np.zeros(shape, dtype=np.int32)
+    overlapping = set()
+    for i in range(len(stamps)):
+        x, y, stamp = stamps[i]
+        h, w = stamp.shape
+        region = labels[y:y+h, x:x+w]
+        inZone = stamp>0
+
+        #Checking whether an earlier zone already claimed any of these pixels
+        hit = region[inZone]
+        hit = hit[hit>0]
+        if len(hit)>0:
+            overlapping.add(i)
+            overlapping.update(np.unique(hit)-1)
+
+        region[inZone] = i+1
+    return labels, sorted(overlapping)
+
+
+#Computes the pixel count, average color and standard deviation of every zone of a label image at once
+#   im is a BGR image, measured in the colorspace of each conversion (cv2.cvtColor codes, None for BGR itself),
+#   the channels of which are stacked in the results
+#   Only the labeled pixels are gathered, then the sums per zone are taken with bincount
+#   (the deviations are summed in a second pass, like a masked-array std, rather than from the sum of squares)
+#Returns counts (n,), means (n, 3*len(conversions)) and standard deviations (n, 3*len(conversions))
+def zoneStatistics(labels, nZones, im, conversions=(None,)):
+    inZones = np.flatnonzero(labels)
+    zoneOf = labels.ravel()[inZones]
+    pixels = im.reshape(-1, 3)[inZones]
+
+    counts = np.bincount(zoneOf, minlength=nZones+1)[1:]
+    means = np.zeros((nZones, 3*len(conversions)))
+    stds = np.zeros((nZones, 3*len(conversions)))
+
+    for k in range(len(conversions)):
+        #Colors are converted pixel by pixel, so only the gathered pixels need converting
+        values = convertColors(pixels.reshape(-1, 1, 3), conversions[k]).reshape(-1, 3).astype(np.float64)
+        for c in range(3):
+            sums = np.bincount(zoneOf, weights=values[:,c], minlength=nZones+1)[1:]
+
+            #The sums of integer pixel values are exact in float64, so the means match a masked-array mean
+            with np.errstate(invalid='ignore', divide='ignore'):
+                mean = sums/counts
+                deviations = values[:,c]-np.concatenate(([0], mean))[zoneOf]
+                variance = np.bincount(zoneOf, weights=deviations**2, minlength=nZones+1)[1:]/counts
+            means[:, 3*k+c] = mean
+            stds[:, 3*k+c] = np.sqrt(variance)
+
+    return counts, means, stds
+
+
+#Computes the histograms of every zone of a label image at once (8-bit), for each channel of the image
+#   Like zoneStatistics, only the labeled pixels are gathered, then every zone, channel and value gets its own bin
+#   of one bincount
+#Returns counts (nZones, channels, 256)
+def zoneHistograms(labels, nZones, im):
+    inZones = np.flatnonzero(labels)
+    channels = im.shape[-1]
+
+    values = im.reshape(-1, channels)[inZones].astype(np.intp)+np.arange(channels)*256
+    values += ((labels.ravel()[inZones].astype(np.intp)-1)*channels*256)[:,None]
+    return np.bincount(values.ravel(), minlength=nZones*channels*256).reshape(nZones, channels, 256)
+
+
+#Finds the pixels covered by filled rectangles (data as in drawShape) centered at integer points, clipped to an image
+#   of the given shape, rounding the corners the same way as the rectangle's stamp (see cachedShapeStamp)
+#Returns an array of (x0, y0, x1, y1) per rectangle, the rectangle covering the image region [y0:y1, x0:x1]
+def rectangleBounds(centers, data, imShape):
+    half = np.array([data[0][0]/2, data[0][1]/2])
+    topLeft = np.asarray(centers, dtype=int)+np.floor(-half).astype(int)
+    bottomRight = np.asarray(centers, dtype=int)+np.floor(half).astype(int)+1
+    x0 = np.clip(topLeft[:,0], 0, imShape[1])
+    y0 = np.clip(topLeft[:,1], 0, imShape[0])
+    x1 = np.maximum(np.clip(bottomRight[:,0], 0, imShape[1]), x0)
+    y1 = np.maximum(np.clip(bottomRight[:,1], 0, imShape[0]), y0)
+    return np.column_stack((x0, y0, x1, y1))
+
+
+#Computes the pixel count, average color and standard deviation of rectangular zones (see rectangleBounds)
+#   from summed-area tables of each image, so each zone takes four lookups whatever its size
+#   The tables (sum and squared sum, from cv2.integral2) only cover the box holding all the zones, and are made
+#   one channel at a time to keep their memory down (two float64 tables of the box)
+#   The sums of integer pixel values are exact in float64, so the variances are computed from them exactly
+#   in integers rather than by subtracting two rounded numbers
+#Returns counts (n,), means (n, 3*len(conversions)) and standard deviations (n, 3*len(conversions)),
+#   with the colorspaces given as in zoneStatistics
+def rectangleStatistics(bounds, im, conversions=(None,)):
+    nZones = len(bounds)
+    means = np.zeros((nZones, 3*len(conversions)))
+    stds = np.zeros((nZones, 3*len(conversions)))
+    if nZones==0:
+        return np.zeros(0, dtype=np.int64), means, stds
+
+    #Making the zones relative to the box holding all of them
+    left, top = bounds[:,0].min(), bounds[:,1].min()
+    right, bottom = bounds[:,2].max(), bounds[:,3].max()
+    x0, y0, x1, y1 = (bounds-np.array([left, top, left, top])).T
+    counts = (x1-x0)*(y1-y0)
+    box = im[top:bottom, left:right]
+
+    for k in range(len(conversions)):
+        #Only the pixels inside the rectangles are converted, since nothing else in the box is summed
+        converted = box if conversions[k] is None else convertBoxes(box, conversions[k], np.column_stack((x0, y0, x1, y1)))
+        for c in range(3):
+            channel = np.ascontiguousarray(converted[:, :, c])
+            sumTable, squareTable = cv2.integral2(channel, sdepth=cv2.CV_64F, sqdepth=cv2.CV_64F)
+
+            #The sum over each rectangle, from the table at its four corners
+            sums = sumTable[y1,x1]-sumTable[y0,x1]-sumTable[y1,x0]+sumTable[y0,x0]
+            squares = squareTable[y1,x1]-squareTable[y0,x1]-squareTable[y1,x0]+squareTable[y0,x0]
+
+            means[:, 3*k+c], stds[:, 3*k+c] = sumStatistics(counts, sums, squares)
+
+    return counts, means, stds
+
+
+#Computes the average color and standard deviation of every zone of stamps that are all the same shape
+#   (see cachedShapeStamp) centered at integer points, gathering the pixels of each zone straight from the images
+#   Nothing the size of the image is made, so this is quick enough to redo for every change of the shape,
+#   and zones can overlap each other or run off the image
+#   maxGather limits how many pixels are gathered at once
+#Returns counts (n,), means (n, 3*len(ims)) and standard deviations (n, 3*len(ims)), as zoneStatistics does
+def stampStatistics(stamp, centers, ims, maxGather=2**20):
+    dx, dy, mask = stamp
+    ys, xs = np.nonzero(mask)
+    xs, ys = (xs+dx).astype(np.intp), (ys+dy).astype(np.intp)
+    h, w = ims[0].shape[:2]
+
+    #Pixel indices are pointer-sized, since the scans analyzed a tile at a time can have 2^31 pixels or more
+    centers = np.asarray(centers, dtype=np.intp).reshape(-1, 2)
+    counts = np.zeros(len(centers), dtype=np.int64)
+    means = np.zeros((len(centers), 3*len(ims)))
+    stds = np.zeros((len(centers), 3*len(ims)))
+
+    chunk = max(1, maxGather//max(len(xs), 1))
+    for start in range(0, len(centers), chunk):
+        zones = slice(start, start+chunk)
+        x = centers[zones, 0, None]+xs
+        y = centers[zones, 1, None]+ys
+        inside = (x>=0) & (x<w) & (y>=0) & (y<h)
+        pixels = np.where(inside, y*w+x, 0)
+        counts[zones] = inside.sum(axis=1)
+
+        for k in range(len(ims)):
+            values = np.take(ims[k].reshape(-1, 3), pixels, axis=0).astype(np.float64)
+            values[~inside] = 0
+
+            #Summing with matrix products, which are much faster than sums over the middle axis
+            #   (the sums of integer pixel values are exact in float64)
+            sums = np.matmul(np.ones(values.shape[1]), values)
+            squares = np.einsum('zpc,zpc->zc', values, values)
+            for c in range(3):
+                means[zones, 3*k+c], stds[zones, 3*k+c] = sumStatistics(counts[zones], sums[:,c], squares[:,c])
+
+    return counts, means, stds
+
+
+#Computes the means and standard deviations of zones from the pixel count, sum and sum of squares of each,
+#   all of which are integers (held in integer or float arrays)
+#   n^2 variance = n (sum of squares) - sum^2 can overflow 64-bit integers, so it is taken in python integers,
+#   which is exact (dividing python integers rounds correctly) rather than subtracting two rounded numbers
+#Returns means (n,) and standard deviations (n,), NaN for zones without pixels
+def sumStatistics(counts, sums, squares):
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = np.asarray(sums, dtype=np.float64)/counts
+    stds = np.array([math.sqrt((n*square-total**2)/n**2) if n>0 else np.nan for n, total, square in
+                     zip(np.asarray(counts).tolist(), np.asarray(sums).astype(np.int64).tolist(), np.asarray(squares).astype(np.int64).tolist())])
+    return means, stds
+
+
+#Computes the pixel count, average color and standard deviation of zones given as (x, y, stamp), one tile of the image
+#   at a time: the pixels of each zone within a tile are gathered, converted and summed, and the sums added up
+#   over the tiles, so only one tile's worth of pixels is ever gathered
+#   Each zone is summed on its own, so zones can overlap, and the sums are exact integers (see sumStatistics),
+#   so the results don't depend on the tiles
+#Returns counts (n,), means (n, 3*len(conversions)) and standard deviations (n, 3*len(conversions)),
+#   with the colorspaces given as in zoneStatistics
+def tiledZoneStatistics(stamps, im, conversions=(None,), tileSize=TILE_SIZE):
+    h, w = im.shape[:2]
+    counts = np.zeros(len(stamps), dtype=np.int64)
+    sums = np.zeros((len(stamps), 3*len(conversions)), dtype=np.int64)
+    squares = np.zeros((len(stamps), 3*len(conversions)), dtype=np.int64)
+    boxes = np.array([(x, y, x+stamp.shape[1], y+stamp.shape[0]) for x, y, stamp in stamps], dtype=np.int64).reshape(-1, 4)
+
+    for y0 in range(0, h, tileSize):
+        for x0 in range(0, w, tileSize):
+            y1, x1 = y0+tileSize, x0+tileSize
+            inTile = np.flatnonzero((boxes[:,0]<x1) & (boxes[:,2]>x0) & (boxes[:,1]<y1) & (boxes[:,3]>y0))
+
+            for i in inTile:
+                #The part of the zone's box within the tile
+                x, y, stamp = stamps[i]
+                left, top = max(x, x0), max(y, y0)
+                right, bottom = min(boxes[i,2], x1), min(boxes[i,3], y1)
+                inZone = stamp[top-y:bottom-y, left-x:right-x]>0
+                pixels = im[top:bottom, left:right][inZone]
+                counts[i] += len(pixels)
+
+                for k in range(len(conversions)):
+                    values = convertColors(pixels.reshape(-1, 1, 3), conversions[k]).reshape(-1, 3).astype(np.int64)
+                    sums[i, 3*k:3*k+3] += values.sum(axis=0)
+                    squares[i, 3*k:3*k+3] += (values**2).sum(axis=0)
+
+    means = np.zeros(sums.shape)
+    stds = np.zeros(sums.shape)
+    for c in range(sums.shape[1]):
+        means[:,c], stds[:,c] = sumStatistics(counts, sums[:,c], squares[:,c])
+    return counts, means, stds
+
+
+#Computes the SHA-256 hash of a file, reading it a piece at a time
+#Returns the hash as a hex string
+def fileHash(filePath):
+    digest = hashlib.sha256()
+    with open(filePath, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+#Computes the key of each stage of analyzing an image file with a preset (see STAGE_SETTINGS)
+#   Each key hashes the previous stage's key with the stage's settings by name, numbers as floats (so 20 and 20.0 match)
+#   The outputs are saved next to the image, so the outputs key also covers where the image is
+#Returns a dictionary of stage -> key
+def stageKeys(filePath, imageHash, preset):
+    keys = {}
+    key = f"{RESULT_CACHE_VERSION}:{imageHash}"
+    for stage, names in STAGE_SETTINGS.items():
+        settings = {}
+        for name in names:
+            value = preset[name].item() if isinstance(preset[name], np.generic) else preset[name]
+            settings[name] = float(value) if isinstance(value, (int, float)) and not isinstance(value, bool) else value
+        if stage=='outputs':
+            settings['path'] = os.path.abspath(filePath)
+
+        key = hashlib.sha256((key+json.dumps(settings, sort_keys=True)).encode()).hexdigest()
+        keys[stage] = key
+    return keys
+
+
+#Analyzes an image file with a preset, reusing the stages of earlier analyses that are in the cache if one is given
+#   If the whole analysis is cached and its folder is still there, the image isn't even read
+#   If a tile size is given, the image is analyzed a tile at a time (see TiledAnalysis)
+#Returns the path of the analysis folder, and whether any stage of it was reused from the cache
+def analyzeFile(filePath, preset, cache=None, tileSize=None):
+    if tileSize is None:
+        makeAnalysis = lambda im: ColorAnalysis(im, filePath, preset)
+    else:
+        #A tiled analysis always finds its contours in components mode, so its stages are cached under that mode
+        preset = dict(preset, V_contourMode='components')
+        makeAnalysis = lambda im: TiledAnalysis(im, filePath, preset, tileSize)
+
+    if cache is None:
+        return makeAnalysis(readImage(filePath)).run(), False
+
+    keys = stageKeys(filePath, fileHash(filePath), dict(DEFAULT_PRESET, **preset))
+    outputs = cache.get('outputs', keys['outputs'])
+    if outputs is not None and os.path.isdir(str(outputs['analysisPath'])):
+        print(f"Reusing the analysis of {filePath} in {outputs['analysisPath']}")
+        return str(outputs['analysisPath']), True
+
+    analysis = makeAnalysis(readImage(filePath))
+    analysisPath = analysis.run(cache, keys)
+    return analysisPath, len(analysis.reusedStages)>0
+
+
+#Stores a preset as a one-row structured array, one typed field per setting, so it can be saved without pickling
+def presetRecord(preset):
+    values = [np.asarray(value) for value in preset.values()]
+    return np.array([tuple(values)], dtype=[(name, value.dtype) for name, value in zip(preset, values)])
+
+
+#Loads the results saved by an analysis (the _results.npz file)
+#Returns the results of the zones (see RESULTS_DTYPE) and the preset they were made with, as a dictionary
+def loadResults(path):
+    with np.load(path, allow_pickle=False) as results:
+        zones = results['zones']
+        preset = results['preset']
+    return zones, dict(zip(preset.dtype.names, preset[0].tolist()))
+
+
+#Lays out the results of the zones as the colors csv file, with the colorspaces given as keys of RESULTS_CHANNELS
+#   Every colorspace has its averages, then their standard deviations, then a blank column,
+#   and the areas are always last
+#Returns the header and the table of strings
+def resultsTable(zones, colorspaces):
+    #Can't be capitalized -- Excel interprets that weirdly
+    header = 'id'
+    columns = [zones['id'].astype(str)]
+    spacer = np.full(len(zones), '')
+
+    for colorspace in colorspaces:
+        channels = RESULTS_CHANNELS[colorspace]
+        header += ','+','.join(channels)+','+','.join('std '+name for name in channels)+','
+        columns += [zones[name].astype(str) for name in channels]
+        columns += [zones['std '+name].astype(str) for name in channels]
+        columns.append(spacer)
+
+    header += ',Area [pixels]'
+    columns.append(zones['Area [pixels]'].astype(str))
+    return header, np.column_stack(columns)
+
+
+#Makes a unique folder name for an analysis output next to the image, <name>_analysis_N
+def makeAnalysisFolder(filePath):
+    analysisPath = os.path.splitext(filePath)[0]+'_analysis'
+    foldernum = 0
+    analysisPathNum = analysisPath
+    while os.path.exists(analysisPathNum):
+        foldernum+=1
+        analysisPathNum = analysisPath+'_'+str(foldernum)
+    os.makedirs(analysisPathNum)
+    return analysisPathNum
+
+
+#Lists the images to analyze from a list of files and folders
+#   Folders are not searched recursively, so earlier _analysis outputs are not picked up
+def findImages(paths):
+    images = []
+    for path in paths:
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS:
+                    images.append(os.path.join(path, name))
+        else:
+            images.append(path)
+    return images
+
+
+
+
+#Encodes an image in the format given by the extension of path, exactly as cv2.imwrite would save it
+#Returns the bytes of the file
+def encodeImage(path, im):
+    ok, buf = cv2.imencode(os.path.splitext(path)[-1], im)
+    if not ok:
+        raise ValueError(f"Could not encode {path}")
+    return buf.tobytes()
+
+
+
+
+#Object: StageCache
+#Purpose: Keeps the results of the mask, dilate/erode, and blur steps keyed by the settings that made them,
+#   so that moving one slider only recomputes the steps after it
+#   The least recently used results are dropped once their total size goes over maxBytes
+class StageCache:
+
+    def __init__(self, maxBytes=STAGE_CACHE_BYTES):
+        self.maxBytes = maxBytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+
+        #The GUI computes the steps in a background thread
+        self.lock = threading.Lock()
+
+
+    #Returns the cached result for a key, or None if it isn't cached
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+
+    #Stores a result and returns it, made read-only since it will be shared by later lookups
+    def put(self, key, im):
+        im.flags.writeable = False
+        with self.lock:
+            if key in self.entries or im.nbytes>self.maxBytes:
+                return im
+
+            self.entries[key] = im
+            self.nbytes += im.nbytes
+
+            #Dropping the least recently used results until it fits the budget
+            while self.nbytes>self.maxBytes:
+                oldKey, oldIm = self.entries.popitem(last=False)
+                self.nbytes -= oldIm.nbytes
+        return im
+
+
+    #Drops every cached result
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+
+
+
+#Object: ResultCache
+#Purpose: Keeps the results of each stage of earlier analyses in a folder, keyed by stage and key (see stageKeys),
+#   so that analyzing an unchanged image again only recomputes the stages whose settings changed
+#   Each entry is an npz file of arrays, written to a temporary file first so that an entry is never half written,
+#   even with several processes sharing the folder
+#   The least recently used entries are deleted once the folder goes over maxBytes
+class ResultCache:
+
+    def __init__(self, path=RESULT_CACHE_PATH, maxBytes=RESULT_CACHE_BYTES):
+        self.path = path
+        self.maxBytes = maxBytes
+        os.makedirs(self.path, exist_ok=True)
+
+
+    #Returns the path of the entry of a stage
+    def entryPath(self, stage, key):
+        return os.path.join(self.path, f"{stage}_{key}.npz")
+
+
+    #Returns the arrays cached for a stage as a dictionary, or None if they aren't cached
+    def get(self, stage, key):
+        entryPath = self.entryPath(stage, key)
+        try:
+            with np.load(entryPath, allow_pickle=False) as entry:
+                arrays = dict(entry)
+
+            #Marking the entry as recently used
+            os.utime(entryPath)
+        except FileNotFoundError:
+            return None
+
+        #A damaged entry is dropped, to be computed again
+        except (OSError, ValueError, zipfile.BadZipFile):
+            self.remove(entryPath)
+            return None
+        return arrays
+
+
+    #Caches the arrays of a stage, then makes room for them if the cache is over its size
+    def put(self, stage, key, **arrays):
+        entryPath = self.entryPath(stage, key)
+        tempPath = f"{entryPath}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tempPath, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tempPath, entryPath)
+        self.evict()
+
+
+    #Deletes the least recently used entries until the cache fits in maxBytes
+    def evict(self):
+        entries = []
+        for entry in os.scandir(self.path):
+            if entry.name.endswith('.npz'):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for mtime, size, entryPath in entries)
+        for mtime, size, entryPath in sorted(entries):
+            if total<=self.maxBytes:
+                break
+            self.remove(entryPath)
+            total -= size
+
+
+    #Deletes an entry, unless another process already has
+    def remove(self, entryPath):
+        try:
+            os.remove(entryPath)
+        except FileNotFoundError:
+            pass
+
+
+
+
+#Object: OutputWriter
+#Purpose: Encodes and saves the output files of an analysis in a pool of background threads,
+#   so that saving overlaps with computing the next outputs
+#   At most maxPending files wait to be saved, requesting another one waits for a thread to be free
+#   Every file is flushed to disk (fsync) before close() returns, and close() raises the first error if a save failed
+class OutputWriter:
+
+    def __init__(self, threads=OUTPUT_THREADS, maxPending=OUTPUT_QUEUE, progress=None):
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+        self.slots = threading.BoundedSemaphore(maxPending)
+        self.futures = []
+        self.folders = set()
+
+        #Called as progress(saved, requested) after each file is saved (from the writer threads)
+        self.progress = progress
+        self.saved = 0
+        self.lock = threading.Lock()
+
+
+    #Requests a file to be saved by save(f, *args), f being the file opened for writing in binary mode
+    def write(self, path, save, *args):
+        self.slots.acquire()
+        self.folders.add(os.path.dirname(os.path.abspath(path)))
+        future = self.executor.submit(self.saveFile, path, save, *args)
+        self.futures.append(future)
+        future.add_done_callback(self.fileDone)
+
+
+    #Requests an image to be saved like cv2.imwrite, encoding it in the background
+    #   The image must not be changed until close(), since it is encoded later
+    def writeImage(self, path, im):
+        self.write(path, lambda f: f.write(encodeImage(path, im)))
+
+
+    #Saves one file (in a writer thread)
+    def saveFile(self, path, save, *args):
+        with open(path, 'wb') as f:
+            save(f, *args)
+            f.flush()
+            os.fsync(f.fileno())
+
+
+    #Frees the slot of a file once it is saved (or has failed) and reports the progress
+    def fileDone(self, future):
+        self.slots.release()
+        with self.lock:
+            self.saved += 1
+            saved = self.saved
+        if self.progress is not None:
+            self.progress(saved, len(self.futures))
+
+
+    #Waits for every requested file to be saved and flushed to disk
+    #Returns the number of files saved
+    def close(self):
+        self.executor.shutdown(wait=True)
+        for future in self.futures:
+            future.result()
+
+        #Flushing the folders as well, so the new files are listed in them on disk (folders can't be opened on Windows)
+        if hasattr(os, 'O_DIRECTORY'):
+            for folder in self.folders:
+                fd = os.open(folder, os.O_RDONLY | os.O_DIRECTORY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+        return len(self.futures)
+
+
+
+
+#Object: HistogramPlotter
+#Purpose: Draws png plots of histograms in a background thread, so the analysis doesn't wait on matplotlib
+#   One figure is drawn over and over (only the heights and title change), since making a figure per plot is slow
+#   Each plot is handed to an OutputWriter to be saved, in the order they are requested, and close() waits for all of them
+class HistogramPlotter:
+
+    def __init__(self, writer):
+        self.writer = writer
+
+        #A bare Figure rather than pyplot, so it works without a GUI and isn't kept by pyplot
+        self.fig = Figure()
+        FigureCanvasAgg(self.fig)
+        self.axis = self.fig.add_subplot(111)
+
+        self.axis.set_facecolor('xkcd:grey')
+        self.axis.set_xlim([0,256])
+        self.axis.set_xticks(np.linspace(0,256,9))
+        self.axis.set_xlabel("Intensity")
+        self.axis.set_ylabel("Counts")
+
+        #One step patch per channel, in the order they were drawn as bar charts
+        edges = np.linspace(0, 256, 257)
+        blank = np.zeros(256)
+        self.plots = [self.axis.stairs(blank, edges, fill=True, color=color, alpha=0.6) for color in ('blue', 'green', 'red')]
+
+        #A single thread, since the figure can only be drawn by one thread at a time
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.futures = []
+
+
+    #Requests a plot of the histograms of one zone, given as counts (3, 256) in BGR order
+    def plot(self, heights, title, path):
+        self.futures.append(self.executor.submit(self.draw, heights, title, path))
+
+
+    #Draws one plot and hands it to the writer (in the background thread)
+    def draw(self, heights, title, path):
+        for plot, channelHeights in zip(self.plots, heights):
+            plot.set_data(channelHeights)
+
+        #Leaving a little room above the tallest bin, as bar charts are scaled (an empty zone keeps a height of 1)
+        self.axis.set_ylim([0, 1.05*max(np.max(heights), 1)])
+        self.axis.set_title(title)
+
+        png = io.BytesIO()
+        self.fig.savefig(png, format='png')
+        self.writer.write(path, lambda f: f.write(png.getvalue()))
+
+
+    #Waits for every requested plot to be drawn, raising the first error if one failed
+    #   (the writer saves them)
+    def close(self):
+        self.executor.shutdown(wait=True)
+        for future in self.futures:
+            future.result()
+
+
+
+
+#Object: ContourStore
+#Purpose: Holds contours in two arrays instead of one array per contour: the points of every contour one after another
+#   (points, shaped (n, 1, 2) like OpenCV's contours) and where each contour starts in them (offsets)
+#   store[i] is contour i, as a view of the points, and indexing with a list, array or slice gives a store of just
+#   those contours which shares the same points, so the selection sets cost nothing to make
+#   A store can be passed to OpenCV functions that take a list of contours
+#   Areas, moments and bounding boxes are computed for all the contours at once
+class ContourStore:
+
+    def __init__(self, points, offsets, indices=None):
+        self.points = points
+        self.offsets = offsets
+
+        #The contours of the store, for stores made by indexing another store
+        self.indices = indices
+
+
+    #Makes a store from a list of contours, as returned by cv2.findContours
+    @classmethod
+    def fromList(cls, contourList):
+        lengths = np.array([len(contour) for contour in contourList], dtype=np.intp)
+        offsets = np.concatenate(([0], np.cumsum(lengths)))
+        if len(contourList)>0:
+            points = np.concatenate(contourList).astype(np.int32, copy=False).reshape(-1, 1, 2)
+        else:
+            points = np.zeros((0, 1, 2), dtype=np.int32)
+        return cls(points, offsets)
+
+
+    def __len__(self):
+        return len(self.offsets)-1 if self.indices is None else len(self.indices)
+
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            if self.indices is not None:
+                key = self.indices[key]
+            elif key<0:
+                key += len(self)
+            return self.points[self.offsets[key]:self.offsets[key+1]]
+
+        indices = np.arange(len(self.offsets)-1) if self.indices is None else self.indices
+        key = np.asarray(key) if not isinstance(key, slice) else key
+        if not isinstance(key, slice) and key.dtype!=bool:
+            key = key.astype(np.intp)
+        return ContourStore(self.points, self.offsets, indices[key])
+
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+    #Returns a store holding only this store's contours, in order, with its own points
+    def compact(self):
+        if self.indices is None:
+            return self
+        lengths = self.offsets[self.indices+1]-self.offsets[self.indices]
+        offsets = np.concatenate(([0], np.cumsum(lengths))).astype(np.intp)
+
+        #The index in self.points of every point to keep
+        pointInds = np.arange(offsets[-1])-np.repeat(offsets[:-1]-self.offsets[self.indices], lengths)
+        return ContourStore(self.points[pointInds], offsets)
+
+
+    #Returns a store of the same contours with their points replaced, e.g. converted to other coordinates
+    def withPoints(self, points):
+        return ContourStore(np.asarray(points, dtype=np.int32).reshape(-1, 1, 2), self.offsets, self.indices)
+
+
+    #Returns the x and y of every point, each point's previous point in its contour (the last point for the first),
+    #   and the index of the first point of each contour, for the sums over the edges of every contour
+    def edges(self):
+        store = self.compact()
+        x = store.points[:,0,0].astype(np.int64)
+        y = store.points[:,0,1].astype(np.int64)
+        starts = store.offsets[:-1]
+        prev = np.arange(len(x))-1
+        prev[starts] = store.offsets[1:]-1
+        return x, y, prev, starts
+
+
+    #Computes the area of every contour, as cv2.contourArea does
+    #   (summed exactly in integers, so the areas are the same to the last bit)
+    def areas(self):
+        if len(self)==0:
+            return np.zeros(0)
+        x, y, prev, starts = self.edges()
+        a00 = np.add.reduceat(x[prev]*y-x*y[prev], starts)
+        return np.abs(a00.astype(np.float64)*0.5)
+
+
+    #Computes the moments m00, m10 and m01 of every contour, as cv2.moments does
+    #Returns three arrays
+    def moments(self):
+        if len(self)==0:
+            return np.zeros(0), np.zeros(0), np.zeros(0)
+        x, y, prev, starts = self.edges()
+        dxy = x[prev]*y-x*y[prev]
+        a00 = np.add.reduceat(dxy, starts).astype(np.float64)
+        a10 = np.add.reduceat(dxy*(x[prev]+x), starts).astype(np.float64)
+        a01 = np.add.reduceat(dxy*(y[prev]+y), starts).astype(np.float64)
+
+        #OpenCV flips the sign for contours that go clockwise, and gives all zeros for contours without area
+        sign = np.where(a00>0, 1, -1)
+        valid = np.abs(a00)>np.finfo(np.float32).eps
+        m00 = np.where(valid, a00*(sign*0.5), 0)
+        m10 = np.where(valid, a10*(sign*0.16666666666666666666666666666667), 0)
+        m01 = np.where(valid, a01*(sign*0.16666666666666666666666666666667), 0)
+        return m00, m10, m01
+
+
+    #Computes the centroid (x, y) of every contour from its moments
+    #Returns an array of shape (contours, 2)
+    def centroids(self):
+        m00, m10, m01 = self.moments()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.column_stack((m10/m00, m01/m00))
+
+
+    #Computes the bounding box (x, y, w, h) of every contour, as cv2.boundingRect does
+    #Returns an array of shape (contours, 4)
+    def boundingRects(self):
+        if len(self)==0:
+            return np.zeros((0, 4), dtype=int)
+        store = self.compact()
+        starts = store.offsets[:-1]
+        xy = store.points[:,0,:]
+        low = np.minimum.reduceat(xy, starts)
+        high = np.maximum.reduceat(xy, starts)
+        return np.column_stack((low, high-low+1)).astype(int)
+
+
+    #Returns the outlines of the contours as a ContourStore, which these already are
+    def outlines(self):
+        return self
+
+
+
+
+#Object: ComponentStore
+#Purpose: Holds the blobs of a mask found by connected-component labeling (the components contour mode)
+#   The area, bounding box and centroid of every blob come from one cv2.connectedComponentsWithStats call,
+#   and a blob's outline is only traced, from its box of the label image, the first time it is needed
+#   Indexes like a ContourStore: store[i] is the outline of blob i, and indexing with a list, array or slice
+#   gives a store of just those blobs, sharing the labels and the outlines traced so far
+class ComponentStore:
+
+    def __init__(self, labels, stats, centers, labelIds, traced=None):
+        self.labels = labels
+        self.stats = stats
+        self.centers = centers
+
+        #The label of each blob of the store
+        self.labelIds = labelIds
+
+        #Outlines traced so far, by label
+        self.traced = {} if traced is None else traced
+
+
+    #Labels the blobs of a mask (8-connected, like the outlines of cv2.findContours)
+    @classmethod
+    def fromMask(cls, mask):
+        n, labels, stats, centers = cv2.connectedComponentsWithStats(mask, connectivity=8, ltype=cv2.CV_32S)
+
+        #Label 0 is the background
+        return cls(labels, stats, centers, np.arange(1, n))
+
+
+    def __len__(self):
+        return len(self.labelIds)
+
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            return self.outline(int(self.labelIds[key]))
+
+        key = np.asarray(key) if not isinstance(key, slice) else key
+        if not isinstance(key, slice) and key.dtype!=bool:
+            key = key.astype(np.intp)
+
+        #A shallow copy, so the store shares everything but its blobs (and keeps its type)
+        store = copy.copy(self)
+        store.labelIds = self.labelIds[key]
+        return store
+
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+    #Returns the outline of a blob, tracing it within the blob's bounding box if it hasn't been traced yet
+    def outline(self, label):
+        if label not in self.traced:
+            x, y, w, h = self.stats[label, :4]
+            blob = np.array(self.labels[y:y+h, x:x+w]==label, dtype=np.uint8)
+            res = cv2.findContours(blob, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE, offset=(int(x), int(y)))
+
+            #The return values of findContours changed between versions 3 and 4
+            outlines = res[1] if cv2.__version__.startswith('3') else res[0]
+
+            #A blob has one outer outline
+            self.traced[label] = max(outlines, key=len).astype(np.int32, copy=False)
+        return self.traced[label]
+
+
+    #The blobs are only ever viewed through their labels, so there is nothing to copy
+    def compact(self):
+        return self
+
+
+    #Returns the pixel count of every blob
+    def areas(self):
+        return self.stats[self.labelIds, cv2.CC_STAT_AREA].astype(np.float64)
+
+
+    #Returns the centroid (x, y) of the pixels of every blob, as an array of shape (blobs, 2)
+    def centroids(self):
+        return self.centers[self.labelIds]
+
+
+    #Returns the bounding box (x, y, w, h) of every blob, as an array of shape (blobs, 4)
+    def boundingRects(self):
+        return self.stats[self.labelIds, :4].astype(int)
+
+
+    #Traces the outlines of the blobs, returning them as a ContourStore
+    def outlines(self):
+        return ContourStore.fromList(list(self))
+
+
+    #Returns an integer label image, 0 where no blob is and i+1 on blob i (see contourHitIndex)
+    def labelImage(self):
+        lookup = np.zeros(len(self.stats), dtype=np.int32)
+        lookup[self.labelIds] = np.arange(1, len(self)+1)
+        return lookup[self.labels]
+
+
+
+
+#Object: TiledComponentStore
+#Purpose: Holds the blobs of a mask found one tile at a time (see findTiledComponents), without a label image
+#   The stats and centroids are indexed by label like those of a ComponentStore, label 0 being the background
+#   A blob's outline is traced from the mask of just its bounding box, recomputed from the image by maskOf
+#   (a function of a box (x0, y0, x1, y1), see tileMask), the first time it is needed
+class TiledComponentStore(ComponentStore):
+
+    def __init__(self, maskOf, stats, centers, labelIds, traced=None):
+        ComponentStore.__init__(self, None, stats, centers, labelIds, traced)
+        self.maskOf = maskOf
+
+
+    #Returns the outline of a blob, tracing it from the mask of its bounding box if it hasn't been traced yet
+    def outline(self, label):
+        if label not in self.traced:
+            x, y, w, h = (int(v) for v in self.stats[label, :4])
+            n, labels, stats, centers = cv2.connectedComponentsWithStats(self.maskOf((x, y, x+w, y+h)), connectivity=8, ltype=cv2.CV_32S)
+
+            #Other blobs can reach into the box, but only the blob itself spans all of it
+            #   (two blobs spanning the box would have to cross, and so touch)
+            spanning = 1+np.flatnonzero(np.all(stats[1:, :4]==(0, 0, w, h), axis=1))[0]
+            blob = np.array(labels==spanning, dtype=np.uint8)
+            res = cv2.findContours(blob, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE, offset=(x, y))
+
+            #The return values of findContours changed between versions 3 and 4
+            outlines = res[1] if cv2.__version__.startswith('3') else res[0]
+
+            #A blob has one outer outline
+            self.traced[label] = max(outlines, key=len).astype(np.int32, copy=False)
+        return self.traced[label]
+
+
+    #There is no label image of the whole mask to hit-test
+    def labelImage(self):
+        raise NotImplementedError("Blobs found a tile at a time have no label image")
+
+
+
+
+#Object: ColorAnalysis
+#Purpose: Holds an image and the results of each analysis step, with the settings taken from a preset
+#   AnalysisWindow extends this with the GUI, taking its settings from tkinter variables instead
+class ColorAnalysis:
+
+    def __init__(self, im, filePath, preset=None):
+
+        self.im = im
+
+        #Extracting the path, filename, and extension (outputs are named after the image)
+        self.filePath = filePath
+        self.ext = os.path.splitext(self.filePath)[-1]
+        self.filename = os.path.splitext(os.path.basename(self.filePath))[0]
+
+        #Settings for the analysis, stored the same way as in the presets file
+        self.preset = dict(DEFAULT_PRESET)
+        if preset is not None:
+            self.preset.update(preset)
+
+        #Saturation and value of the image for masking (see maskPlanes), converted the first time they are needed
+        #   (other colorspaces are only converted inside the zones, see zoneColors)
+        self.imSV = None
+
+        #The result of the latest analysis step, and the settings of every step that led to it
+        #   (stageKey is the key of self.analyzed in the stage cache)
+        self.analyzed = self.im
+        self.stageKey = ()
+        self.stageCache = StageCache()
+
+        #Structuring element for each dilation/erosion
+        self.dileroKernel = DILERO_KERNEL
+
+        #Will be the sum of all the contour masks
+        self.totalMask = np.zeros(self.im.shape[:2], dtype=np.uint8)
+
+        #Whether the labeled image and the mask are drawn on the image and the mask themselves rather than on copies,
+        #   for analyses that are only run once (see TiledAnalysis)
+        #   Otherwise the mask is copied too, since the writer of an earlier analysis may still be saving it
+        self.drawInPlace = False
+
+        #Setup for the lists to store contours and contour properties
+        self.contours = [] #contours
+        self.sizes = [] #size of each contour
+        self.features = None #Hu moments etc. of each contour (see contourFeatures)
+        self.selectedCont = -1 #index of the reference contour
+        self.closeInds = [] #indices of the contours which are similar to the selected one
+        self.closeIndsPlus = [] #the second step of selection
+        self.addConts = [] #manually added contours
+        self.removeConts = [] #manually removed contours
+        self.centers = [] #centroid of each contour
+
+        #Setup for the lists to store information for individual contours post-refinement
+        self.refinedStamps = [] #mask of each refined zone, as (x, y, stamp) covering only the zone's box
+        self.refinedCenters = [] #center of each refined zone
+
+        #Setup for printing numbers on the image after analysis
+        self.numberTextArgs = [] #arguments for each cv2.putText call
+
+        #Boolean to output the cropped image around each zone
+        #   (currently no option to change this)
+        self.saveCrops = True
+
+        #Number of pixels to expand the border around the cropped zone
+        self.saveBorder = 5
+
+        #Cache of earlier results, and the key of each stage of this analysis in it (see run)
+        self.resultCache = None
+        self.cacheKeys = None
+        #Stages of this analysis that were found in the cache
+        self.reusedStages = []
+
+
+    #Returns the value of a preset variable
+    def getSetting(self, name):
+        return self.preset[name]
+
+
+    #Runs every analysis step with the preset settings and saves the outputs
+    #Returns the path of the analysis folder
+    #   If a ResultCache is given with the keys of this image and preset (see stageKeys), the stages it has are reused
+    #   and the stages computed are added to it
+    def run(self, cache=None, keys=None):
+        self.resultCache, self.cacheKeys = cache, keys
+
+        zones = self.cachedStage('zones')
+        if zones is None:
+            self.contours, self.sizes = self.findAllContours()
+            if len(self.contours)==0:
+                raise ValueError(f"No contours found in {self.filePath}")
+
+            self.selectedCont = findReferenceContour(self.sizes, self.getSetting('V_referenceArea'), self.getSetting('V_sizeTol'))
+            self.closeInds = similarContours(self.contours, self.sizes, self.selectedCont,
+                                             self.getSetting('V_sizeTol'), self.getSetting('V_shapeTol'))
+            self.closeIndsPlus = np.union1d(self.closeInds, self.addConts).astype(int)
+            self.findCenters()
+
+            #Only the outlines of the zones are cached, which is all the later stages use
+            zoneContours = self.contours[self.closeIndsPlus].outlines().compact()
+            self.cacheStage('zones', points=zoneContours.points, offsets=zoneContours.offsets,
+                            centers=self.centers, sizes=self.closeSizes)
+
+        else:
+            #The cached zones take the place of all the contours, as contours 0 to n-1
+            #   (their centers and sizes are cached too, since in components mode they are measured from the pixels)
+            self.contours = ContourStore(zones['points'], zones['offsets'])
+            self.sizes = self.closeSizes = zones['sizes']
+            self.centers = zones['centers']
+            self.closeInds = self.closeIndsPlus = np.arange(len(self.contours))
+            self.indDict = {i: i for i in range(len(self.contours))}
+
+        refinement = presetRefinement(self.preset)
+        if refinement is not None:
+            self.setRefinedZones(*refinement)
+
+        self.analyzeContours()
+        self.cacheStage('outputs', analysisPath=np.array(self.analysisPathNum))
+        return self.analysisPathNum
+
+
+    #Thresholds, dilates/erodes and blurs the image with the preset settings, and finds the contours in the result
+    #Returns the contours and their sizes, sorted by size (see findContours)
+    def findAllContours(self):
+        self.maskStep(self.getSetting('V_maskThresh1'), self.getSetting('V_maskThresh2'), self.getSetting('V_maskMode'))
+        self.dilateErodeStep(self.getSetting('V_dilerocode'))
+        self.blurStep(self.getSetting('V_blurAmount'))
+        return findContours(self.analyzed, self.getSetting('V_contourMode'))
+
+
+    #Returns the arrays cached for a stage of this analysis as a dictionary, or None if the analysis isn't cached
+    def cachedStage(self, stage):
+        if self.resultCache is None:
+            return None
+        arrays = self.resultCache.get(stage, self.cacheKeys[stage])
+        if arrays is not None:
+            self.reusedStages.append(stage)
+        return arrays
+
+
+    #Caches the arrays of a stage of this analysis, if it is run with a cache
+    def cacheStage(self, stage, **arrays):
+        if self.resultCache is not None:
+            self.resultCache.put(stage, self.cacheKeys[stage], **arrays)
+
+
+    #Thresholds the image into self.analyzed, reusing the mask if these thresholds were used before
+    def maskStep(self, thresh1, thresh2, maskMode):
+        self.analyzed, self.stageKey = self.maskStage(thresh1, thresh2, maskMode)
+
+
+    #Dilates/erodes self.analyzed according to the code
+    def dilateErodeStep(self, code):
+        self.analyzed, self.stageKey = self.dilateErodeStage(self.analyzed, self.stageKey, code)
+
+
+    #Blurs self.analyzed, reusing the result if this blur was applied to the same mask before
+    def blurStep(self, blurAmount):
+        self.analyzed, self.stageKey = self.blurStage(self.analyzed, self.stageKey, blurAmount)
+
+
+    #Runs the analysis steps up to lastStep (0: none, 1: mask, 2: dilate/erode, 3: blur) with the given settings
+    #   Unlike the steps above this doesn't change self.analyzed, so it can run in a background thread
+    #Returns the result and its stage key
+    def computeStages(self, lastStep, thresh1, thresh2, maskMode, code, blurAmount):
+        analyzed, stageKey = self.im, ()
+        if lastStep>0:
+            analyzed, stageKey = self.maskStage(thresh1, thresh2, maskMode)
+        if lastStep>1:
+            analyzed, stageKey = self.dilateErodeStage(analyzed, stageKey, code)
+        if lastStep>2:
+            analyzed, stageKey = self.blurStage(analyzed, stageKey, blurAmount)
+        return analyzed, stageKey
+
+
+    #The analysis steps, each taking the previous result and its key in the stage cache and returning the new ones
+
+    #Thresholds the image, reusing the mask if these thresholds were used before
+    def maskStage(self, thresh1, thresh2, maskMode):
+        stageKey = ('mask', int(thresh1), int(thresh2), int(maskMode))
+        analyzed = self.stageCache.get(stageKey)
+        if analyzed is None:
+            analyzed = self.stageCache.put(stageKey, thresholdMask(self.maskPlanes(), thresh1, thresh2, maskMode))
+        return analyzed, stageKey
+
+
+    #Returns the saturation and value of the image, converting them the first time
+    def maskPlanes(self):
+        if self.imSV is None:
+            self.imSV = saturationValue(self.im)
+        return self.imSV
+
+
+    #Dilates/erodes according to the code
+    #   Starts from the longest beginning of the code that has already been applied to this mask,
+    #   so pressing Dilate or Erode once more only applies the one new step
+    def dilateErodeStage(self, analyzed, stageKey, code):
+        if len(code)==0:
+            return analyzed, stageKey
+
+        upstreamKey = (stageKey, self.dileroKernel.shape, self.dileroKernel.tobytes())
+        done = 0
+        for n in range(len(code), 0, -1):
+            cached = self.stageCache.get(('dilerode', upstreamKey, code[:n]))
+            if cached is not None:
+                done = n
+                analyzed = cached
+                break
+
+        stageKey = ('dilerode', upstreamKey, code)
+        if done<len(code):
+            analyzed = self.stageCache.put(stageKey, dilateErode(analyzed, code[done:], self.dileroKernel))
+        return analyzed, stageKey
+
+
+    #Blurs, reusing the result if this blur was applied to the same mask before
+    def blurStage(self, analyzed, stageKey, blurAmount):
+        stageKey = ('blur', stageKey, int(blurAmount))
+        blurred = self.stageCache.get(stageKey)
+        if blurred is None:
+            blurred = self.stageCache.put(stageKey, blurMask(analyzed, blurAmount))
+        return blurred, stageKey
+
+
+    #Finds the center of each contour
+    def findCenters(self):
+
+        #Initializing lists of center coordinates and sizes
+        self.centers = np.zeros((len(self.closeIndsPlus),2))
+        self.closeSizes = np.zeros((len(self.closeIndsPlus)))
+
+        #A dictionary that will allow us to go from indices in the contour array to
+        #   indices in the centers array
+        self.indDict = {}
+
+        for i in range(len(self.closeIndsPlus)):
+            self.indDict[int(self.closeIndsPlus[i])] = i
+
+        #Measuring the contours in the closeIndsPlus array, all at once
+        closeContours = self.contours[self.closeIndsPlus]
+
+        #Central moments are given by M_10/M_00 and M_01/M_00,
+        #   where M_ij = sum(x^i y^j I(x,y)) over the whole image,
+        #   where I is either 1 or 0
+        #   Finds the centroid of the image (truncated like int())
+        self.centers[:] = np.trunc(closeContours.centroids()) #x,y
+
+        #For reference: M_00 is sum(I(x,y)), the area
+        self.closeSizes[:] = closeContours.areas() #0,0th moment is the sum of the pixels in the image
+
+
+    #Replaces the contours with refined zones of the given shape, displaced from the contour centers
+    #   (the parameters are those returned by ZoneRefiner.getParams)
+    def setRefinedZones(self, zoneShape, displace_x, displace_y, refiner_data):
+        self.zoneShape, self.displace_x, self.displace_y, self.refiner_data = zoneShape, displace_x, displace_y, refiner_data
+
+        #Applying the displacement to contour centers
+        self.refinedCenters = self.centers+np.array([self.displace_x, -self.displace_y])
+        mask = np.zeros(self.im.shape[:2], dtype=np.uint8)
+
+        #Making a mask for each refined zone, only as big as the zone, so memory scales with zone area
+        self.refinedStamps = []
+        for i in range(len(self.centers)):
+            x, y, stamp = shapeStamp(self.zoneShape, self.refinedCenters[i].astype(int), self.refiner_data, self.im.shape)
+            self.refinedStamps.append((x, y, stamp))
+
+            #Making a total mask for the saved mask image (and display purposes)
+            region = mask[y:y+stamp.shape[0], x:x+stamp.shape[1]]
+            np.bitwise_or(region, stamp, out=region)
+
+        self.totalMask = mask
+
+
+    #Returns the mask of zone i (after sorting) as (x, y, stamp), the stamp covering the image region [y:y+h, x:x+w]
+    def zoneStamp(self, i):
+        if len(self.refinedStamps)==0:
+            return contourStamp(self.contours[self.closeIndsPlus[i]])
+        return self.refinedStamps[i]
+
+
+    #Computes the average color and standard deviation of every zone in each colorspace
+    #Returns the label image of the zones and the zones that overlap (see zoneLabelImage),
+    #   or (None, None) if the zones were measured without a label image
+    def zoneColors(self):
+
+        #Only measuring the colorspaces that are saved (see ZONE_COLORSPACES), the others are left NaN
+        spaces = [k for k, (code, setting) in enumerate(ZONE_COLORSPACES) if setting is None or self.getSetting(setting)]
+
+        #Colors cached by an earlier analysis of the same zones (see run)
+        cached = self.cachedStage('colors')
+        if cached is not None:
+            labels, overlapping = None, None
+            means, stds = cached['means'], cached['stds']
+        else:
+            labels, overlapping, counts, means, stds = self.measureZones(spaces)
+
+        #Reversing RGB because opencv uses BGR
+        self.avcolorsRGB = means[:, 2::-1].copy()
+        self.stdsRGB = stds[:, 2::-1].copy()
+        self.avcolorsHSV = means[:, 3:6].copy()
+        self.stdsHSV = stds[:, 3:6].copy()
+        self.avcolorsLAB = means[:, 6:9].copy()
+        self.stdsLAB = stds[:, 6:9].copy()
+
+        #Getting the area of each masked region (the counts of a label image leave out the pixels of overlaps)
+        if cached is not None:
+            self.maskAreas = cached['areas']
+        elif labels is None:
+            self.maskAreas = counts.astype(np.float64)
+        else:
+            self.maskAreas = np.array([np.count_nonzero(stamp) for x, y, stamp in self.zoneStamps], dtype=np.float64)
+
+        if cached is None:
+            self.cacheStage('colors', means=means, stds=stds, areas=self.maskAreas)
+
+        return labels, overlapping
+
+
+    #Measures the pixel count, average color and standard deviation of every zone in the colorspaces of
+    #   ZONE_COLORSPACES given by their indices in spaces
+    #Returns the label image of the zones and the zones that overlap (see zoneLabelImage), or (None, None),
+    #   then the counts (n,), means and standard deviations (n, 3*len(ZONE_COLORSPACES)), NaN in the other colorspaces
+    def measureZones(self, spaces):
+        nZones = len(self.zoneStamps)
+        conversions = [ZONE_COLORSPACES[k][0] for k in spaces]
+        columns = np.concatenate([np.arange(3*k, 3*k+3) for k in spaces])
+        means = np.full((nZones, 3*len(ZONE_COLORSPACES)), np.nan)
+        stds = np.full((nZones, 3*len(ZONE_COLORSPACES)), np.nan)
+
+        #Rectangular refined zones are measured from summed-area tables, without rasterizing them
+        #   (rectangles can overlap freely, since each one is looked up on its own)
+        if len(self.refinedStamps)!=0 and self.zoneShape=='rectangle':
+            labels, overlapping = None, None
+            bounds = rectangleBounds(self.refinedCenters.astype(int), self.refiner_data, self.im.shape)
+            counts, means[:, columns], stds[:, columns] = rectangleStatistics(bounds, self.im, conversions)
+
+        else:
+            #Rasterizing all zones into one label image, then computing the colors of all zones in one pass
+            labels, overlapping = zoneLabelImage(self.im.shape[:2], self.zoneStamps)
+            counts, means[:, columns], stds[:, columns] = zoneStatistics(labels, nZones, self.im, conversions)
+
+            #Zones that overlap share pixels, which one label image can't hold, so those are done one at a time
+            for i in overlapping:
+                x, y, stamp = self.zoneStamps[i]
+                h, w = stamp.shape
+                for k in spaces:
+                    zoneIm = convertColors(self.im[y:y+h,x:x+w], ZONE_COLORSPACES[k][0])
+                    means[i, 3*k:3*k+3], stds[i, 3*k:3*k+3] = getAvColor(zoneIm, stamp)
+
+        return labels, overlapping, counts, means, stds
+
+
+    #Final contour analysis, saves the zone colors, crops, and labeled image to a new analysis folder
+    def analyzeContours(self):
+        print("ANALYZING")
+
+        #Array to store position, size, etc. for text to place on image
+        self.numberTextArgs = np.zeros(len(self.closeIndsPlus), dtype=object)
+
+
+        #Making a unique folder name for this analysis output
+        self.analysisPathNum = makeAnalysisFolder(self.filePath)
+
+        #The output files are saved in the background while the rest of the analysis is done
+        writer = OutputWriter(progress=self.outputProgress)
+
+
+        #Various aesthetic properties will be decided by the size of the largest contour
+        #   Note: this will behave poorly when the analyzed contours are of very different sizes
+        largestContInd = self.closeIndsPlus[np.argmax(self.closeSizes)]
+        largest_x, largest_y, largest_w, largest_h = cv2.boundingRect(self.contours[largestContInd])
+
+
+        #Sorting indices first by row then by column
+        sort_inds = np.lexsort((self.centers[:,0],self.centers[:,1]))
+
+        #Sorting the arrays
+        self.closeIndsPlus = self.closeIndsPlus[sort_inds]
+        self.centers = self.centers[sort_inds]
+
+        #If the user has refined the zones, sorting those arrays too
+        if len(self.refinedStamps)!=0:
+            self.refinedStamps = [self.refinedStamps[ind] for ind in sort_inds]
+            self.refinedCenters = self.refinedCenters[sort_inds]
+
+        #Getting the average colors and standard deviations of all the zones
+        self.zoneStamps = [self.zoneStamp(i) for i in range(len(self.closeIndsPlus))]
+        labels, overlapping = self.zoneColors()
+
+        #Bounding boxes of all the close contours, computed at once
+        contRects = self.contours[self.closeIndsPlus].boundingRects().tolist()
+
+        #If the user has not refined zones, the mask is made of the contours
+        if len(self.refinedStamps)==0:
+            mask = self.totalMask if self.drawInPlace else self.totalMask.copy()
+            for x, y, stamp in self.zoneStamps:
+                region = mask[y:y+stamp.shape[0], x:x+stamp.shape[1]]
+                np.bitwise_or(region, stamp, out=region)
+            self.totalMask = mask
+
+        #If the user has elected to save the histograms, saving them all at once
+        #   (the plots, if requested, are drawn in the background while the crops are saved)
+        plotter = None
+        if self.getSetting('V_saveHistograms'):
+            plotter = self.saveHistograms(labels, overlapping, writer)
+
+
+        #Looping through all the close contours to analyze them
+        for i in range(len(self.closeIndsPlus)):
+
+            ind = self.closeIndsPlus[i]
+            cont = self.contours[ind]
+
+            cont_x, cont_y, cont_w, cont_h = contRects[i]
+
+
+            #If there are no refined masks (the user has not refined zones)
+            #   then use contours
+            if len(self.refinedStamps)==0:
+                w, h = cont_w, cont_h
+                center = self.centers[i]
+
+            #If the user has refined zones, use the refined zones
+            else:
+                center = self.refinedCenters[i]
+                w = self.refiner_data[-1][0]*2+1
+                h = self.refiner_data[-1][-1]*2+1
+
+            #Finding a referencee text size for scaling
+            t_size, baseline = cv2.getTextSize(str(i+1), cv2.FONT_HERSHEY_SIMPLEX, 1, 10)
+
+            #Scaling by the size of the largest contour
+            #TODO: Find a better way to scale the text!!
+            fontsize = min(int(np.round(largest_w/t_size[0])),int(np.round(largest_h/t_size[1])))
+
+            #Setting the position of the number to the top right of the contour
+            textcent = (int(center[0]+w//2), int(center[1]-h//2))
+            color = [0,255,0]
+
+            self.numberTextArgs[i]=(str(i+1), textcent, cv2.FONT_HERSHEY_SIMPLEX, fontsize, color)
+
+
+
+            print(f'Spot {i+1} analyzed')
+
+
+            #Saves an image cropped to the current zone
+            if self.saveCrops:
+                cropspath = self.analysisPathNum+'/crops'
+                if not os.path.exists(cropspath):
+                    os.makedirs(cropspath)
+                    os.makedirs(cropspath+'/drawn')
+
+                #Takes a slice of the image from the top-left corner of the zone
+                #   with the dimensions of the largest of the close contours (for consistent crop sizes)
+                cropRows = slice(cont_y-self.saveBorder, cont_y+largest_h+self.saveBorder)
+                cropCols = slice(cont_x-self.saveBorder, cont_x+largest_w+self.saveBorder)
+                crop_im = self.im[cropRows, cropCols]
+                #(copied if the labeled image is drawn on the image, since the crops are saved in the background)
+                if self.drawInPlace:
+                    crop_im = crop_im.copy()
+
+                #A copy of the crop to draw just the contour on, shifting the contour by where the crop starts
+                #   (range gives the rows and columns that the slices actually pick out of the image)
+                crop_im_draw = crop_im.copy()
+                cropOffset = (-range(self.im.shape[1])[cropCols].start, -range(self.im.shape[0])[cropRows].start)
+
+                #Drawing either the contour or the refined zone shape
+                if crop_im_draw.size==0:
+                    pass
+                elif len(self.refinedStamps)==0:
+                    cv2.drawContours(crop_im_draw, [cont], -1, (255,255,0), 1, offset=cropOffset)
+                else:
+                    pasteShape(crop_im_draw, self.zoneShape, self.refinedCenters[i], self.refiner_data, (0,0,255), 1, offset=cropOffset)
+
+                #Saving the resulting images
+                writer.writeImage(cropspath+'/'+self.filename+'_crop_'+str(i+1)+'.jpg', crop_im)
+                writer.writeImage(cropspath+'/drawn/'+self.filename+'_crop_draw_'+str(i+1)+'.jpg', crop_im_draw)
+
+        #Saves the average colors to a csv file
+        self.saveColors(writer)
+
+        #Saves the numbered image and the mask for reference
+        self.saveIm(writer)
+
+        self.finishOutputs(writer, plotter)
+
+
+    #Waits for the histogram plots and every output file of the analysis to be saved
+    def finishOutputs(self, writer, plotter):
+        if plotter is not None:
+            plotter.close()
+        saved = writer.close()
+        print(f"Saved {saved} files to {self.analysisPathNum}")
+
+
+    #Reports the output files saved so far (called from the writer threads), every 100 files
+    def outputProgress(self, saved, requested):
+        if saved%100==0:
+            print(f"Saved {saved} of the {requested} files requested so far")
+
+
+    #Collects the results of every zone into one array (see RESULTS_DTYPE), converting the colors to the units of the csv file
+    def zoneResults(self):
+        zones = np.zeros(len(self.closeIndsPlus), dtype=RESULTS_DTYPE)
+
+        #Numbers in ascending order to match numbers drawn on image
+        zones['id'] = np.arange(len(zones))+1
+
+        #Centers of the refined zones, or of the contours if the zones weren't refined
+        centers = self.centers if len(self.refinedStamps)==0 else self.refinedCenters
+        zones['x'] = centers[:,0]
+        zones['y'] = centers[:,1]
+
+        #The contour areas (or refined zone areas)
+        zones['Area [pixels]'] = self.maskAreas
+
+        rgb = self.avcolorsRGB
+        std_rgb = self.stdsRGB
+
+        #Grayscale values calculated as a weighted average of RGB
+        grayscale = np.dot(rgb, RGB2grayscale_weights)
+        std_grayscale = np.sqrt(np.dot(std_rgb**2, RGB2grayscale_weights**2)) #sqrt of sum of squares for proper propagation of error
+
+        #Hue from OpenCV's 0-180 to degrees, saturation and value from 0-255 to 0-1
+        hsv = self.avcolorsHSV.copy()
+        hsv[:,0] = hsv[:,0]/180*360
+        hsv[:,1:] = np.round(hsv[:,1:]/255, 8)
+        std_hsv = self.stdsHSV.copy()
+        std_hsv[:,0] = std_hsv[:,0]/180*360
+        std_hsv[:,1:] = np.round(std_hsv[:,1:]/255, 8)
+
+        #Lightness from 0-255 to 0-100, a and b centered on 0
+        lab = self.avcolorsLAB.copy()
+        lab[:,0] = np.round(lab[:,0]/255*100, 8)
+        lab[:,1:] = lab[:,1:]-128
+        std_lab = self.stdsLAB.copy()
+        std_lab[:,0] = np.round(std_lab[:,0]/255*100, 8)
+
+        for colorspace, means, stds in (('RGB', rgb, std_rgb), ('Gray', grayscale[:,None], std_grayscale[:,None]),
+                                        ('HSV', hsv, std_hsv), ('LAB', lab, std_lab)):
+            for c, name in enumerate(RESULTS_CHANNELS[colorspace]):
+                zones[name] = means[:,c]
+                zones['std '+name] = stds[:,c]
+
+        return zones
+
+
+    #Saving the results of every zone, with the preset settings used, to an npz file
+    #   and the average colors to a csv file if the user has elected to (made from the same results)
+    def saveColors(self, writer):
+        zones = self.zoneResults()
+        preset = presetRecord({name: self.getSetting(name) for name in self.preset})
+
+        output = self.getSetting('V_resultsOutput') or RESULTS_OUTPUTS[0]
+        if output not in RESULTS_OUTPUTS:
+            raise ValueError(f"Unknown results output {output!r}, expected one of {RESULTS_OUTPUTS}")
+
+        writer.write(self.analysisPathNum+'/'+self.filename+"_results.npz", lambda f: np.savez(f, zones=zones, preset=preset))
+
+        if not output.endswith('+csv'):
+            return
+
+        #The program will always output at least the grayscale (and the areas)
+        colorspaces = [colorspace for colorspace in RESULTS_CHANNELS if colorspace=='Gray' or self.getSetting('V_save'+colorspace)]
+        header, full = resultsTable(zones, colorspaces)
+
+        #Saving the table in a csv format
+        writer.write(self.analysisPathNum+'/'+self.filename+"_colors.csv",
+                     lambda f: np.savetxt(f, full, delimiter=',', header = header, fmt='%s', comments=''))
+
+
+    #Saving the image with numbers drawn on
+    def saveIm(self, writer):
+        #copying the image so we don't edit the original (unless it isn't needed after this)
+        imcopy = self.im if self.drawInPlace else self.im.copy()
+
+        #Drawing the numbers on
+        for i in range(len(self.numberTextArgs)):
+            cv2.putText(imcopy, *self.numberTextArgs[i], thickness=10)
+
+        #If the user has refined the zones, draw the zones
+        if len(self.refinedStamps)!=0:
+            for i in range(len(self.refinedStamps)):
+                center = self.refinedCenters[i].astype(int)
+                pasteShape(imcopy, self.zoneShape, center, self.refiner_data, color=(0,0,255), thickness=4)
+        #Otherwise, draw the contours
+        else:
+            cv2.drawContours(imcopy, self.contours[self.closeIndsPlus], -1, (255,255,0), 4)
+
+        #Save the labeled image and the mask
+        writer.writeImage(self.analysisPathNum+'/'+self.filename+"_labeled"+self.ext, imcopy)
+        writer.writeImage(self.analysisPathNum+'/'+self.filename+"_mask"+self.ext, self.totalMask)
+
+
+    #Saving the histograms of every zone, computed at once from the label image of the zones (see zoneColors)
+    #   Triggered by analyzeContours if the user has elected to save the histograms
+    #Returns the HistogramPlotter drawing the plots in the background, or None if no plots were requested
+    def saveHistograms(self, labels, overlapping, writer):
+        histspath = self.analysisPathNum+'/histograms'
+        if not os.path.exists(histspath):
+            os.makedirs(histspath)
+
+        #Zones measured without a label image are counted one at a time, each from its own box
+        if labels is None:
+            heights = np.zeros((len(self.zoneStamps), 3, 256), dtype=np.int64)
+            overlapping = range(len(self.zoneStamps))
+        else:
+            heights = zoneHistograms(labels, len(self.zoneStamps), self.im)
+
+        #Zones that overlap share pixels, which one label image can't hold, so those are counted one at a time
+        for i in overlapping:
+            x, y, stamp = self.zoneStamps[i]
+            heights[i] = imageHistograms(self.im[y:y+stamp.shape[0],x:x+stamp.shape[1]], stamp)[0]
+
+        output = self.getSetting('V_histogramOutput') or HISTOGRAM_OUTPUTS[0]
+        if output not in HISTOGRAM_OUTPUTS:
+            raise ValueError(f"Unknown histogram output {output!r}, expected one of {HISTOGRAM_OUTPUTS}")
+        paths = [histspath+'/'+self.filename+'_histogram_'+str(i+1) for i in range(len(heights))]
+
+        #One array for all the zones, in RGB order like the csv files
+        if output.startswith('npy'):
+            writer.write(histspath+'/'+self.filename+'_histograms.npy', np.save, heights[:, ::-1].transpose(0, 2, 1))
+
+        #Otherwise a csv file per zone, with the bins and the counts of the red, green and blue channels
+        else:
+            bins = np.arange(256)
+            saveCsv = lambda f, combo: np.savetxt(f, combo, fmt='%d', header='bin, Red Channel, Green Channel, Blue Channel', delimiter=',', comments='')
+            for i in range(len(heights)):
+                combo = np.column_stack((bins, heights[i, 2], heights[i, 1], heights[i, 0]))
+                writer.write(paths[i]+'.csv', saveCsv, combo)
+
+        ###Also saving plots of the histograms for immediate inspection###
+        if not output.endswith('+plots'):
+            return None
+
+        plotter = HistogramPlotter(writer)
+        for i in range(len(heights)):
+            plotter.plot(heights[i], f"Zone {i+1} Histogram", paths[i]+'.png')
+        return plotter
+
+
+
+
+#Object: TiledAnalysis
+#Purpose: Analyzes an image one tile at a time, for scans too large to also hold the masks, label images and color
+#   conversions of the whole image: the blobs are found a tile at a time (see findTiledComponents) and the zones
+#   measured a tile at a time (see tiledZoneStatistics), so the memory these take is bounded by the tile size
+#   Blobs are found by connected-component labeling, so the results are those of the components contour mode,
+#   which the preset is switched to
+#   The memory isn't bounded by the tile size alone: the image is read whole, and the labeled image and the mask are
+#   saved whole, since OpenCV can only encode whole images. The labeled image is drawn on the image itself and the mask
+#   is the only array the size of the whole image that is made, so at most the image and a one byte per pixel mask are
+#   held, on top of what a tile takes
+class TiledAnalysis(ColorAnalysis):
+
+    def __init__(self, im, filePath, preset=None, tileSize=TILE_SIZE):
+        ColorAnalysis.__init__(self, im, filePath, preset)
+        self.tileSize = tileSize
+        self.drawInPlace = True
+
+        if self.preset['V_contourMode']!='components':
+            print(f"Tiled analysis finds blobs as connected components, ignoring the {self.preset['V_contourMode']!r} contour mode of the preset")
+            self.preset['V_contourMode'] = 'components'
+
+
+    #Finds the blobs of the mask a tile at a time, the mask itself never being made
+    def findAllContours(self):
+        return contoursBySize(findTiledComponents(self.im, self.getSetting('V_maskThresh1'), self.getSetting('V_maskThresh2'),
+                                                  self.getSetting('V_maskMode'), self.getSetting('V_dilerocode'),
+                                                  self.getSetting('V_blurAmount'), self.tileSize))
+
+
+    #Measures the zones a tile at a time, without a label image, whatever their shape
+    def measureZones(self, spaces):
+        nZones = len(self.zoneStamps)
+        columns = np.concatenate([np.arange(3*k, 3*k+3) for k in spaces])
+        means = np.full((nZones, 3*len(ZONE_COLORSPACES)), np.nan)
+        stds = np.full((nZones, 3*len(ZONE_COLORSPACES)), np.nan)
+
+        counts, means[:, columns], stds[:, columns] = tiledZoneStatistics(self.zoneStamps, self.im, [ZONE_COLORSPACES[k][0] for k in spaces],
+                                                                          self.tileSize)
+        return None, None, counts, means, stds